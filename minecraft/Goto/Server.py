@@ -1,19 +1,123 @@
+import time
+STARTUP_STARTED = time.perf_counter() # 起動時間の内訳 (imports) の計測開始
 import os
 import io
 import logging
 import numpy as np
 from PIL import Image
-from flask import Flask, request, jsonify
-from ultralytics import YOLO
+from flask import Flask, request, jsonify, g, Response
 import cv2
-import time
 import errno
+import argparse
+import threading
+import queue
+import collections
+import signal
+import socket
+import gc
+import json
+import hashlib
+import hmac
+import re
+import math
+import metrics
+import detection_codec
+import shm_ring
+import uuid
+import datetime
+from debug_archive import DebugArchive
+from detection_history import DetectionHistory
+from onnx_export import export_onnx_cached, int8_model_path, file_sha256
+from tracker import Tracker, TrackingSessions, SessionLimitError
+from concurrent.futures import Future, ThreadPoolExecutor
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header
+
+try:
+    # WebSocket (/stream) はオプション: pip install flask-sock
+    from flask_sock import Sock
+    from simple_websocket import ConnectionClosed
+except ImportError:
+    Sock = None
+
+try:
+    # asyncio フロントエンド (--async) はオプション: pip install aiohttp
+    import asyncio
+    from aiohttp import web
+except ImportError:
+    web = None
+
+# ultralytics / torch はモデルを作るときに import する (時間はモデルのロード時間の 'ultralytics_import' に含まれる)
+IMPORTS_SECONDS = time.perf_counter() - STARTUP_STARTED
 
 # --- 設定値 ---
 CONFIDENCE_THRESHOLD = 0.1 # 個々の検出の信頼度閾値
 IMAGE_SIZE = 648           # 推論時の画像サイズ
 SERVER_PORT = 9001          # サーバーポート
+MODEL_BACKEND = 'torch'    # 推論バックエンド: torch / onnx / onnx-int8 / stub
+STUB_LATENCY_MS = 0.0      # stub バックエンドの1バッチあたりの推論時間 (HTTP 層だけの負荷試験用)
 DEBUG_IMAGE_DIR = './debug_images' # デバッグ画像保存ディレクトリ
+BATCH_MAX_SIZE = 8         # 1回の model.predict にまとめる最大画像数
+BATCH_MAX_WAIT_MS = 10.0   # バッチが埋まるまで最初のリクエストを待たせる最大時間 (ミリ秒)
+BATCH_ENDPOINT_MAX_IMAGES = 32 # /predict/batch で1リクエストに含められる最大画像数
+STATS_WINDOW = 1000        # 統計 (p50/p99) 計算に使う直近サンプル数
+JPEG_REDUCED_DECODE = True # 大きな JPEG を DCT スケーリングで縮小デコードする
+WORKER_MIN_UPTIME = 10.0          # これより短い稼働で終了したワーカーは「連続クラッシュ」とみなす (秒)
+WORKER_RESTART_BACKOFF_MAX = 30.0 # クラッシュを繰り返すワーカーの再起動待ちの上限 (秒)
+WORKER_SHUTDOWN_TIMEOUT = 10.0    # 終了時にワーカーの停止を待つ時間 (秒)
+RESULT_CACHE_MAX_MB = 64.0 # 推論結果キャッシュのメモリ上限 (MB, 0 で無効)
+RESULT_CACHE_TTL = 30.0    # 推論結果キャッシュの有効期間 (秒)
+DEBUG_SAMPLE_MODE = 'all'  # デバッグ画像の保存対象: all / every_n / no_detection / low_confidence / off
+DEBUG_SAMPLE_EVERY_N = 10  # every_n モードで何リクエストに1枚保存するか
+DEBUG_LOW_CONFIDENCE = 0.3 # low_confidence モードで「低信頼度」とみなす最大信頼度
+DEBUG_QUEUE_SIZE = 64      # 保存待ちデバッグ画像の最大数 (超えた分は破棄)
+DEBUG_MAX_MB = 2048.0      # デバッグ画像 (アーカイブを含む) の合計サイズの上限 (MB, 0 で無制限, 超えたら古いものから消す)
+DEBUG_MAX_FILES = 200000   # デバッグ画像 (アーカイブを含む) の枚数の上限 (0 で無制限)
+DEBUG_MAX_AGE_HOURS = 168.0 # デバッグ画像を残す期間 (時間, 0 で無制限)
+DEBUG_ARCHIVE = True       # 過ぎた時間帯のデバッグ画像を1時間ごとの zip (archive/YYYYMMDD_HH.zip) にまとめる
+DEBUG_MAINTENANCE_INTERVAL = 60.0 # デバッグ画像のアーカイブ・削除を行う間隔 (秒)
+DEBUG_MAINTENANCE_BATCH = 5000    # 1回の整理で扱う画像の上限 (溜まっている分は DEBUG_MAINTENANCE_RETRY 秒ごとに続きを片付ける)
+DEBUG_MAINTENANCE_RETRY = 1.0
+HISTORY_ENABLED = True     # 検出結果を履歴 (SQLite) に記録し、/history で集計できるようにする
+HISTORY_DB_PATH = './detection_history.sqlite' # 検出結果の履歴の保存先
+HISTORY_FLUSH_INTERVAL = 1.0 # 履歴をまとめて書き込む間隔 (秒)
+HISTORY_QUEUE_SIZE = 10000 # 書き込み待ちの履歴 (フレーム数) の上限 (超えた分は破棄)
+HISTORY_MAX_BUCKETS = 10000 # /history の時系列で返せる最大バケット数
+INFERENCE_QUEUE_MAX = 64   # 推論待ちキューに入れられる最大画像数 (超えたら 429)
+ADMISSION_MAX_WAIT_MS = 2000.0 # 予測されるキュー待ち時間がこれを超えるリクエストは 429 で断る (ミリ秒)
+TILE_SIZE = IMAGE_SIZE     # 分割推論 (?tiled=1) のタイルの一辺 (ピクセル)
+TILE_OVERLAP = 0.2         # 隣り合うタイルの重なり (タイルの一辺に対する割合)
+TILE_MAX_TILES = 16        # 1枚から作る最大タイル数 (超える場合はタイルを大きくする)
+TILE_MAX_TILES_LIMIT = 64  # リクエストで指定できる max_tiles の上限
+TILE_FULL_FRAME = False    # 分割推論で画像全体の粗い推論も合わせて行うか
+TILE_NMS_IOU = 0.5         # タイル間の重複検出をまとめる NMS の IoU 閾値
+MODEL_DIR = './models'     # ?model=<name> で選べる名前付きモデル (<name>.pt) の置き場所
+MODEL_MEMORY_BUDGET_MB = 2048.0 # 名前付きモデルの合計メモリ上限 (MB, 超えたら使われていない順に解放)
+MODEL_WATCH_INTERVAL = 5.0 # best.pt の更新を確認する間隔 (秒, 0 で監視しない)
+ADMIN_TOKEN = os.environ.get('GOTO_ADMIN_TOKEN') # /admin/* 用のトークン (未設定ならローカルからのみ許可)
+TRACK_DETECT_EVERY = 1     # /track で何フレームに1回検出を行うか (間のフレームは動きから予測)
+TRACK_MAX_SESSIONS = 64    # /track の同時セッション数の上限
+TRACK_SESSION_TIMEOUT = 60.0 # この時間フレームが来ないセッションは破棄する (秒)
+TRACK_MAX_MISSED = 10      # 検出フレームで連続してこの回数見つからなかったトラックを削除する
+RESOLUTION_ADAPTIVE = False # 負荷に応じて推論解像度 (imgsz) を RESOLUTION_LEVELS の中で切り替えるか
+RESOLUTION_LEVELS = (960, 648, 480, 320) # 切り替える推論解像度 (開始は IMAGE_SIZE に最も近いもの)
+RESOLUTION_TARGET_MS = 300.0 # 保ちたい1枚あたりの推論レイテンシ (キュー待ち + 推論, ミリ秒)
+RESOLUTION_UP_MARGIN = 0.7 # 1段上げた場合の予測レイテンシが目標のこの割合以下なら上げる
+RESOLUTION_QUEUE_HIGH = 16 # 推論待ちの画像がこれを超えたらレイテンシに関係なく1段下げる
+RESOLUTION_DOWN_DWELL = 2.0 # 解像度を変えてから次に下げるまでの最短時間 (秒)
+RESOLUTION_UP_DWELL = 10.0 # 解像度を変えてから次に上げるまでの最短時間 (秒)
+RESOLUTION_MIN_SAMPLES = 5 # 解像度を変えてから判断に使う最小リクエスト数
+ASYNC_EXECUTOR_WORKERS = os.cpu_count() or 4 # --async でデコードなどの CPU 処理を行うスレッド数
+ASYNC_MAX_PENDING = INFERENCE_QUEUE_MAX # --async でスレッドの順番待ち + 実行中にできる処理の数 (超えたら 429)
+ASYNC_READ_TIMEOUT = 30.0  # --async でリクエスト本体の受信を待つ最大時間 (秒, 超えたら 408)
+ASYNC_KEEPALIVE_TIMEOUT = 75.0 # --async で keep-alive 接続を保持する時間 (秒)
+UPLOAD_MAX_MB = 64.0       # --async で受け付けるリクエスト本体の最大サイズ (MB)
+LETTERBOX_STRIDE = 32      # レターボックス済みのフレーム (X-Letterboxed) の一辺はこの倍数 (モデルの最大ストライド)
+SHM_INGEST = False         # 同じホストのクライアントから共有メモリ経由で生のフレームを受け取るか
+SHM_SOCKET_PATH = shm_ring.DEFAULT_SOCKET_PATH # 共有メモリ受信の Unix ドメインソケットのパス
+SHM_SOCKET_MODE = 0o600    # ソケットのパーミッション (接続できるユーザーは任意の共有メモリを推論させられるため、既定はサーバーのユーザーのみ)
+TRACK_IOU_THRESHOLD = 0.2  # トラックと検出を対応付ける IoU の下限
+TRACK_HIGH_CONFIDENCE = 0.5 # これ以上の信頼度の検出を優先して対応付け、新しいトラックを作る
 
 app = Flask(__name__)
 
@@ -32,236 +136,3239 @@ except OSError as e:
         logging.error(f"Could not create debug image directory '{DEBUG_IMAGE_DIR}': {e}", exc_info=True)
         DEBUG_IMAGE_DIR = None # 保存しないように設定
 
+# --- 推論バックエンド ---
+class TorchBackend:
+    """PyTorch (ultralytics YOLO) でそのまま推論するバックエンド"""
+    name = 'torch'
+    requires_weights = True # False のバックエンドは best.pt が無くても起動できる
+    fixed_input_size = None # 入力サイズが固定のバックエンド (静的 INT8 ONNX) はその一辺。レターボックス済みのフレームはこの大きさに限る
+
+    def __init__(self, weights_path):
+        self.weights_path = weights_path
+        self.model_path = weights_path
+        self.timings = {}
+        self.model = self._load(weights_path)
+        self._check_loaded()
+        # Conv と BatchNorm の融合は初回の推論時に行われるため、ここで済ませて時間を分けて計測する
+        started = time.perf_counter()
+        self.model.fuse()
+        self.timings['fuse'] = time.perf_counter() - started
+
+    def _load(self, path, **kwargs):
+        """ultralytics の import (初回のみ重い) と重みの読み込みを別々に計測する"""
+        started = time.perf_counter()
+        from ultralytics import YOLO
+        loaded = time.perf_counter()
+        self.timings['ultralytics_import'] = loaded - started
+        yolo = YOLO(path, **kwargs)
+        self.timings['weights'] = time.perf_counter() - loaded
+        return yolo
+
+    def _check_loaded(self):
+        from ultralytics import YOLO
+        # モデルロード成功確認 (クラス名が取得できるかなど)
+        if isinstance(self.model, YOLO) and hasattr(self.model, 'names'):
+            self.names = self.model.names
+        else:
+            # 読み込めても期待するオブジェクトでない場合
+            raise RuntimeError("Failed to initialize YOLO model object properly (e.g., missing 'names' attribute).")
+
+    def predict(self, images, imgsz, conf):
+        return self.model.predict(
+            images,                  # BGR画像 (のリスト) を入力
+            imgsz=imgsz,             # 推論サイズ指定
+            conf=conf,               # 信頼度閾値
+            verbose=False            # コンソール出力を抑制
+        )
+
+    def predict_letterboxed(self, images, imgsz, conf):
+        """
+        クライアントがレターボックス済みの BGR 画像 (すべて同じ大きさ) を推論する。
+        ultralytics の前処理 (縮小・パディング) を通さないよう、前処理済みのテンソル (RGB, 0-1) にして渡す。
+        """
+        import torch
+        batch = torch.from_numpy(np.stack(images)).permute(0, 3, 1, 2).flip(1) # BHWC (BGR) -> BCHW (RGB)
+        return self.model.predict(batch.contiguous().float().div_(255.0), imgsz=imgsz, conf=conf, verbose=False)
+
+    def describe(self):
+        return {
+            'backend': self.name,
+            'weights': self.weights_path,
+            'model_file': self.model_path,
+            'sha256': getattr(self, 'weights_sha256', None),
+            'load_seconds': getattr(self, 'load_seconds', None),
+            'warmup_ms': getattr(self, 'warmup_ms', None),
+            'warmup_batches_ms': getattr(self, 'warmup_batches_ms', None),
+            'load_timings_seconds': {phase: round(seconds, 3) for phase, seconds in getattr(self, 'timings', {}).items()},
+            'loaded_at': getattr(self, 'loaded_at', None),
+        }
+
+
+class OnnxBackend(TorchBackend):
+    """
+    best.pt を ONNX に書き出し ONNX Runtime (CPU) で推論するバックエンド。
+    書き出したファイルは重みのハッシュと IMAGE_SIZE をキーにキャッシュし、次回以降は再利用する。
+    """
+    name = 'onnx'
+
+    def __init__(self, weights_path, imgsz=IMAGE_SIZE, cache_dir=None):
+        self.weights_path = weights_path
+        self.timings = {}
+        started = time.perf_counter()
+        self.model_path = export_onnx_cached(weights_path, imgsz, cache_dir or MODEL_CACHE_DIR)
+        self.timings['export'] = time.perf_counter() - started
+        self.model = self._load(self.model_path, task='detect')
+        self._check_loaded()
+
+
+class OnnxInt8Backend(TorchBackend):
+    """quantize.py で作成した静的 INT8 量子化 ONNX モデルで推論するバックエンド"""
+    name = 'onnx-int8'
+
+    def __init__(self, weights_path, imgsz=IMAGE_SIZE, cache_dir=None):
+        self.weights_path = weights_path
+        self.model_path = int8_model_path(weights_path, imgsz, cache_dir or MODEL_CACHE_DIR)
+        if not os.path.exists(self.model_path):
+            raise FileNotFoundError(f"INT8 model not found at {self.model_path}. Create it first with: python quantize.py --imgsz {imgsz}")
+        self.fixed_input_size = letterbox_size(imgsz)
+        self.timings = {}
+        self.model = self._load(self.model_path, task='detect')
+        self._check_loaded()
+
+
+class StubBoxes:
+    """ultralytics の Boxes と同じ属性 (xyxy / conf / cls) を NumPy 配列で持つ"""
+    __slots__ = ('xyxy', 'conf', 'cls')
+
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy = xyxy
+        self.conf = conf
+        self.cls = cls
+
+    def __len__(self):
+        return len(self.conf)
+
+
+class StubResult:
+    __slots__ = ('boxes',)
+
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+class StubBackend(TorchBackend):
+    """
+    モデルを使わず、画像の大きさから決まる固定の検出結果を返すバックエンド (loadtest.py で HTTP 層だけを計測する用)。
+    推論時間は STUB_LATENCY_MS (IMAGE_SIZE での1バッチあたり, 画素数に比例させる) の sleep で模擬する。
+    """
+    name = 'stub'
+    requires_weights = False
+    # 画像の幅・高さに対する割合で表した矩形 (x1, y1, x2, y2), 信頼度, クラス ID
+    DETECTIONS = (
+        ((0.10, 0.20, 0.30, 0.60), 0.90, 0),
+        ((0.45, 0.40, 0.60, 0.85), 0.65, 1),
+        ((0.70, 0.10, 0.95, 0.50), 0.30, 2),
+    )
+
+    def __init__(self, weights_path, latency_ms=None):
+        self.weights_path = weights_path
+        self.model_path = 'stub'
+        self.model = None
+        self.timings = {}
+        self.latency_ms = STUB_LATENCY_MS if latency_ms is None else latency_ms
+        self.names = {0: 'zombie', 1: 'skeleton', 2: 'creeper'}
+        self._fractions = np.array([box for box, _, _ in self.DETECTIONS], dtype=np.float64)
+        self._conf = np.array([conf for _, conf, _ in self.DETECTIONS])
+        self._cls = np.array([class_id for _, _, class_id in self.DETECTIONS], dtype=np.int64)
+
+    def predict(self, images, imgsz, conf):
+        if self.latency_ms > 0:
+            time.sleep(self.latency_ms / 1000.0 * (imgsz / IMAGE_SIZE) ** 2)
+        keep = self._conf >= conf
+        results = []
+        for image in images:
+            height, width = image.shape[:2]
+            xyxy = self._fractions[keep] * np.array([width, height, width, height])
+            results.append(StubResult(StubBoxes(xyxy, self._conf[keep], self._cls[keep])))
+        return results
+
+    def predict_letterboxed(self, images, imgsz, conf):
+        return self.predict(images, imgsz, conf)
+
+
+def letterbox_size(imgsz):
+    """imgsz で推論するときの実際の入力の一辺 (ultralytics と同じく LETTERBOX_STRIDE の倍数に切り上げる)"""
+    return math.ceil(imgsz / LETTERBOX_STRIDE) * LETTERBOX_STRIDE
+
+
+MODEL_BACKENDS = {
+    'torch': TorchBackend,
+    'onnx': OnnxBackend,
+    'onnx-int8': OnnxInt8Backend,
+    'stub': StubBackend,
+}
+
+
 # --- モデルロード ---
 model = None
 model_load_error = None
-try:
-    # スクリプト自身の場所を基準にモデルパスを決定
-    script_path = os.path.abspath(__file__)
-    script_dir = os.path.dirname(script_path)
-    relative_model_path = './best.pt' # モデルファイルへの相対パス
-    model_name = os.path.join(script_dir, relative_model_path)
-    model_name = os.path.normpath(model_name) # パスを正規化
-
-    logging.info(f"Attempting to load model from calculated path: {model_name}")
-    logging.info(f"Using confidence threshold for predict: {CONFIDENCE_THRESHOLD}")
-    logging.info(f"Using image size for predict: {IMAGE_SIZE}")
-    # logging.info(f"Prediction iterations: {PREDICT_ITERATIONS}") # 削除
-    # logging.info(f"NMS IoU threshold: {NMS_IOU_THRESHOLD}")      # 削除
-
-    if not os.path.exists(model_name):
-         raise FileNotFoundError(f"Model file not found at the calculated path: {model_name}")
-
-    # モデルをロード
-    model = YOLO(model_name)
-
-    # モデルロード成功確認 (クラス名が取得できるかなど)
-    if isinstance(model, YOLO) and hasattr(model, 'names'):
-        logging.info(f"Successfully loaded YOLO model: {model_name}")
+# スクリプト自身の場所を基準にモデルパスを決定
+script_path = os.path.abspath(__file__)
+script_dir = os.path.dirname(script_path)
+relative_model_path = './best.pt' # モデルファイルへの相対パス
+model_name = os.path.normpath(os.path.join(script_dir, relative_model_path)) # パスを正規化
+MODEL_CACHE_DIR = os.path.join(script_dir, 'model_cache') # ONNX 変換結果のキャッシュ
+
+
+def create_backend(backend, weights_path):
+    """バックエンドを作成し、重みのハッシュとロード時間を記録する"""
+    start_time = time.perf_counter()
+    weights_sha256 = file_sha256(weights_path) if MODEL_BACKENDS[backend].requires_weights else None
+    hash_seconds = time.perf_counter() - start_time
+    instance = MODEL_BACKENDS[backend](weights_path)
+    instance.timings = {'hash': hash_seconds, **getattr(instance, 'timings', {})}
+    instance.weights_sha256 = weights_sha256
+    instance.load_seconds = round(time.perf_counter() - start_time, 3)
+    instance.loaded_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+    return instance
+
+
+def warmup_batch_sizes():
+    """ウォームアップするバッチサイズ (1枚と、マイクロバッチの最大枚数)"""
+    return sorted({1, batch_scheduler.max_batch_size})
+
+
+def warm_up(instance, batch_sizes=(1,)):
+    """
+    IMAGE_SIZE の空の画像を各バッチサイズで推論し (初回だけ重い初期化を済ませる)、結果の数を確認する。
+    ホットリロード・名前付きモデルではスモーク推論を兼ねる。
+    """
+    image = np.zeros((IMAGE_SIZE, IMAGE_SIZE, 3), dtype=np.uint8)
+    timings = {}
+    for batch_size in batch_sizes:
+        start_time = time.perf_counter()
+        results = instance.predict([image] * batch_size, IMAGE_SIZE, CONFIDENCE_THRESHOLD)
+        if results is None or len(results) != batch_size:
+            raise RuntimeError(f"Smoke inference returned {0 if results is None else len(results)} results for {batch_size} images")
+        timings[batch_size] = round((time.perf_counter() - start_time) * 1000.0, 2)
+    instance.warmup_batches_ms = timings
+    instance.warmup_ms = round(sum(timings.values()), 2)
+    return instance
+
+
+def load_model(backend=MODEL_BACKEND):
+    """指定したバックエンドでモデルをロードし、グローバルの model / model_load_error を設定する"""
+    global model, model_load_error
+    model = None
+    model_load_error = None
+    try:
+        logging.info(f"Attempting to load model from calculated path: {model_name} (backend: {backend})")
+        logging.info(f"Using confidence threshold for predict: {CONFIDENCE_THRESHOLD}")
+        logging.info(f"Using image size for predict: {IMAGE_SIZE}")
+
+        if MODEL_BACKENDS[backend].requires_weights and not os.path.exists(model_name):
+            raise FileNotFoundError(f"Model file not found at the calculated path: {model_name}")
+
+        # モデルをロード
+        model = create_backend(backend, model_name)
+        logging.info(f"Successfully loaded YOLO model: {model.model_path} (backend: {model.name})")
         logging.info(f"Model class names ({len(model.names)}): {model.names}")
+
+    except FileNotFoundError as fnf_error:
+        model_load_error = str(fnf_error)
+        logging.error(f"Critical Error: {fnf_error}", exc_info=False) # スタックトレースは不要
+    except Exception as e:
+        model = None
+        model_load_error = str(e)
+        logging.error(f"Critical Error: Failed to load YOLO model ({model_name}): {e}", exc_info=True)
+    return model
+
+
+# --- モデルのホットリロード ---
+class ModelReloader:
+    """
+    best.pt の更新 (または /admin/reload) を検知すると、裏で新しいモデルをロード・ウォームアップし、
+    スモーク推論が通ったらグローバルの model を差し替える。
+    実行中のバッチは差し替え前のモデルへの参照を持ったまま完了し、その後で古いモデルが解放される。
+    """
+
+    def __init__(self, weights_path, interval=MODEL_WATCH_INTERVAL):
+        self.weights_path = weights_path
+        self.interval = interval
+        self.backend = MODEL_BACKEND
+        self._reload_lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+        self._last_signature = None
+        self.in_progress = False
+        self.reloads = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_reload_at = None
+
+    def _signature(self):
+        try:
+            stat = os.stat(self.weights_path)
+        except OSError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def start(self):
+        self._last_signature = self._signature()
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._thread = threading.Thread(target=self._watch, name='model-watcher', daemon=True)
+        self._thread.start()
+        logging.info(f"Watching {self.weights_path} for changes every {self.interval} seconds.")
+
+    def stop(self, timeout=None):
+        """監視を止め、実行中のリロードがあれば終わるまで待つ (timeout 秒まで)。止まったら True"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if not self._reload_lock.acquire(timeout=-1 if timeout is None else timeout):
+            return False
+        self._reload_lock.release()
+        return self._thread is None or not self._thread.is_alive()
+
+    def _watch(self):
+        pending = None
+        while not self._stop.wait(self.interval):
+            signature = self._signature()
+            if signature is None or signature == self._last_signature:
+                pending = None
+                continue
+            # learn.py が書き込み中の可能性があるため、2回続けて同じ状態になってからロードする
+            if signature != pending:
+                pending = signature
+                continue
+            pending = None
+            self._last_signature = signature
+            logging.info(f"Detected a change to {self.weights_path}; reloading model in the background.")
+            self.reload()
+
+    def reload(self, force=False):
+        """新しいモデルをロードして差し替える。戻り値は (差し替えたか, メッセージ)"""
+        global model, model_load_error
+        if self._stop.is_set():
+            return False, 'Server is shutting down'
+        if not self._reload_lock.acquire(blocking=False):
+            return False, 'A reload is already in progress'
+        self.in_progress = True
+        try:
+            current = model
+            if not force and current is not None and getattr(current, 'weights_sha256', None) == file_sha256(self.weights_path):
+                logging.info("Weights file is unchanged (same sha256); keeping the current model.")
+                return False, 'Weights are unchanged; model not reloaded'
+            new_model = warm_up(create_backend(self.backend, self.weights_path), warmup_batch_sizes())
+            if current is not None and new_model.names != current.names:
+                logging.warning(f"Reloaded model has different class names: {new_model.names}")
+            # 参照の代入は原子的なので、以降に始まるバッチから新しいモデルが使われる
+            model, model_load_error = new_model, None
+            server_ready.set()
+            self.reloads += 1
+            self.last_error = None
+            self.last_reload_at = time.strftime('%Y-%m-%dT%H:%M:%S')
+            batch_scheduler.start()
+            debug_writer.start()
+            message = (f"Model reloaded: sha256 {new_model.weights_sha256[:16]}, load {new_model.load_seconds} s, "
+                       f"warm-up {new_model.warmup_ms} ms (backend: {new_model.name})")
+            logging.info(message)
+            del current
+            gc.collect() # 古いモデルを解放する (実行中のバッチが終われば参照が無くなる)
+            return True, message
+        except Exception as e:
+            self.failures += 1
+            self.last_error = str(e)
+            logging.error(f"Model reload failed; keeping the current model: {e}", exc_info=True)
+            return False, f'Model reload failed: {e}'
+        finally:
+            self.in_progress = False
+            self._reload_lock.release()
+
+    def stats(self):
+        return {
+            'watching': self._thread is not None and self._thread.is_alive(),
+            'interval_seconds': self.interval,
+            'in_progress': self.in_progress,
+            'reloads': self.reloads,
+            'failures': self.failures,
+            'last_error': self.last_error,
+            'last_reload_at': self.last_reload_at,
+        }
+
+
+model_reloader = ModelReloader(model_name)
+
+
+# --- 名前付きモデルのレジストリ ---
+MODEL_NAME_PATTERN = re.compile(r'^[A-Za-z0-9_.-]{1,64}$')
+DEFAULT_MODEL_NAME = 'default' # ?model= を省略した場合と同じ best.pt のモデル
+
+
+def model_memory_bytes(instance):
+    """モデルの常駐メモリの概算 (PyTorch はパラメータとバッファ、ONNX はファイルサイズ)"""
+    module = getattr(getattr(instance, 'model', None), 'model', None)
+    if hasattr(module, 'parameters'):
+        tensors = list(module.parameters()) + list(module.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+    try:
+        return os.path.getsize(instance.model_path)
+    except OSError:
+        return 0
+
+
+class ModelRegistry:
+    """
+    MODEL_DIR の <name>.pt を ?model=<name> で使えるようにする。
+    初めて使われたときにロードし、合計メモリが上限を超えたら最も長く使われていないモデルから解放する。
+    """
+
+    def __init__(self, directory, budget_mb=MODEL_MEMORY_BUDGET_MB):
+        self.directory = directory
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        self.backend = MODEL_BACKEND
+        self._models = collections.OrderedDict() # name -> エントリ (最近使われた順)
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock() # ロードは1つずつ (同じモデルの二重ロードを防ぐ)
+        self.evictions = 0
+
+    def weights_path(self, name):
+        if name == DEFAULT_MODEL_NAME or not MODEL_NAME_PATTERN.match(name):
+            raise KeyError(name)
+        path = os.path.join(self.directory, f"{name}.pt")
+        if not os.path.isfile(path):
+            raise KeyError(name)
+        return path
+
+    def available(self):
+        try:
+            names = sorted(os.path.splitext(f)[0] for f in os.listdir(self.directory) if f.endswith('.pt'))
+        except OSError:
+            return []
+        return [name for name in names if MODEL_NAME_PATTERN.match(name) and name != DEFAULT_MODEL_NAME]
+
+    def _touch(self, name):
+        entry = self._models.get(name)
+        if entry is not None:
+            self._models.move_to_end(name)
+            entry['hits'] += 1
+            entry['last_used'] = time.time()
+        return entry
+
+    def get(self, name):
+        """名前付きモデルを返す (必要ならロードする)。無い名前は KeyError"""
+        with self._lock:
+            entry = self._touch(name)
+        if entry is not None:
+            return entry['model']
+        path = self.weights_path(name)
+        with self._load_lock:
+            with self._lock:
+                entry = self._touch(name) # 待っている間に他のリクエストがロードした
+            if entry is not None:
+                return entry['model']
+            logging.info(f"Loading named model '{name}' from {path} (backend: {self.backend})...")
+            instance = warm_up(create_backend(self.backend, path), warmup_batch_sizes())
+            memory = model_memory_bytes(instance)
+            with self._lock:
+                self._models[name] = {'model': instance, 'memory_bytes': memory, 'hits': 1, 'last_used': time.time()}
+                evicted = self._evict(keep=name)
+            logging.info(f"Loaded named model '{name}' in {instance.load_seconds} s ({memory / 1048576:.1f} MB, warm-up {instance.warmup_ms} ms).")
+        if evicted:
+            logging.info(f"Evicted named models to stay within {self.budget_bytes / 1048576:.0f} MB: {', '.join(evicted)}")
+            gc.collect() # キューに残っている推論が終われば参照が無くなり解放される
+        return instance
+
+    def _evict(self, keep):
+        evicted = []
+        total = sum(entry['memory_bytes'] for entry in self._models.values())
+        for name in list(self._models):
+            if total <= self.budget_bytes:
+                break
+            if name == keep:
+                continue
+            total -= self._models.pop(name)['memory_bytes']
+            evicted.append(name)
+            self.evictions += 1
+        return evicted
+
+    def stats(self):
+        with self._lock:
+            loaded = [
+                {
+                    'name': name,
+                    'backend': entry['model'].name,
+                    'sha256': entry['model'].weights_sha256,
+                    'memory_mb': round(entry['memory_bytes'] / 1048576, 2),
+                    'hits': entry['hits'],
+                    'load_seconds': entry['model'].load_seconds,
+                    'idle_seconds': round(time.time() - entry['last_used'], 1),
+                }
+                for name, entry in reversed(self._models.items()) # 最近使われた順
+            ]
+        return {
+            'directory': self.directory,
+            'budget_mb': round(self.budget_bytes / 1048576, 2),
+            'resident_mb': round(sum(entry['memory_mb'] for entry in loaded), 2),
+            'evictions': self.evictions,
+            'available': self.available(),
+            'loaded': loaded,
+        }
+
+
+model_registry = ModelRegistry(os.path.normpath(os.path.join(script_dir, MODEL_DIR)))
+
+
+def resolve_model(req):
+    """
+    ?model=<name> (またはフォームの model) で使うモデルを選ぶ。
+    戻り値は (モデル, スケジューラに渡す backend)。省略時はデフォルトの model で backend は None。
+    """
+    name = req.args.get('model') or req.form.get('model')
+    if not name or name == DEFAULT_MODEL_NAME:
+        return model, None
+    instance = model_registry.get(name)
+    return instance, instance
+
+
+def model_unavailable_response(error):
+    """resolve_model の例外をレスポンスにする (無い名前は 404、ロード失敗は 503)"""
+    if isinstance(error, KeyError):
+        return jsonify({'error': f"Unknown model '{error.args[0]}'", 'available': [DEFAULT_MODEL_NAME] + model_registry.available()}), 404
+    logging.error(f"Failed to load named model: {error}", exc_info=True)
+    return jsonify({'error': f'Failed to load model: {error}'}), 503
+
+
+# --- 統計ユーティリティ ---
+def percentile(samples, pct):
+    """サンプル列の pct パーセンタイル値を返す (サンプルが無い場合は None)"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, int(round(pct / 100.0 * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+# --- メトリクス (/metrics, Prometheus テキスト形式) ---
+# プリフォーク時はワーカーごとに集計される (どのワーカーが応答したかは goto_worker_info で分かる)
+metrics_registry = metrics.Registry()
+stage_seconds = metrics_registry.histogram(
+    'goto_stage_seconds', 'Time spent in each request processing stage.', ('stage',))
+request_duration_seconds = metrics_registry.histogram(
+    'goto_request_duration_seconds', 'Total request handling time.', ('endpoint',))
+requests_total = metrics_registry.counter(
+    'goto_requests_total', 'HTTP requests handled, by endpoint and status code.', ('endpoint', 'status'))
+request_errors_total = metrics_registry.counter(
+    'goto_request_errors_total', 'Error responses (status >= 400), by status code.', ('status',))
+detections_total = metrics_registry.counter(
+    'goto_detections_total', 'Detections returned to clients, by class.', ('class_name',))
+requests_in_flight = metrics_registry.gauge(
+    'goto_requests_in_flight', 'Requests currently being handled.')
+inference_queue_depth = metrics_registry.gauge(
+    'goto_inference_queue_depth', 'Images waiting in the batch scheduler queue.')
+batch_size_images = metrics_registry.histogram(
+    'goto_batch_size_images', 'Number of images per model.predict call.', buckets=(1, 2, 4, 8, 16, 32, 64))
+batch_queue_wait_seconds = metrics_registry.histogram(
+    'goto_batch_queue_wait_seconds', 'Time an image waited in the batch queue before inference.')
+batch_inference_seconds = metrics_registry.histogram(
+    'goto_batch_inference_seconds', 'Time spent in one batched model.predict call.')
+worker_info_gauge = metrics_registry.gauge(
+    'goto_worker_info', 'Process serving this scrape (always 1).', ('index', 'pid'))
+
+
+class StageTimer:
+    """リクエスト内の処理段階ごとの時間を計測し、/metrics と Server-Timing ヘッダーに反映する"""
+
+    def __init__(self):
+        self.timings = {}
+        self._last = time.perf_counter()
+
+    def mark(self, stage):
+        """前回の mark からの経過時間を stage の時間として記録する"""
+        now = time.perf_counter()
+        elapsed = now - self._last
+        self._last = now
+        self.timings[stage] = self.timings.get(stage, 0.0) + elapsed
+        stage_seconds.observe(elapsed, stage)
+        return elapsed
+
+    def server_timing(self):
+        return ', '.join(f"{stage};dur={seconds * 1000.0:.2f}" for stage, seconds in self.timings.items())
+
+
+def json_response(payload, status=200, timer=None):
+    """JSON 変換時間も計測してレスポンスを作る (jsonify の代わり)"""
+    body = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+    headers = {}
+    if timer is not None:
+        timer.mark('serialize')
+        headers['Server-Timing'] = timer.server_timing()
+    return Response(body, status=status, mimetype='application/json', headers=headers)
+
+
+def encode_detections(message, output_data, response_format, media_type, timer=None, imgsz=None):
+    """
+    /predict の結果を Accept ヘッダーで選ばれた形式にし、(本体, Content-Type, ヘッダー) を返す。
+    固定レイアウト (application/x-goto-detections) は常に列形式で、メッセージは含まない。
+    imgsz (推論に使った解像度) は X-Inference-Size ヘッダーと、JSON / MessagePack の 'imgsz' で返す。
+    """
+    headers = {'Vary': 'Accept'}
+    if media_type == detection_codec.PACKED_MEDIA_TYPE:
+        body = detection_codec.encode_packed(output_data.to_columns())
+        headers['X-Detections'] = str(len(output_data))
+    else:
+        payload = {'message': message, 'predictions': format_predictions(output_data, response_format)}
+        if output_data.tiling is not None:
+            payload['tiling'] = output_data.tiling
+        if imgsz is not None:
+            payload['imgsz'] = imgsz
+        if media_type == detection_codec.MSGPACK_MEDIA_TYPE:
+            body = detection_codec.encode_msgpack(payload)
+            headers['X-Detections'] = str(len(output_data))
+        else:
+            body = json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            media_type = detection_codec.JSON_MEDIA_TYPE
+    if imgsz is not None:
+        headers['X-Inference-Size'] = str(imgsz)
+    if timer is not None:
+        timer.mark('serialize')
+        headers['Server-Timing'] = timer.server_timing()
+    return body, media_type, headers
+
+
+def detection_response(message, output_data, response_format, media_type, timer=None, imgsz=None):
+    """encode_detections の結果を Flask のレスポンスにする"""
+    body, content_type, headers = encode_detections(message, output_data, response_format, media_type, timer, imgsz)
+    return Response(body, status=200, content_type=content_type, headers=headers)
+
+
+def best_media_type(accept_header):
+    """Accept ヘッダーから返す形式を選ぶ (指定が無い・対応していない場合は JSON)"""
+    accept = parse_accept_header(accept_header, MIMEAccept)
+    return accept.best_match(detection_codec.available_media_types(), default=detection_codec.JSON_MEDIA_TYPE)
+
+
+REQUEST_TIMEOUT_HEADER = 'X-Request-Timeout-Ms'
+REQUEST_ID_HEADER = 'X-Request-ID'
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
+
+
+def request_id_from(headers):
+    """クライアントが付けた X-Request-ID (無い・不正な場合は新しい ID) を返す。デバッグ画像の検索に使う"""
+    request_id = headers.get(REQUEST_ID_HEADER, '')
+    return request_id if REQUEST_ID_PATTERN.match(request_id) else uuid.uuid4().hex
+
+
+SOURCE_HEADER = 'X-Source'
+
+
+def request_source(headers, args, remote_addr):
+    """検出結果の履歴の送信元 (監視しているサーバーなど)。?source=、X-Source ヘッダー、接続元アドレスの順に使う"""
+    return (args.get('source') or headers.get(SOURCE_HEADER) or remote_addr or 'unknown')[:128]
+
+
+def parse_timestamp(value):
+    """UNIX 時刻 (秒) または ISO 8601 の文字列を UNIX 時刻にする。不正なら ValueError"""
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+
+def request_deadline(headers=None, started=None):
+    """
+    X-Request-Timeout-Ms ヘッダー (リクエスト受信からクライアントが待つ時間) を
+    time.perf_counter() 基準の期限にする。ヘッダーが無ければ None。
+    headers / started を省略すると Flask の現在のリクエストのものを使う。
+    """
+    value = (request.headers if headers is None else headers).get(REQUEST_TIMEOUT_HEADER)
+    if not value:
+        return None
+    try:
+        timeout_ms = float(value)
+    except ValueError:
+        timeout_ms = float('nan')
+    if not math.isfinite(timeout_ms) or timeout_ms <= 0:
+        raise ValueError(f"{REQUEST_TIMEOUT_HEADER} must be a positive number of milliseconds")
+    if started is None:
+        started = g.get('request_started', time.perf_counter())
+    return started + timeout_ms / 1000.0
+
+
+def admission_error(error):
+    """OverloadedError は 429 + Retry-After、DeadlineExceededError は 504 にする。(ステータス, 本体, ヘッダー) を返す"""
+    if isinstance(error, OverloadedError):
+        logging.warning(f"Request shed by admission control: {error}")
+        return 429, {'error': str(error), 'queue_depth': error.queue_depth,
+                     'projected_wait_ms': round(error.projected_wait_ms, 1)}, {'Retry-After': str(error.retry_after)}
+    logging.warning(f"Request dropped: {error}")
+    return 504, {'error': str(error)}, {}
+
+
+def admission_error_response(error):
+    status, payload, headers = admission_error(error)
+    response = jsonify(payload)
+    response.status_code = status
+    response.headers.update(headers)
+    return response
+
+
+def record_detections(output_data, source=None, request_id=None):
+    """検出数のメトリクスを更新し、履歴に記録する (source は送信元, request_source を参照)"""
+    for class_name, count in collections.Counter(output_data.class_name).items():
+        detections_total.inc(class_name, amount=count)
+    if detection_history is not None:
+        detection_history.record(source or 'unknown', request_id, output_data.class_name, output_data.confidence, output_data.xyxy)
+
+
+# --- マイクロバッチスケジューラ ---
+class OverloadedError(RuntimeError):
+    """推論キューが満杯、または待ち時間が長すぎるため受け付けない (429)"""
+
+    def __init__(self, message, retry_after, queue_depth, projected_wait_ms):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.queue_depth = queue_depth
+        self.projected_wait_ms = projected_wait_ms
+
+
+class DeadlineExceededError(TimeoutError):
+    """クライアントが指定した期限までに推論を始められなかった (504)"""
+
+
+admission_rejected_total = metrics_registry.counter(
+    'goto_admission_rejected_total', 'Images refused or dropped by admission control, by reason.', ('reason',))
+projected_queue_wait_seconds = metrics_registry.gauge(
+    'goto_projected_queue_wait_seconds', 'Estimated wait for an image submitted now.')
+
+
+class BatchScheduler:
+    """
+    リクエストごとの画像をキューに積み、最大 max_batch_size 枚または
+    max_wait_ms 経過のどちらか早い方でまとめて1回の推論に渡す。
+    推論パラメータ (imgsz, conf)、推論するモデル、入力の種類 (レターボックス済みか) が異なる画像は同じバッチに入れない。
+    キューの長さと予測待ち時間で受け付けを制限し (OverloadedError)、
+    期限 (deadline) を過ぎた画像は推論せずに DeadlineExceededError で終わらせる。
+    """
+
+    def __init__(self, predict_fn, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS,
+                 max_queue_depth=INFERENCE_QUEUE_MAX, max_queue_wait_ms=ADMISSION_MAX_WAIT_MS):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait_ms = max(0.0, float(max_wait_ms))
+        self.max_queue_depth = max(1, int(max_queue_depth))
+        self.max_queue_wait_ms = max(0.0, float(max_queue_wait_ms))
+        self._batch_time_ewma_ms = None # 1バッチの推論時間の指数移動平均 (待ち時間の予測に使う)
+        self._queue = queue.Queue()
+        self._pending = collections.deque() # 別パラメータのため次回に回した要素
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batch_size_counts = collections.Counter()
+        self._queue_wait_ms = collections.deque(maxlen=STATS_WINDOW)
+        self._batch_time_ms = collections.deque(maxlen=STATS_WINDOW)
+        self._total_batches = 0
+        self._total_images = 0
+        self._rejected = collections.Counter()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='batch-scheduler', daemon=True)
+                self._thread.start()
+                logging.info(f"Batch scheduler started (max_batch_size={self.max_batch_size}, max_wait_ms={self.max_wait_ms}).")
+
+    def submit(self, image, imgsz, conf, deadline=None, admit=True, backend=None, letterboxed=False):
+        """
+        画像1枚をキューに入れ、推論結果 (ultralytics Results) を返す Future を返す。
+        deadline は time.perf_counter() 基準の期限。admit=False は check_admission 済みの場合。
+        backend は名前付きモデル (None はデフォルトの model)。
+        letterboxed=True はクライアントがモデルの入力サイズにレターボックス済みの画像 (縮小・パディングを省く)。
+        レターボックス済みの画像は大きさ (縦横) が同じものだけをまとめる。
+        """
+        if admit:
+            self.check_admission(1, deadline)
+        if self._thread is None:
+            self.start()
+        future = Future()
+        self._queue.put((image, (imgsz, conf, backend, letterboxed and image.shape[:2]), future, time.perf_counter(), deadline))
+        return future
+
+    def queue_depth(self):
+        return self._queue.qsize() + len(self._pending)
+
+    def stop(self, timeout=None):
+        """キューに入っている分を推論し終えたらスケジューラのスレッドを止める。止まったら True"""
+        thread = self._thread
+        if thread is None or not thread.is_alive():
+            return True
+        self._queue.put(None) # 終了の目印 (先に入っている要素の後に処理される)
+        thread.join(timeout)
+        return not thread.is_alive()
+
+    def projected_wait_ms(self, count=1):
+        """今 count 枚を投入した場合に、最後の1枚が先に待っているバッチの推論を待つ予測時間 (ミリ秒)"""
+        if self._batch_time_ewma_ms is None:
+            return 0.0 # まだ推論していないので予測できない
+        batches_ahead = math.ceil((self.queue_depth() + count) / self.max_batch_size) - 1
+        return batches_ahead * self._batch_time_ewma_ms
+
+    def _reject(self, reason):
+        admission_rejected_total.inc(reason)
+        with self._stats_lock:
+            self._rejected[reason] += 1
+
+    def check_admission(self, count=1, deadline=None):
+        """count 枚を受け付けられるか確認し、受け付けられなければ例外を投げる"""
+        depth = self.queue_depth()
+        projected = self.projected_wait_ms(count)
+        if deadline is not None and time.perf_counter() >= deadline:
+            self._reject('deadline')
+            raise DeadlineExceededError("Request deadline already passed before inference")
+        if depth + count > self.max_queue_depth:
+            self._reject('queue_full')
+            raise OverloadedError(f"Inference queue is full ({depth}/{self.max_queue_depth} images waiting)",
+                                  max(1, math.ceil(projected / 1000.0)), depth, projected)
+        if self.max_queue_wait_ms > 0 and projected > self.max_queue_wait_ms:
+            self._reject('projected_wait')
+            raise OverloadedError(f"Projected queue wait {projected:.0f} ms exceeds {self.max_queue_wait_ms:.0f} ms",
+                                  max(1, math.ceil((projected - self.max_queue_wait_ms) / 1000.0)), depth, projected)
+
+    def _next_item(self, timeout):
+        if self._pending:
+            return self._pending.popleft()
+        return self._queue.get(timeout=timeout) if timeout is not None else self._queue.get()
+
+    def _collect_batch(self):
+        first = self._next_item(None)
+        if first is None:
+            return None, None # stop()
+        batch = [first]
+        key = first[1]
+        deadline = time.perf_counter() + self.max_wait_ms / 1000.0
+        deferred = []
+        # 保留分から同じパラメータの要素を先に拾う
+        for item in list(self._pending):
+            if len(batch) >= self.max_batch_size:
+                break
+            if item is not None and item[1] == key:
+                self._pending.remove(item)
+                batch.append(item)
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is not None and item[1] == key:
+                batch.append(item)
+            else:
+                deferred.append(item) # 終了の目印もこのバッチの後に回す
+        self._pending.extend(deferred)
+        return batch, key
+
+    def _run(self):
+        while True:
+            batch, key = self._collect_batch()
+            if batch is None:
+                logging.info("Batch scheduler stopped.")
+                return
+            imgsz, conf, backend, letterboxed = key
+            # キャンセル済み (クライアント切断など) と期限切れの要素は推論しない
+            now = time.perf_counter()
+            live = []
+            for item in batch:
+                if item[4] is not None and now >= item[4]:
+                    if item[2].set_running_or_notify_cancel():
+                        item[2].set_exception(DeadlineExceededError(
+                            f"Request deadline passed after {(now - item[3]) * 1000.0:.1f} ms in the inference queue"))
+                    self._reject('deadline')
+                elif item[2].set_running_or_notify_cancel():
+                    live.append(item)
+            batch = live
+            if not batch:
+                continue
+            started = time.perf_counter()
+            waits = [(started - item[3]) * 1000.0 for item in batch]
+            try:
+                results = self.predict_fn([item[0] for item in batch], imgsz, conf, backend, letterboxed)
+                if results is None or len(results) != len(batch):
+                    raise RuntimeError(f"Batch prediction returned {0 if results is None else len(results)} results for {len(batch)} images.")
+                for item, result in zip(batch, results):
+                    item[2].set_result(result)
+            except Exception as e:
+                logging.error(f"Batch prediction of {len(batch)} images failed: {e}", exc_info=True)
+                for item in batch:
+                    if not item[2].done():
+                        item[2].set_exception(e)
+            elapsed_ms = (time.perf_counter() - started) * 1000.0
+            batch_size_images.observe(len(batch))
+            batch_inference_seconds.observe(elapsed_ms / 1000.0)
+            for wait_ms in waits:
+                batch_queue_wait_seconds.observe(wait_ms / 1000.0)
+            self._batch_time_ewma_ms = elapsed_ms if self._batch_time_ewma_ms is None else 0.8 * self._batch_time_ewma_ms + 0.2 * elapsed_ms
+            with self._stats_lock:
+                self._batch_size_counts[len(batch)] += 1
+                self._queue_wait_ms.extend(waits)
+                self._batch_time_ms.append(elapsed_ms)
+                self._total_batches += 1
+                self._total_images += len(batch)
+
+    def stats(self):
+        """バッチサイズ分布とキュー待ち時間 (ms) の統計を返す"""
+        with self._stats_lock:
+            waits = list(self._queue_wait_ms)
+            batch_times = list(self._batch_time_ms)
+            sizes = dict(sorted(self._batch_size_counts.items()))
+            total_batches = self._total_batches
+            total_images = self._total_images
+            rejected = dict(self._rejected)
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait_ms,
+            'queue_depth': self.queue_depth(),
+            'max_queue_depth': self.max_queue_depth,
+            'max_queue_wait_ms': self.max_queue_wait_ms,
+            'projected_wait_ms': round(self.projected_wait_ms(), 2),
+            'rejected': rejected,
+            'total_batches': total_batches,
+            'total_images': total_images,
+            'avg_batch_size': round(total_images / total_batches, 3) if total_batches else None,
+            'batch_size_counts': sizes,
+            'queue_wait_ms': {
+                'p50': percentile(waits, 50),
+                'p99': percentile(waits, 99),
+                'max': max(waits) if waits else None,
+            },
+            'batch_time_ms': {
+                'p50': percentile(batch_times, 50),
+                'p99': percentile(batch_times, 99),
+            },
+        }
+
+
+def predict_batch(images, imgsz, conf, backend=None, letterboxed=False):
+    """複数画像を1回の model.predict で推論する (BatchScheduler から呼ばれる)"""
+    # 推論中にホットリロードされても、このバッチは同じモデルで完了させる
+    active_model = backend if backend is not None else model
+    if letterboxed:
+        return active_model.predict_letterboxed(images, imgsz, conf)
+    return active_model.predict(images, imgsz, conf)
+
+
+batch_scheduler = BatchScheduler(predict_batch)
+projected_queue_wait_seconds.set_function(lambda: batch_scheduler.projected_wait_ms() / 1000.0)
+inference_queue_depth.set_function(batch_scheduler.queue_depth)
+
+
+# --- 負荷に応じた推論解像度の切り替え ---
+resolution_level_seconds = metrics_registry.counter(
+    'goto_resolution_level_seconds_total', 'Time spent at each inference resolution (imgsz).', ('imgsz',))
+resolution_changes_total = metrics_registry.counter(
+    'goto_resolution_changes_total', 'Inference resolution changes, by direction (down / up).', ('direction',))
+inference_imgsz = metrics_registry.gauge(
+    'goto_inference_imgsz', 'Inference resolution (imgsz) currently used for new requests.')
+
+
+class ResolutionLadder:
+    """
+    推論解像度 (imgsz) を負荷に応じて1段ずつ切り替える (enabled=False の間は常に IMAGE_SIZE)。
+    1枚あたりのレイテンシ (キュー待ち + 推論) の移動平均が目標を超えるか、推論待ちの画像が溜まったら1段下げる。
+    上げるのは、推論時間が画素数 (imgsz の2乗) に比例するとして1段上の予測レイテンシが目標の up_margin 倍以下のときだけ。
+    変えた直後は一定時間・一定件数の計測を待ち、上げる方を長く待たせることで行き来を防ぐ。
+    上げてすぐに下げることになった場合は、次に上げるまでの待ち時間を倍にする (最大 UP_BACKOFF_MAX 倍)。
+    """
+    UP_BACKOFF_MAX = 8
+
+    def __init__(self, levels=RESOLUTION_LEVELS, target_ms=RESOLUTION_TARGET_MS, enabled=RESOLUTION_ADAPTIVE):
+        self.enabled = enabled
+        self.target_ms = target_ms
+        self.up_margin = RESOLUTION_UP_MARGIN
+        self.queue_high = RESOLUTION_QUEUE_HIGH
+        self.down_dwell = RESOLUTION_DOWN_DWELL
+        self.up_dwell = RESOLUTION_UP_DWELL
+        self.min_samples = RESOLUTION_MIN_SAMPLES
+        self._lock = threading.Lock()
+        self.set_levels(levels)
+
+    def set_levels(self, levels):
+        """解像度の段を設定し (大きい順)、IMAGE_SIZE に最も近い段から始める"""
+        levels = sorted({int(level) for level in levels if int(level) > 0}, reverse=True)
+        if not levels:
+            raise ValueError("At least one positive resolution level is required")
+        now = time.perf_counter()
+        with self._lock:
+            if getattr(self, 'levels', None):
+                self._accumulate(now)
+            self.levels = levels
+            self._index = min(range(len(levels)), key=lambda i: abs(levels[i] - IMAGE_SIZE))
+            self._reset(now)
+            self._accounted_at = now
+            self._changes = collections.Counter()
+            self._last_change = None
+            self._last_direction = None
+            self._up_backoff = 1
+
+    def _reset(self, now):
+        self._changed_at = now
+        self._latency_ewma_ms = None
+        self._samples = 0
+
+    def current(self):
+        """新しいリクエストに使う推論解像度"""
+        return self.levels[self._index] if self.enabled else IMAGE_SIZE
+
+    def _accumulate(self, now):
+        resolution_level_seconds.inc(self.current(), amount=now - self._accounted_at)
+        self._accounted_at = now
+
+    def accumulate(self):
+        """現在の段にいた時間をメトリクスに反映する (/metrics の出力前に呼ぶ)"""
+        with self._lock:
+            self._accumulate(time.perf_counter())
+
+    def observe(self, imgsz, latency_ms):
+        """imgsz で処理したリクエストのキュー待ち + 推論時間を記録し、必要なら段を切り替える"""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        with self._lock:
+            if imgsz != self.levels[self._index]:
+                return # 切り替え前の解像度で処理されたものは判断に使わない
+            self._latency_ewma_ms = latency_ms if self._latency_ewma_ms is None else 0.8 * self._latency_ewma_ms + 0.2 * latency_ms
+            self._samples += 1
+            if self._samples < self.min_samples:
+                return
+            dwell = now - self._changed_at
+            depth = batch_scheduler.queue_depth()
+            overloaded = self._latency_ewma_ms > self.target_ms or depth > self.queue_high
+            if overloaded:
+                if self._index < len(self.levels) - 1 and dwell >= self.down_dwell:
+                    if self._last_direction == 'up' and dwell < self.up_dwell * self._up_backoff:
+                        self._up_backoff = min(self.UP_BACKOFF_MAX, self._up_backoff * 2)
+                    self._switch(now, 1, f"latency {self._latency_ewma_ms:.0f} ms (target {self.target_ms:.0f} ms), {depth} images queued")
+                return
+            if self._last_direction == 'up' and dwell >= self.up_dwell * self._up_backoff:
+                self._up_backoff = 1 # 上げた段で落ち着いたので待ち時間を戻す
+            if self._index > 0 and dwell >= self.up_dwell * self._up_backoff and depth <= batch_scheduler.max_batch_size:
+                projected = self._latency_ewma_ms * (self.levels[self._index - 1] / self.levels[self._index]) ** 2
+                if projected <= self.target_ms * self.up_margin:
+                    self._switch(now, -1, f"projected latency {projected:.0f} ms at the next level is within {self.up_margin:.0%} of target")
+
+    def _switch(self, now, step, reason):
+        self._accumulate(now)
+        previous = self.levels[self._index]
+        self._index += step
+        direction = 'down' if step > 0 else 'up'
+        self._last_direction = direction
+        resolution_changes_total.inc(direction)
+        self._changes[direction] += 1
+        self._last_change = {'from': previous, 'to': self.levels[self._index], 'reason': reason, 'at': time.strftime('%Y-%m-%dT%H:%M:%S')}
+        self._reset(now)
+        logging.info(f"Inference resolution {direction}: {previous} -> {self.levels[self._index]} ({reason}).")
+
+    def stats(self):
+        with self._lock:
+            self._accumulate(time.perf_counter())
+            latency = self._latency_ewma_ms
+            return {
+                'enabled': self.enabled,
+                'imgsz': self.current(),
+                'levels': self.levels,
+                'target_ms': self.target_ms,
+                'latency_ewma_ms': round(latency, 2) if latency is not None else None,
+                'seconds_at_current': round(time.perf_counter() - self._changed_at, 1),
+                'up_dwell_seconds': self.up_dwell * self._up_backoff,
+                'changes': dict(self._changes),
+                'last_change': self._last_change,
+                'seconds_at_level': {level: round(resolution_level_seconds.value(level), 1) for level in self.levels},
+            }
+
+
+resolution_ladder = ResolutionLadder()
+inference_imgsz.set_function(resolution_ladder.current)
+
+
+# --- 処理時間の統計 ---
+class LatencyStats:
+    """直近サンプルから処理時間 (ms) のパーセンタイルを集計する"""
+
+    def __init__(self, window=STATS_WINDOW):
+        self._lock = threading.Lock()
+        self._samples = collections.deque(maxlen=window)
+        self._count = 0
+        self._labels = collections.Counter()
+
+    def observe(self, ms, label=None):
+        with self._lock:
+            self._samples.append(ms)
+            self._count += 1
+            if label is not None:
+                self._labels[label] += 1
+
+    def summary(self):
+        with self._lock:
+            samples = list(self._samples)
+            count = self._count
+            labels = dict(self._labels)
+        return {
+            'count': count,
+            'labels': labels,
+            'p50': percentile(samples, 50),
+            'p99': percentile(samples, 99),
+            'max': max(samples) if samples else None,
+        }
+
+
+# --- 画像デコード ---
+JPEG_REDUCE_FACTORS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+decode_stats = LatencyStats() # ラベルはデコード経路 (opencv / jpeg_reduced_N / pil)
+
+
+def jpeg_dimensions(data):
+    """JPEG の SOF マーカーから (幅, 高さ) を読む。JPEG でない・読めない場合は None"""
+    if len(data) < 4 or data[0] != 0xFF or data[1] != 0xD8:
+        return None
+    pos = 2
+    length = len(data)
+    while pos + 4 <= length:
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF: # パディング
+            pos += 1
+            continue
+        if marker in (0xD8, 0x01) or 0xD0 <= marker <= 0xD7: # 長さを持たないマーカー
+            pos += 2
+            continue
+        segment_length = (data[pos + 2] << 8) | data[pos + 3]
+        # SOF0-SOF15 (DHT=C4, JPG=C8, DAC=CC は除く)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            if pos + 9 > length:
+                return None
+            height = (data[pos + 5] << 8) | data[pos + 6]
+            width = (data[pos + 7] << 8) | data[pos + 8]
+            return (width, height) if width and height else None
+        pos += 2 + segment_length
+    return None
+
+
+def jpeg_reduce_flag(dimensions, target_size):
+    """長辺を target_size 未満にしない範囲で最大の DCT 縮小デコードフラグを選ぶ (target_size=None は縮小しない)"""
+    if not JPEG_REDUCED_DECODE or dimensions is None or target_size is None:
+        return 1, cv2.IMREAD_COLOR
+    long_side = max(dimensions)
+    for factor, flag in JPEG_REDUCE_FACTORS:
+        if long_side / factor >= target_size:
+            return factor, flag
+    return 1, cv2.IMREAD_COLOR
+
+
+def decode_image_bytes(img_bytes, target_size=IMAGE_SIZE):
+    """
+    アップロードされた画像バイト列を OpenCV(BGR) の NumPy 配列に直接デコードする。
+    推論サイズより十分大きい JPEG は DCT スケーリングで縮小しながらデコードする。
+    戻り値は (画像, (x方向の倍率, y方向の倍率), デコード時間ms)。倍率は元画像座標に戻すために使う。
+    """
+    start_time = time.perf_counter()
+    buf = np.frombuffer(img_bytes, dtype=np.uint8)
+    dimensions = jpeg_dimensions(img_bytes)
+    factor, flag = jpeg_reduce_flag(dimensions, target_size)
+    # PIL と同じく EXIF の回転情報は無視する (座標系を元画像のまま保つ)
+    img_cv2 = cv2.imdecode(buf, flag | cv2.IMREAD_IGNORE_ORIENTATION) if buf.size else None
+    scale = (1.0, 1.0)
+    if img_cv2 is not None:
+        path = f'jpeg_reduced_{factor}' if factor > 1 else 'opencv'
+        if factor > 1:
+            scale = (dimensions[0] / img_cv2.shape[1], dimensions[1] / img_cv2.shape[0])
     else:
-        # 読み込めても期待するオブジェクトでない場合
-        raise RuntimeError("Failed to initialize YOLO model object properly (e.g., missing 'names' attribute).")
+        # OpenCV で読めない形式は Pillow にフォールバック
+        path = 'pil'
+        img = Image.open(io.BytesIO(img_bytes)).convert('RGB')
+        img_cv2 = cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2BGR)
+    decode_ms = (time.perf_counter() - start_time) * 1000.0
+    decode_stats.observe(decode_ms, label=path)
+    return img_cv2, scale, decode_ms
+
+
+# --- 推論結果の処理 ---
+RESPONSE_FORMATS = ('objects', 'columnar')
+
+
+def to_numpy(values):
+    """torch.Tensor / NumPy 配列のどちらでも NumPy 配列にする"""
+    return values.cpu().numpy() if hasattr(values, 'cpu') else np.asarray(values)
+
+
+class Detections:
+    """
+    1フレーム分の検出結果を列ごとのリストで持つ。
+    テンソル全体を一度に変換して作るため、検出数が多くても Python のループが少ない。
+    tiling は分割推論の場合のタイル情報 (通常の推論では None)。
+    """
+    __slots__ = ('class_id', 'class_name', 'confidence', 'xyxy', 'tiling')
+
+    def __init__(self, class_id=(), class_name=(), confidence=(), xyxy=(), tiling=None):
+        self.class_id = list(class_id)
+        self.class_name = list(class_name)
+        self.confidence = list(confidence)
+        self.xyxy = list(xyxy)
+        self.tiling = tiling
+
+    def __len__(self):
+        return len(self.class_id)
+
+    def to_objects(self):
+        """従来のレスポンス形式 (検出ごとのオブジェクトのリスト)"""
+        return [
+            {
+                'class_id': class_id,
+                'class_name': class_name,
+                'confidence': confidence,
+                'box': {'x1': box[0], 'y1': box[1], 'x2': box[2], 'y2': box[3]},
+            }
+            for class_id, class_name, confidence, box in zip(self.class_id, self.class_name, self.confidence, self.xyxy)
+        ]
+
+    def to_columns(self):
+        """列形式 (format=columnar): 同じ長さの配列を並べ、クラス名は ID との対応表で返す"""
+        return {
+            'class_id': self.class_id,
+            'conf': self.confidence,
+            'xyxy': self.xyxy,
+            'names': {str(class_id): name for class_id, name in zip(self.class_id, self.class_name)},
+        }
+
+
+def result_arrays(result):
+    """ultralytics の Results から (xyxy[N,4], conf[N], cls[N]) の NumPy 配列を取り出す"""
+    # 検出結果 (Boxesオブジェクト) が存在するか確認
+    boxes = getattr(result, 'boxes', None)
+    if boxes is None or len(boxes) == 0:
+        return np.zeros((0, 4)), np.zeros(0), np.zeros(0, dtype=np.int64)
+    # result.boxes にはNMS適用後の検出結果が含まれる。テンソルごとにまとめて NumPy に変換する
+    return (to_numpy(boxes.xyxy).astype(np.float64, copy=False),
+            to_numpy(boxes.conf).astype(np.float64, copy=False),
+            to_numpy(boxes.cls).astype(np.int64))
+
+
+def detections_from_arrays(xyxy, conf, cls, class_names_dict, scale=(1.0, 1.0), tiling=None):
+    if scale != (1.0, 1.0):
+        xyxy = xyxy * np.array([scale[0], scale[1], scale[0], scale[1]])
+    class_ids = cls.tolist()
+    class_names = [class_names_dict.get(class_id, f"UnknownID:{class_id}") for class_id in class_ids]
+    return Detections(class_ids, class_names, conf.tolist(), xyxy.tolist(), tiling)
+
+
+def unletterbox(xyxy, size, original_size):
+    """中央寄せでレターボックスした size (幅, 高さ) の画像上の座標を、元の画像 (幅, 高さ) の座標に戻す (ultralytics と同じ配置)"""
+    box_width, box_height = size
+    width, height = original_size
+    gain = min(box_width / width, box_height / height)
+    pad_x = (box_width - round(width * gain)) / 2
+    pad_y = (box_height - round(height * gain)) / 2
+    xyxy = (xyxy - np.array([pad_x, pad_y, pad_x, pad_y])) / gain
+    return np.clip(xyxy, 0, np.array([width, height, width, height], dtype=np.float64))
+
+
+def build_predictions(result, class_names_dict, scale=(1.0, 1.0)):
+    """
+    ultralytics の Results から検出結果 (Detections) を作成する。
+    scale は縮小デコードした画像の座標を元画像の座標に戻す倍率。
+    """
+    return detections_from_arrays(*result_arrays(result), class_names_dict, scale)
+
+
+def format_predictions(output_data, response_format):
+    return output_data.to_columns() if response_format == 'columnar' else output_data.to_objects()
+
+
+def requested_format(req):
+    """?format=columnar (またはフォームの format) でレスポンス形式を選ぶ。既定は従来形式"""
+    response_format = (req.args.get('format') or req.form.get('format') or 'objects').lower()
+    if response_format not in RESPONSE_FORMATS:
+        raise ValueError(f"Unknown format '{response_format}' (choose from {', '.join(RESPONSE_FORMATS)})")
+    return response_format
+
+
+def draw_detections(img_cv2, output_data, scale=(1.0, 1.0)):
+    """デバッグ用に検出結果を描画した画像のコピーを返す (scale はデコード時の縮小倍率)"""
+    sx, sy = scale
+    img_to_draw = img_cv2.copy()
+    color = (0, 255, 0) # 緑色
+    thickness = 2
+    font_scale = 0.7
+    font = cv2.FONT_HERSHEY_SIMPLEX
+    for class_name, confidence, box in zip(output_data.class_name, output_data.confidence, output_data.xyxy):
+        x1, y1, x2, y2 = map(int, (box[0] / sx, box[1] / sy, box[2] / sx, box[3] / sy))
+        label_text = f"{class_name}: {confidence:.2f}"
+
+        # バウンディングボックスを描画
+        cv2.rectangle(img_to_draw, (x1, y1), (x2, y2), color, thickness)
+
+        # ラベルテキストを描画 (背景付き、枠外にはみ出さないように調整)
+        (w, h), _ = cv2.getTextSize(label_text, font, font_scale, thickness)
+        label_y = y1 - h - 10 if y1 - h - 10 > 0 else y1 + 10 + h # 上か下に表示
+        # テキスト背景の矩形
+        cv2.rectangle(img_to_draw, (x1, label_y - h - 5), (x1 + w, label_y + 5), color, -1)
+        # テキスト本体 (黒色)
+        cv2.putText(img_to_draw, label_text, (x1, label_y), font, font_scale, (0, 0, 0), thickness, cv2.LINE_AA)
+    return img_to_draw
+
+
+# --- 分割 (タイル) 推論 ---
+def is_truthy(value):
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'on')
 
-except FileNotFoundError as fnf_error:
-    model_load_error = str(fnf_error)
-    logging.error(f"Critical Error: {fnf_error}", exc_info=False) # スタックトレースは不要
-except Exception as e:
-    model_load_error = str(e)
-    logging.error(f"Critical Error: Failed to load YOLO model ({model_name}): {e}", exc_info=True)
+
+def requested_tiling(req):
+    """
+    ?tiled=1 (またはフォームの tiled) で分割推論を有効にする。無効なら None を返す。
+    tile_size / tile_overlap / max_tiles / full_frame で精度と速度のバランスをリクエストごとに選べる。
+    """
+    def param(name, default):
+        value = req.args.get(name, req.form.get(name))
+        return default if value in (None, '') else value
+
+    if not is_truthy(param('tiled', '0')):
+        return None
+    try:
+        tile_size = int(param('tile_size', TILE_SIZE))
+        overlap = float(param('tile_overlap', TILE_OVERLAP))
+        max_tiles = int(param('max_tiles', TILE_MAX_TILES))
+    except ValueError:
+        raise ValueError("tile_size and max_tiles must be integers and tile_overlap must be a number")
+    if not 64 <= tile_size <= 4096:
+        raise ValueError("tile_size must be between 64 and 4096")
+    if not 0.0 <= overlap <= 0.75:
+        raise ValueError("tile_overlap must be between 0 and 0.75")
+    if not 1 <= max_tiles <= TILE_MAX_TILES_LIMIT:
+        raise ValueError(f"max_tiles must be between 1 and {TILE_MAX_TILES_LIMIT}")
+    return {
+        'tile_size': tile_size,
+        'overlap': overlap,
+        'max_tiles': max_tiles,
+        'full_frame': is_truthy(param('full_frame', TILE_FULL_FRAME)),
+    }
+
+
+def tile_starts(length, tile, overlap):
+    """1辺の長さ length を、重なりが overlap 以上になるよう等間隔に並べたタイルの開始位置"""
+    if length <= tile:
+        return [0]
+    count = int(math.ceil((length - tile) / (tile * (1.0 - overlap)))) + 1
+    return [round(i * (length - tile) / (count - 1)) for i in range(count)]
+
+
+def tile_grid(width, height, tile_size, overlap, max_tiles):
+    """
+    タイルの矩形 (x1, y1, x2, y2) のリスト・実際のタイルサイズ・(列数, 行数) を返す。
+    max_tiles を超える場合はタイルを大きくして (推論時の縮小率を上げて) 枚数を抑える。
+    """
+    tile = tile_size
+    while True:
+        xs = tile_starts(width, tile, overlap)
+        ys = tile_starts(height, tile, overlap)
+        if len(xs) * len(ys) <= max_tiles or tile >= max(width, height):
+            break
+        tile = int(math.ceil(tile * 1.1))
+    tile_w, tile_h = min(tile, width), min(tile, height)
+    return [(x, y, x + tile_w, y + tile_h) for y in ys for x in xs], tile, (len(xs), len(ys))
+
+
+def class_aware_nms(xyxy, conf, cls, iou_threshold=TILE_NMS_IOU):
+    """
+    クラスごとの NMS で残す検出の添字を信頼度の高い順に返す。
+    クラスごとに座標をずらすことで、全クラスを1回の NMS で処理する。
+    """
+    if len(xyxy) == 0:
+        return np.zeros(0, dtype=np.int64)
+    boxes = xyxy + cls[:, None] * (xyxy.max() + 1.0)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    order = np.argsort(-conf, kind='stable')
+    keep = []
+    while order.size:
+        best, rest = order[0], order[1:]
+        keep.append(best)
+        width = np.minimum(boxes[best, 2], boxes[rest, 2]) - np.maximum(boxes[best, 0], boxes[rest, 0])
+        height = np.minimum(boxes[best, 3], boxes[rest, 3]) - np.maximum(boxes[best, 1], boxes[rest, 1])
+        inter = np.clip(width, 0, None) * np.clip(height, 0, None)
+        iou = inter / (areas[best] + areas[rest] - inter + 1e-9)
+        order = rest[iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+
+def predict_tiled(img_cv2, tiling, imgsz, conf, deadline=None, backend=None):
+    """
+    画像を重なりのあるタイルに分けて推論し、検出を画像全体の座標に戻して NMS でまとめる。
+    戻り値は (xyxy, conf, cls, タイル情報)。
+    """
+    height, width = img_cv2.shape[:2]
+    tiles, tile, grid = tile_grid(width, height, tiling['tile_size'], tiling['overlap'], tiling['max_tiles'])
+    crops = [(img_cv2[y1:y2, x1:x2], (x1, y1)) for x1, y1, x2, y2 in tiles]
+    full_frame = tiling['full_frame'] and len(tiles) > 1
+    if full_frame:
+        crops.append((img_cv2, (0, 0))) # 大きな物体用の画像全体の粗い推論
+    # 全タイルを続けてスケジューラに投入し、同じバッチ (max_batch_size 枚ずつ) で推論させる
+    batch_scheduler.check_admission(len(crops), deadline)
+    futures = [(batch_scheduler.submit(crop, imgsz, conf, deadline, admit=False, backend=backend), offset) for crop, offset in crops]
+    boxes, scores, classes = [], [], []
+    for future, (dx, dy) in futures:
+        xyxy, score, cls = result_arrays(future.result())
+        boxes.append(xyxy + np.array([dx, dy, dx, dy], dtype=np.float64))
+        scores.append(score)
+        classes.append(cls)
+    xyxy, score, cls = np.concatenate(boxes), np.concatenate(scores), np.concatenate(classes)
+    keep = class_aware_nms(xyxy, score, cls)
+    info = {
+        'tiles': len(tiles),
+        'grid': list(grid),
+        'tile_size': tile,
+        'overlap': tiling['overlap'],
+        'full_frame': full_frame,
+        'candidates': int(len(xyxy)),
+        'merged': int(len(keep)),
+    }
+    return xyxy[keep], score[keep], cls[keep], info
+
+
+# --- デバッグ画像の非同期保存 ---
+DEBUG_SAMPLE_MODES = ('all', 'every_n', 'no_detection', 'low_confidence', 'off')
+
+
+class DebugImageWriter:
+    """
+    デバッグ画像の描画と保存をバックグラウンドスレッドで行う。
+    サンプリング対象外のフレームは描画もコピーもせずに捨て、
+    キューが満杯の場合は待たずに破棄する (リクエストの応答を遅らせない)。
+    保存した画像は索引に記録し、別のスレッドが定期的にアーカイブ・削除する (debug_archive.py)。
+    """
+
+    def __init__(self, directory, mode=DEBUG_SAMPLE_MODE, every_n=DEBUG_SAMPLE_EVERY_N,
+                 low_confidence=DEBUG_LOW_CONFIDENCE, queue_size=DEBUG_QUEUE_SIZE):
+        self.directory = directory
+        self.archive = DebugArchive(directory, max_bytes=int(DEBUG_MAX_MB * 1024 * 1024), max_files=DEBUG_MAX_FILES,
+                                    max_age=DEBUG_MAX_AGE_HOURS * 3600.0, archive=DEBUG_ARCHIVE,
+                                    batch_limit=DEBUG_MAINTENANCE_BATCH) if directory else None
+        self.maintenance_interval = DEBUG_MAINTENANCE_INTERVAL
+        self._maintenance_thread = None
+        self.mode = mode
+        self.every_n = max(1, int(every_n))
+        self.low_confidence = low_confidence
+        self._queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._counter_lock = threading.Lock()
+        self._seen = 0
+        self._sequence = 0 # 書き込みスレッドだけが更新する
+        self.counters = collections.Counter(written=0, dropped=0, skipped=0, failed=0)
+
+    def configure(self, mode=None, every_n=None, low_confidence=None, queue_size=None,
+                  max_mb=None, max_files=None, max_age_hours=None, archive=None):
+        """起動前に設定を変更する (コマンドライン引数の反映用)"""
+        if self.archive is not None:
+            if max_mb is not None:
+                self.archive.max_bytes = int(max(0.0, max_mb) * 1024 * 1024)
+            if max_files is not None:
+                self.archive.max_files = max(0, int(max_files))
+            if max_age_hours is not None:
+                self.archive.max_age = max(0.0, max_age_hours) * 3600.0
+            if archive is not None:
+                self.archive.archive = archive
+        if mode is not None:
+            self.mode = mode
+        if every_n is not None:
+            self.every_n = max(1, int(every_n))
+        if low_confidence is not None:
+            self.low_confidence = low_confidence
+        if queue_size is not None:
+            self._queue = queue.Queue(maxsize=max(1, int(queue_size)))
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name='debug-image-writer', daemon=True)
+                self._thread.start()
+            if self.archive is not None and (self._maintenance_thread is None or not self._maintenance_thread.is_alive()):
+                self._maintenance_thread = threading.Thread(target=self._maintain, name='debug-archive', daemon=True)
+                self._maintenance_thread.start()
+
+    def _count(self, name):
+        with self._counter_lock:
+            self.counters[name] += 1
+
+    def _should_sample(self, output_data):
+        if not self.directory or self.mode == 'off':
+            return False
+        if self.mode == 'every_n':
+            with self._counter_lock:
+                self._seen += 1
+                return self._seen % self.every_n == 0
+        if self.mode == 'no_detection':
+            return not output_data
+        if self.mode == 'low_confidence':
+            # 検出なし、または最も高い信頼度が閾値未満のフレーム
+            return not output_data or max(output_data.confidence) < self.low_confidence
+        return True
+
+    def submit(self, img_cv2, output_data, filename, scale=(1.0, 1.0), copy=False, request_id=None):
+        """
+        サンプリング対象ならキューに入れる (リクエストスレッドからは描画・保存しない)。
+        copy=True は応答後にクライアントが書き換える画像 (共有メモリ上のフレーム) の場合で、対象のときだけコピーする。
+        request_id は索引に記録し、/debug/images で検索できる。
+        """
+        if not self._should_sample(output_data):
+            self._count('skipped')
+            return False
+        if self._thread is None:
+            self.start()
+        if copy:
+            img_cv2 = img_cv2.copy()
+        try:
+            self._queue.put_nowait((img_cv2, output_data, filename, scale, request_id, time.time()))
+            return True
+        except queue.Full:
+            self._count('dropped')
+            return False
+
+    def _run(self):
+        while True:
+            img_cv2, output_data, filename, scale, request_id, received_at = self._queue.get()
+            try:
+                start_time = time.perf_counter()
+                self._write(img_cv2, output_data, filename, scale, request_id, received_at)
+                stage_seconds.observe(time.perf_counter() - start_time, 'debug_write')
+                self._count('written')
+            except Exception as save_e:
+                # 画像保存に失敗してもAPI自体はエラーにしない
+                self._count('failed')
+                logging.error(f"Failed to save debug image to '{self.directory}': {save_e}", exc_info=True)
+
+    def _write(self, img_cv2, output_data, filename, scale, request_id, received_at):
+        # 非同期保存で同じ時刻に複数枚書かれるため連番を付けて上書きを防ぐ
+        # (連番はプロセスごとなので、--workers の子プロセス同士で重ならないようプロセス ID も付ける)
+        self._sequence += 1
+        timestamp = time.strftime("%Y%m%d_%H%M%S", time.localtime(received_at)) + f"_{os.getpid()}_{self._sequence % 1000000:06d}"
+        # ファイル名を安全な文字のみにする
+        safe_original_filename = "".join(c if c.isalnum() else "_" for c in os.path.splitext(filename)[0])
+
+        if output_data: # 検出結果がある場合
+            save_path = os.path.join(self.directory, f"{timestamp}_{safe_original_filename}_result_simple.jpg")
+            ok = cv2.imwrite(save_path, draw_detections(img_cv2, output_data, scale)) # 描画済み画像を保存
+        else: # 検出結果がない場合
+            save_path = os.path.join(self.directory, f"{timestamp}_{safe_original_filename}_no_detection_simple.jpg")
+            ok = cv2.imwrite(save_path, img_cv2) # 元画像(BGR)を保存
+        if not ok:
+            raise IOError(f"cv2.imwrite returned False for {save_path}")
+        logging.debug(f"Saved debug image to: {save_path}")
+        if self.archive is not None:
+            self.archive.record(save_path, request_id, received_at)
+
+    def _maintain(self):
+        """過ぎた時間帯のアーカイブと、保存期間・容量の上限を超えた画像の削除を定期的に行う"""
+        while True:
+            result = {}
+            try:
+                start_time = time.perf_counter()
+                result = self.archive.maintain()
+                if any(result.values()):
+                    logging.info(f"Debug image maintenance in {time.perf_counter() - start_time:.2f} s: "
+                                 + ', '.join(f"{key} {value}" for key, value in result.items()))
+            except Exception as e:
+                logging.error(f"Debug image maintenance failed: {e}", exc_info=True)
+            time.sleep(DEBUG_MAINTENANCE_RETRY if result.get('pending') else self.maintenance_interval)
+
+    def stats(self):
+        with self._counter_lock:
+            counters = dict(self.counters)
+        return {
+            'enabled': bool(self.directory) and self.mode != 'off',
+            'mode': self.mode,
+            'every_n': self.every_n,
+            'low_confidence': self.low_confidence,
+            'queue_depth': self._queue.qsize(),
+            'queue_size': self._queue.maxsize,
+            **counters,
+            'retention': self.archive.stats() if self.archive is not None else None,
+        }
+
+
+debug_writer = DebugImageWriter(DEBUG_IMAGE_DIR)
+
+
+# --- 検出結果の履歴 (/history で集計する) ---
+detection_history = DetectionHistory(HISTORY_DB_PATH, HISTORY_QUEUE_SIZE, HISTORY_FLUSH_INTERVAL) if HISTORY_ENABLED else None
+
+
+def describe_predictions(output_data, filename):
+    """検出結果からレスポンス用メッセージを作成する"""
+    if output_data:
+        message = f"Detected {len(output_data)} objects."
+    else:
+        message = "No objects detected (result.boxes is empty or None after internal processing)."
+    logging.info(f"Prediction result for '{filename}': {message}")
+    return message
+
+
+# --- 推論結果キャッシュ (同一フレームの再推論を省く) ---
+class ImageDecodeError(ValueError):
+    """アップロードされた画像をデコードできなかった (400 を返す)"""
+
+
+class ResultCache:
+    """
+    アップロードのバイト列のハッシュと推論パラメータをキーにした LRU キャッシュ。
+    メモリ使用量 (概算) の上限と TTL を持つ。同じキーの推論が実行中の場合、
+    後から来たリクエストは推論を重ねて実行せず、その結果を待って共有する。
+    """
+    ENTRY_OVERHEAD_BYTES = 512     # 1エントリあたりの固定分 (キー・リスト・管理情報の概算)
+    DETECTION_BYTES = 256          # 検出1件 (各列の要素 + 座標リスト) の概算
+
+    def __init__(self, max_bytes=int(RESULT_CACHE_MAX_MB * 1024 * 1024), ttl=RESULT_CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict() # key -> (期限, サイズ, 値)
+        self._inflight = {}                       # key -> 実行中の推論の Future
+        self._bytes = 0
+        self.counters = collections.Counter(hit=0, miss=0, coalesced=0, bypass=0, evicted=0, expired=0)
+
+    @staticmethod
+    def make_key(img_bytes, *params):
+        return (hashlib.blake2b(img_bytes, digest_size=16).hexdigest(),) + params
+
+    def _estimate_size(self, value):
+        return self.ENTRY_OVERHEAD_BYTES + self.DETECTION_BYTES * len(value)
+
+    def get_or_compute(self, key, compute, bypass=False):
+        """キャッシュ済みの値か compute() の結果を返す。戻り値は (値, 'hit'|'miss'|'coalesced'|'bypass')"""
+        status, handle = self.begin(key, bypass)
+        if status == 'hit':
+            return handle, status
+        if status == 'coalesced':
+            # 同じフレームの推論が実行中: 結果 (または例外) を共有する
+            return handle.result(), status
+        try:
+            value = compute()
+        except BaseException as e:
+            self.finish(key, handle, error=e)
+            raise
+        self.finish(key, handle, value)
+        return value, status
+
+    def begin(self, key, bypass=False):
+        """
+        キャッシュを引く。(状態, ハンドル) を返す:
+        'hit' はハンドルが値、'coalesced' は実行中の推論の Future、
+        'miss' / 'bypass' は呼び出し側が計算し、finish(key, ハンドル, 値) を必ず呼ぶ。
+        """
+        if bypass or self.max_bytes <= 0:
+            with self._lock:
+                self.counters['bypass'] += 1
+            cache_results_total.inc('bypass')
+            return 'bypass', None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.counters['hit'] += 1
+                    cache_results_total.inc('hit')
+                    return 'hit', entry[2]
+                self._remove(key)
+                self.counters['expired'] += 1
+            leader_future = self._inflight.get(key)
+            if leader_future is None:
+                future = self._inflight[key] = Future()
+                self.counters['miss'] += 1
+            else:
+                self.counters['coalesced'] += 1
+
+        if leader_future is not None:
+            cache_results_total.inc('coalesced')
+            return 'coalesced', leader_future
+        cache_results_total.inc('miss')
+        return 'miss', future
+
+    def finish(self, key, future, value=None, error=None):
+        """begin が 'miss' を返した計算の結果 (または例外) を保存し、待っているリクエストに渡す"""
+        if future is None:
+            return # bypass
+        with self._lock:
+            self._inflight.pop(key, None)
+            if error is None:
+                self._store(key, value)
+        if error is None:
+            future.set_result(value)
+        else:
+            future.set_exception(error)
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self._bytes -= size
+
+    def _store(self, key, value):
+        size = self._estimate_size(value)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (time.monotonic() + self.ttl, size, value)
+        self._bytes += size
+        # メモリ上限を超えた分を古い順に追い出す
+        while self._bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.counters['evicted'] += 1
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+            entries = len(self._entries)
+            used = self._bytes
+            inflight = len(self._inflight)
+        lookups = counters['hit'] + counters['miss'] + counters['coalesced']
+        return {
+            'enabled': self.max_bytes > 0,
+            'entries': entries,
+            'bytes_estimate': used,
+            'max_bytes': self.max_bytes,
+            'ttl_seconds': self.ttl,
+            'inflight': inflight,
+            'hit_rate': round((counters['hit'] + counters['coalesced']) / lookups, 4) if lookups else None,
+            **counters,
+        }
+
+
+cache_results_total = metrics_registry.counter(
+    'goto_cache_requests_total', 'Result cache lookups for /predict, by outcome.', ('result',))
+result_cache = ResultCache()
+
+
+def cache_bypass_requested(headers):
+    """Cache-Control: no-cache / no-store が付いたリクエストはキャッシュを使わない"""
+    directives = {d.strip().lower() for d in headers.get('Cache-Control', '').split(',')}
+    return bool(directives & {'no-cache', 'no-store'})
 
 
 # --- /predict エンドポイント (修正済み) ---
 @app.route('/predict', methods=['POST'])
 def predict_endpoint():
+    # 使うモデルを選ぶ (?model=<name> で名前付きモデル、省略時は best.pt)
+    try:
+        active_model, backend = resolve_model(request)
+    except Exception as e:
+        return model_unavailable_response(e)
+
     # モデルがロードされていない場合はエラーを返す
-    if model is None:
+    if active_model is None:
         logging.error("Prediction attempt failed: Model is not loaded.")
         return jsonify({
             'error': 'Model not loaded or failed to load',
             'details': model_load_error
         }), 503 # Service Unavailable
 
-    # リクエストに画像ファイルが含まれているかチェック
-    if 'image' not in request.files:
-        logging.warning("Request rejected: No 'image' file part found in the request.")
-        return jsonify({'error': 'No image file provided in the request'}), 400
+    timer = StageTimer()
+
+    raw_body = request.mimetype == detection_codec.RAW_MEDIA_TYPE # 画素をそのまま送ったリクエスト (detection_codec.py を参照)
+    if raw_body:
+        filename = RAW_UPLOAD_FILENAME
+    else:
+        # リクエストに画像ファイルが含まれているかチェック (ここでマルチパートが読み込まれる)
+        if 'image' not in request.files:
+            logging.warning("Request rejected: No 'image' file part found in the request.")
+            return jsonify({'error': 'No image file provided in the request'}), 400
 
-    file = request.files['image']
+        file = request.files['image']
+        filename = file.filename
 
-    # ファイル名が空でないかチェック
-    if file.filename == '':
-        logging.warning("Request rejected: No file selected (empty filename).")
-        return jsonify({'error': 'No file selected'}), 400
+        # ファイル名が空でないかチェック
+        if file.filename == '':
+            logging.warning("Request rejected: No file selected (empty filename).")
+            return jsonify({'error': 'No file selected'}), 400
 
-    # 画像ファイルの読み込みと前処理
     try:
-        img_bytes = file.read()
-        # Pillowで開いてRGBに変換
-        img = Image.open(io.BytesIO(img_bytes)).convert('RGB')
-        # Pillow(RGB) -> NumPy(RGB)
-        img_np = np.array(img)
-        # NumPy(RGB) -> OpenCV(BGR) - 描画用およびモデル入力用 (YOLOv8はBGR入力を想定)
-        img_cv2 = cv2.cvtColor(img_np, cv2.COLOR_RGB2BGR)
-        logging.info(f"Image received and loaded successfully: {file.filename} (Dimensions: {img.width}x{img.height})")
+        response_format = requested_format(request)
+        tiling = requested_tiling(request)
+        deadline = request_deadline()
+        img_bytes = request.get_data(cache=False) if raw_body else file.read()
+        raw = raw_upload(img_bytes, request.headers, tiling, active_model) if raw_body else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    # レスポンス形式は Accept ヘッダーで選ぶ (指定が無い・対応していない場合は JSON)
+    media_type = best_media_type(request.headers.get('Accept'))
+    timer.mark('read')
+
+    upload = UploadPrediction(img_bytes, filename, active_model, backend, tiling, deadline, timer, g.request_id,
+                              request_source(request.headers, request.args, request.remote_addr), raw)
+    try:
+        output_data, message, cache_status = upload.run(cache_bypass_requested(request.headers))
     except Exception as e:
-        logging.error(f"Error processing image file '{file.filename}': {e}", exc_info=True)
-        return jsonify({'error': f'Invalid or corrupted image file: {e}'}), 400
+        status, payload, headers = predict_error(e, filename)
+        response = jsonify(payload)
+        response.status_code = status
+        response.headers.update(headers)
+        return response
+    # 正常終了：検出結果を返す (段階ごとの処理時間は Server-Timing ヘッダーで返す)
+    response = detection_response(message, output_data, response_format, media_type, timer, upload.imgsz)
+    response.headers['X-Cache'] = cache_status.upper()
+    return response
+
+
+RAW_UPLOAD_FILENAME = 'raw' # 画素をそのまま送ったリクエストのファイル名 (ログとデバッグ画像の名前に使う)
+
+
+def raw_upload(body, headers, tiling, active_model):
+    """application/octet-stream の本体の並び方を読み、レターボックス済みならそのまま推論できるか確認する。不正なら ValueError"""
+    raw = detection_codec.RawFrame.parse(body, headers)
+    if raw.letterboxed:
+        if raw.width % LETTERBOX_STRIDE or raw.height % LETTERBOX_STRIDE:
+            raise ValueError(f"Letterboxed frames must have sides that are multiples of {LETTERBOX_STRIDE}, "
+                             f"got {raw.width}x{raw.height}")
+        size = active_model.fixed_input_size
+        if size is not None and (raw.width, raw.height) != (size, size):
+            raise ValueError(f"The {active_model.name} backend only accepts letterboxed frames of {size}x{size}")
+        if tiling:
+            raise ValueError("Letterboxed frames cannot be combined with tiled inference")
+    return raw
+
+
+class UploadPrediction:
+    """
+    /predict 1リクエスト分の処理 (デコード・推論・後処理)。Flask と asyncio のフロントエンド (--async) で共有する。
+    run() は同期で全段階を行い、--async は decode() と tiled() をスレッドで、推論の完了待ちをイベントループで行う。
+    失敗した場合の例外 (ImageDecodeError / OverloadedError など) は predict_error でレスポンスにする。
+    """
+
+    def __init__(self, img_bytes, filename, active_model, backend, tiling, deadline, timer, request_id=None, source=None, raw=None):
+        self.img_bytes = img_bytes
+        self.filename = filename
+        self.request_id = request_id
+        self.source = source
+        self.active_model = active_model
+        self.backend = backend
+        self.tiling = tiling
+        self.deadline = deadline
+        self.timer = timer
+        self.raw = raw # 画素をそのまま送った場合の並び方 (detection_codec.RawFrame)
+        self.letterboxed = raw is not None and raw.letterboxed
+        # 推論解像度は受け付けた時点の負荷で決める (デコードの縮小もこの解像度に合わせる)。
+        # レターボックス済みのフレームはクライアントが合わせた大きさのまま推論する
+        self.imgsz = max(raw.width, raw.height) if self.letterboxed else resolution_ladder.current()
+        self.img_cv2 = None
+        self.scale = (1.0, 1.0)
+
+    def cache_key(self):
+        return ResultCache.make_key(self.img_bytes, self.active_model.model_path, self.active_model.weights_sha256, self.imgsz,
+                                    CONFIDENCE_THRESHOLD, JPEG_REDUCED_DECODE, tuple(sorted(self.tiling.items())) if self.tiling else None,
+                                    self.raw.key() if self.raw is not None else None)
+
+    def decode(self):
+        # 混雑している・期限切れの場合はデコード前に断る
+        batch_scheduler.check_admission(1, self.deadline)
+
+        if self.raw is not None:
+            # 画素をそのまま送ったリクエストはデコードも縮小もしない (BGRA は BGR にする)
+            self.img_cv2 = self.raw.image(self.img_bytes)
+            if self.raw.channels == 4:
+                self.img_cv2 = cv2.cvtColor(self.img_cv2, cv2.COLOR_BGRA2BGR)
+            self.timer.mark('decode')
+            return
+
+        # 画像ファイルの読み込みと前処理
+        try:
+            # 分割推論では小さな物体を残すため縮小デコードしない
+            self.img_cv2, self.scale, decode_ms = decode_image_bytes(self.img_bytes, None if self.tiling else self.imgsz)
+        except Exception as e:
+            raise ImageDecodeError(str(e)) from e
+        self.timer.mark('decode')
+        logging.info(f"Image received and loaded successfully: {self.filename} (Decoded: {self.img_cv2.shape[1]}x{self.img_cv2.shape[0]}, scale={self.scale[0]:.2f}, decode={decode_ms:.2f} ms)")
+
+    def tiled(self):
+        """分割推論: タイルごとに推論して NMS でまとめる"""
+        xyxy, conf, cls, tiling_info = predict_tiled(self.img_cv2, self.tiling, self.imgsz, CONFIDENCE_THRESHOLD, self.deadline, self.backend)
+        predict_time = self.timer.mark('inference')
+        logging.info(f"Tiled prediction ({tiling_info['tiles']} tiles of {tiling_info['tile_size']}px, "
+                     f"{tiling_info['candidates']} -> {tiling_info['merged']} detections) completed in {predict_time:.4f} seconds.")
+        output_data = detections_from_arrays(xyxy, conf, cls, self.active_model.names, self.scale, tiling_info)
+        self.timer.mark('postprocess')
+        return self.finish(output_data)
+
+    def submit(self):
+        """バッチスケジューラに投入し、推論結果の Future を返す"""
+        logging.info(f"Queueing prediction for '{self.filename}' with imgsz={self.imgsz}, conf={CONFIDENCE_THRESHOLD}...")
+        # 同時に届いた他のリクエストの画像とまとめて1回の model.predict で処理される
+        return batch_scheduler.submit(self.img_cv2, self.imgsz, CONFIDENCE_THRESHOLD, self.deadline, admit=False, backend=self.backend,
+                                      letterboxed=self.letterboxed)
+
+    def predicted(self, result):
+        """推論結果からレスポンスデータを作る"""
+        predict_time = self.timer.mark('inference')
+        resolution_ladder.observe(self.imgsz, predict_time * 1000.0)
+        logging.info(f"Prediction (including batch queue wait) completed in {predict_time:.4f} seconds.")
+        if self.letterboxed and self.raw.original_size is not None:
+            # レターボックス上の座標を元の画像の座標に戻して返す (デバッグ画像は受け取ったフレームに描く)
+            xyxy, conf, cls = result_arrays(result)
+            drawn = detections_from_arrays(xyxy, conf, cls, self.active_model.names)
+            output_data = detections_from_arrays(unletterbox(xyxy, (self.raw.width, self.raw.height), self.raw.original_size), conf, cls, self.active_model.names)
+            self.timer.mark('postprocess')
+            return self.finish(output_data, drawn)
+        output_data = build_predictions(result, self.active_model.names, self.scale)
+        self.timer.mark('postprocess')
+        return self.finish(output_data)
+
+    def finish(self, output_data, drawn=None):
+        # --- デバッグ画像の保存 ---
+        drawn = output_data if drawn is None else drawn
+        debug_writer.submit(self.img_cv2, drawn, self.filename, self.scale, request_id=self.request_id)
+        self.timer.mark('debug')
+        return output_data
+
+    def compute(self):
+        """デコードから後処理まで (キャッシュに無い場合だけ実行される)"""
+        self.decode()
+        if self.tiling:
+            return self.tiled()
+        return self.predicted(self.submit().result())
+
+    def respond(self, output_data, cache_status):
+        """キャッシュの結果も含め、返す検出結果を記録して (メッセージ, キャッシュの状態) を返す"""
+        if cache_status in ('hit', 'coalesced'):
+            self.timer.mark('cache')
+        record_detections(output_data, self.source, self.request_id)
+        return describe_predictions(output_data, self.filename), cache_status
+
+    def run(self, bypass_cache=False):
+        """同期で処理して (検出結果, メッセージ, キャッシュの状態) を返す (同一フレームは結果キャッシュから返す)"""
+        output_data, cache_status = result_cache.get_or_compute(self.cache_key(), self.compute, bypass=bypass_cache)
+        return (output_data,) + self.respond(output_data, cache_status)
+
+
+def predict_error(error, filename):
+    """UploadPrediction の例外を (ステータス, 本体, ヘッダー) にする"""
+    if isinstance(error, ImageDecodeError):
+        logging.error(f"Error processing image file '{filename}': {error}", exc_info=error)
+        return 400, {'error': f'Invalid or corrupted image file: {error}'}, {}
+    if isinstance(error, (OverloadedError, DeadlineExceededError)):
+        return admission_error(error)
+    # 推論・結果処理中の予期せぬエラー
+    logging.error(f"Error during YOLO prediction or result processing for '{filename}': {error}", exc_info=error)
+    return 500, {'error': f'Prediction process failed internally: {error}'}, {} # Internal Server Error
+
 
-    # YOLO推論と結果処理
+# --- /predict/batch エンドポイント ---
+@app.route('/predict/batch', methods=['POST'])
+def predict_batch_endpoint():
+    """
+    1リクエストに含まれる複数の画像パートをまとめて推論する。
+    結果は画像の順番どおりのリストで、各要素は /predict と同じ形式。
+    個々の画像のエラーはその要素にだけ記録され、リクエスト全体は失敗しない。
+    """
     try:
-        # モデルのクラス名辞書を取得 (推論前に取得しておく)
-        class_names_dict = model.names
+        active_model, backend = resolve_model(request)
+    except Exception as e:
+        return model_unavailable_response(e)
+    if active_model is None:
+        logging.error("Batch prediction attempt failed: Model is not loaded.")
+        return jsonify({
+            'error': 'Model not loaded or failed to load',
+            'details': model_load_error
+        }), 503
 
-        logging.info(f"Starting single prediction for '{file.filename}' with imgsz={IMAGE_SIZE}, conf={CONFIDENCE_THRESHOLD}...")
-        start_time = time.time()
+    timer = StageTimer()
+    try:
+        response_format = requested_format(request)
+        deadline = request_deadline()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-        # --- ★ 単一回の推論実行 ★ ---
-        # OpenCV(BGR)形式のNumPy配列を入力として使用
-        results = model.predict(
-            img_cv2,                 # BGR画像を入力
-            imgsz=IMAGE_SIZE,        # 推論サイズ指定
-            conf=CONFIDENCE_THRESHOLD, # 信頼度閾値
-            verbose=False            # コンソール出力を抑制
-        )
-        # model.predict は内部でNMSを実行します
-
-        predict_time = time.time() - start_time
-        logging.info(f"Single prediction completed in {predict_time:.4f} seconds.")
-
-        # --- レスポンスデータの作成 ---
-        output_data = []
-        message = ""
-        img_to_draw = img_cv2.copy() # デバッグ描画用に画像をコピー
-
-        # 結果の処理 (resultsリストの最初の要素を使用)
-        if results and len(results) > 0:
-            result = results[0] # 単一画像入力なので結果は一つ
-
-            # 検出結果 (Boxesオブジェクト) が存在するか確認
-            if hasattr(result, 'boxes') and result.boxes is not None and len(result.boxes) > 0:
-                # result.boxes にはNMS適用後の検出結果が含まれる
-                boxes = result.boxes # Boxesオブジェクトを取得
-
-                logging.info(f"Processing {len(boxes)} detections found in the result.")
-
-                # 各検出結果を処理
-                for box_data in boxes:
-                    # 検出情報を抽出
-                    xyxy = box_data.xyxy[0].tolist()        # 座標 [x1, y1, x2, y2]
-                    confidence = box_data.conf[0].item()    # 信頼度
-                    class_id = int(box_data.cls[0].item())  # クラスID
-                    class_name = class_names_dict.get(class_id, f"UnknownID:{class_id}") # クラス名取得
-
-                    # レスポンスデータに追加
-                    output_data.append({
-                        'class_id': class_id,
-                        'class_name': class_name,
-                        'confidence': confidence,
-                        'box': {
-                            'x1': xyxy[0],
-                            'y1': xyxy[1],
-                            'x2': xyxy[2],
-                            'y2': xyxy[3]
-                        }
-                    })
-
-                    # --- デバッグ画像への描画 ---
-                    x1, y1, x2, y2 = map(int, xyxy)
-                    label_text = f"{class_name}: {confidence:.2f}"
-                    color = (0, 255, 0) # 緑色
-                    thickness = 2
-                    font_scale = 0.7
-                    font = cv2.FONT_HERSHEY_SIMPLEX
-
-                    # バウンディングボックスを描画
-                    cv2.rectangle(img_to_draw, (x1, y1), (x2, y2), color, thickness)
-
-                    # ラベルテキストを描画 (背景付き、枠外にはみ出さないように調整)
-                    (w, h), _ = cv2.getTextSize(label_text, font, font_scale, thickness)
-                    label_y = y1 - h - 10 if y1 - h - 10 > 0 else y1 + 10 + h # 上か下に表示
-                    # テキスト背景の矩形
-                    cv2.rectangle(img_to_draw, (x1, label_y - h - 5), (x1 + w, label_y + 5), color, -1)
-                    # テキスト本体 (黒色)
-                    cv2.putText(img_to_draw, label_text, (x1, label_y), font, font_scale, (0, 0, 0), thickness, cv2.LINE_AA)
-                    # --- 描画終了 ---
-
-                # 最終的な検出数をメッセージに設定
-                final_count = len(output_data)
-                if final_count > 0:
-                    message = f"Detected {final_count} objects."
-                else:
-                    # このパスは通常、 predictのconfフィルタリングにより到達しないはず
-                    message = f"Prediction ran, but no objects met the confidence threshold ({CONFIDENCE_THRESHOLD})."
-                logging.info(f"Prediction result for '{file.filename}': {message}")
+    # パート名に関係なく、送られた順番で全ての画像パートを取り出す
+    files = [f for _, f in request.files.items(multi=True)]
+    if not files:
+        logging.warning("Batch request rejected: No image file parts found in the request.")
+        return jsonify({'error': 'No image files provided in the request'}), 400
+    if len(files) > BATCH_ENDPOINT_MAX_IMAGES:
+        logging.warning(f"Batch request rejected: {len(files)} images exceeds the limit of {BATCH_ENDPOINT_MAX_IMAGES}.")
+        return jsonify({'error': f'Too many images in one request (max {BATCH_ENDPOINT_MAX_IMAGES})'}), 413
+
+    class_names_dict = active_model.names
+    results = [None] * len(files)
+    decoded = [] # (index, filename, img_cv2, scale)
+
+    # 画像ごとに読み込み・デコード (失敗したものはその要素だけエラーにする)
+    uploads = []
+    for index, file in enumerate(files):
+        filename = file.filename or f"image_{index}"
+        if file.filename == '':
+            results[index] = {'index': index, 'filename': filename, 'status': 400, 'error': 'No file selected'}
+            continue
+        uploads.append((index, filename, file.read()))
+    timer.mark('read')
+    imgsz = resolution_ladder.current()
+    for index, filename, img_bytes in uploads:
+        try:
+            img_cv2, scale, _ = decode_image_bytes(img_bytes, imgsz)
+            decoded.append((index, filename, img_cv2, scale))
+        except Exception as e:
+            logging.warning(f"Batch item {index} ('{filename}') could not be decoded: {e}")
+            results[index] = {'index': index, 'filename': filename, 'status': 400, 'error': f'Invalid or corrupted image file: {e}'}
+    timer.mark('decode')
+
+    # デコードできた画像をまとめてスケジューラに投入 (同じバッチで推論される)
+    logging.info(f"Queueing batch prediction for {len(decoded)}/{len(files)} images with imgsz={imgsz}, conf={CONFIDENCE_THRESHOLD}...")
+    # 全画像をまとめて受け付けられるか先に確認する (混雑時はリクエスト全体を 429 にする)
+    try:
+        batch_scheduler.check_admission(len(decoded), deadline)
+    except (OverloadedError, DeadlineExceededError) as e:
+        return admission_error_response(e)
+    futures = [(index, filename, img_cv2, scale, batch_scheduler.submit(img_cv2, imgsz, CONFIDENCE_THRESHOLD, deadline, admit=False, backend=backend))
+               for index, filename, img_cv2, scale in decoded]
+    outcomes = []
+    for index, filename, img_cv2, scale, future in futures:
+        try:
+            outcomes.append((index, filename, img_cv2, scale, future.result(), None))
+        except Exception as e:
+            outcomes.append((index, filename, img_cv2, scale, None, e))
+    inference_time = timer.mark('inference')
+    if decoded:
+        resolution_ladder.observe(imgsz, inference_time * 1000.0)
+
+    finished = []
+    for index, filename, img_cv2, scale, result, error in outcomes:
+        if isinstance(error, DeadlineExceededError):
+            results[index] = {'index': index, 'filename': filename, 'status': 504, 'error': str(error)}
+            continue
+        try:
+            if error is not None:
+                raise error
+            output_data = build_predictions(result, class_names_dict, scale)
+            message = describe_predictions(output_data, filename)
+            record_detections(output_data, request_source(request.headers, request.args, request.remote_addr), g.request_id)
+            results[index] = {'index': index, 'filename': filename, 'status': 200, 'message': message,
+                              'predictions': format_predictions(output_data, response_format)}
+            finished.append((img_cv2, output_data, filename, scale))
+        except Exception as e:
+            logging.error(f"Error during YOLO prediction or result processing for batch item {index} ('{filename}'): {e}", exc_info=True)
+            results[index] = {'index': index, 'filename': filename, 'status': 500, 'error': f'Prediction process failed internally: {e}'}
+    timer.mark('postprocess')
+
+    for img_cv2, output_data, filename, scale in finished:
+        debug_writer.submit(img_cv2, output_data, filename, scale, request_id=g.request_id)
+    timer.mark('debug')
+
+    logging.info(f"Batch prediction of {len(decoded)} images completed in {sum(timer.timings.values()):.4f} seconds.")
+    response = json_response({'count': len(results), 'imgsz': imgsz, 'results': results}, 200, timer)
+    response.headers['X-Inference-Size'] = str(imgsz)
+    return response
+
+
+# --- /track エンドポイント (セッションごとの物体追跡) ---
+track_frames_total = metrics_registry.counter(
+    'goto_track_frames_total', 'Frames handled by /track, by kind (keyframe / predicted).', ('kind',))
+track_sessions_gauge = metrics_registry.gauge(
+    'goto_track_sessions', 'Active /track sessions.')
+tracking_sessions = TrackingSessions(
+    lambda: Tracker(TRACK_IOU_THRESHOLD, TRACK_HIGH_CONFIDENCE, TRACK_MAX_MISSED),
+    max_sessions=TRACK_MAX_SESSIONS, timeout=TRACK_SESSION_TIMEOUT)
+track_sessions_gauge.set_function(lambda: len(tracking_sessions))
+
+
+@app.route('/track', methods=['POST'])
+def track_endpoint():
+    """
+    session_id ごとにトラッカーの状態を保持し、安定したトラック ID 付きの検出結果を返す。
+    detect_every=K のとき K フレームに1回だけ検出し、間のフレームは画像を読まずに動きから位置を予測する。
+    keyframe=1 でそのフレームの検出を強制できる。レスポンスの next_is_keyframe が false なら次のフレームは画像を省略できる。
+    ?model=<name> で名前付きモデルを選べる (/predict と同じ)。
+    """
+    try:
+        active_model, backend = resolve_model(request)
+    except Exception as e:
+        return model_unavailable_response(e)
+    if active_model is None:
+        logging.error("Track attempt failed: Model is not loaded.")
+        return jsonify({
+            'error': 'Model not loaded or failed to load',
+            'details': model_load_error
+        }), 503
+
+    timer = StageTimer()
+    session_id = request.args.get('session_id') or request.form.get('session_id') or request.headers.get('X-Session-Id')
+    if not session_id or len(session_id) > 128:
+        return jsonify({'error': 'A session_id (1-128 characters) is required'}), 400
+    try:
+        detect_every = int(request.args.get('detect_every', request.form.get('detect_every', TRACK_DETECT_EVERY)))
+    except ValueError:
+        return jsonify({'error': 'detect_every must be an integer'}), 400
+    if not 1 <= detect_every <= 300:
+        return jsonify({'error': 'detect_every must be between 1 and 300'}), 400
+    force_keyframe = is_truthy(request.args.get('keyframe', request.form.get('keyframe', '0')))
+    try:
+        deadline = request_deadline()
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        session = tracking_sessions.acquire(session_id, detect_every)
+    except SessionLimitError as e:
+        logging.warning(f"Track request rejected for session '{session_id}': {e}")
+        response = jsonify({'error': str(e)})
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response, 429
+
+    with session.lock:
+        session.detect_every = detect_every
+        frame = session.frames
+        keyframe = force_keyframe or frame % detect_every == 0
+        detections = None
+        imgsz = None # 検出しないフレームでは推論しない
+        if keyframe:
+            file = request.files.get('image')
+            if file is None or file.filename == '':
+                return jsonify({'error': f'Frame {frame} is a keyframe and requires an image', 'frame': frame}), 400
+            img_bytes = file.read()
+            timer.mark('read')
+            imgsz = resolution_ladder.current()
+            try:
+                img_cv2, scale, _ = decode_image_bytes(img_bytes, imgsz)
+            except Exception as e:
+                logging.error(f"Error processing image file '{file.filename}' for session '{session_id}': {e}")
+                return jsonify({'error': f'Invalid or corrupted image file: {e}'}), 400
+            timer.mark('decode')
+            try:
+                result = batch_scheduler.submit(img_cv2, imgsz, CONFIDENCE_THRESHOLD, deadline, backend=backend).result()
+                resolution_ladder.observe(imgsz, timer.mark('inference') * 1000.0)
+                output_data = build_predictions(result, active_model.names, scale)
+            except (OverloadedError, DeadlineExceededError) as e:
+                return admission_error_response(e)
+            except Exception as e:
+                logging.error(f"Error during YOLO prediction for session '{session_id}': {e}", exc_info=True)
+                return jsonify({'error': f'Prediction process failed internally: {e}'}), 500
+            record_detections(output_data, request_source(request.headers, request.args, request.remote_addr), g.request_id)
+            debug_writer.submit(img_cv2, output_data, file.filename, scale, request_id=g.request_id)
+            detections = (np.array(output_data.xyxy, dtype=np.float64).reshape(-1, 4), np.array(output_data.confidence),
+                          np.array(output_data.class_id, dtype=np.int64), output_data.class_name)
+            timer.mark('postprocess')
+
+        tracks = session.tracker.step(detections)
+        session.frames += 1
+        session.keyframes += int(keyframe)
+        timer.mark('track')
+    track_frames_total.inc('keyframe' if keyframe else 'predicted')
+
+    return json_response({
+        'session_id': session_id,
+        'frame': frame,
+        'keyframe': keyframe,
+        'imgsz': imgsz,
+        'next_is_keyframe': (frame + 1) % detect_every == 0,
+        'tracks': [track.to_dict(predicted) for track, predicted in tracks],
+    }, 200, timer)
+
+
+@app.route('/track/<session_id>', methods=['DELETE'])
+def track_close_endpoint(session_id):
+    """セッションを終了してトラッカーの状態を破棄する"""
+    if not tracking_sessions.close(session_id):
+        return jsonify({'error': f"Unknown session '{session_id}'"}), 404
+    logging.info(f"Tracking session '{session_id}' closed by client.")
+    return jsonify({'session_id': session_id, 'closed': True}), 200
+
+
+# --- /stream WebSocket エンドポイント (最新フレーム優先) ---
+stream_frames_total = metrics_registry.counter(
+    'goto_stream_frames_total', 'Frames received over /stream, by outcome (processed / dropped / error).', ('outcome',))
+stream_connections = metrics_registry.gauge(
+    'goto_stream_connections', 'Open /stream WebSocket connections.')
+
+
+class StreamConnection:
+    """/stream の1接続分の状態と統計"""
+    _ids = iter(range(1, 1 << 62))
+
+    def __init__(self, peer, request_id=None, source=None):
+        self.id = next(StreamConnection._ids)
+        self.peer = peer
+        self.request_id = request_id # 接続のリクエスト ID (この接続のデバッグ画像はすべてこの ID で記録する)
+        self.source = source         # 検出結果の履歴の送信元
+        self.started = time.time()
+        self.received = 0
+        self.processed = 0
+        self.dropped = 0 # 推論中に新しいフレームが届いたため推論しなかったフレーム数
+        self.errors = 0
+        self.last_seq = None
+
+    def stats(self):
+        return {
+            'id': self.id,
+            'peer': self.peer,
+            'request_id': self.request_id,
+            'uptime_seconds': round(time.time() - self.started, 1),
+            'received': self.received,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'errors': self.errors,
+            'last_seq': self.last_seq,
+        }
+
+
+stream_lock = threading.Lock()
+active_streams = {} # id -> StreamConnection
+stream_connections.set_function(lambda: len(active_streams))
+
+
+def streams_summary():
+    with stream_lock:
+        connections = [conn.stats() for conn in active_streams.values()]
+    return {'enabled': Sock is not None, 'active': len(connections), 'connections': connections}
+
+
+def process_stream_frame(conn, seq, img_bytes, response_format, packed):
+    """1フレームを推論して、クライアントに送るメッセージ (JSON テキストまたはバイナリ) を返す"""
+    timer = StageTimer()
+    imgsz = resolution_ladder.current()
+    img_cv2, scale, _ = decode_image_bytes(img_bytes, imgsz)
+    timer.mark('decode')
+    class_names_dict = model.names
+    result = batch_scheduler.submit(img_cv2, imgsz, CONFIDENCE_THRESHOLD).result()
+    resolution_ladder.observe(imgsz, timer.mark('inference') * 1000.0)
+    output_data = build_predictions(result, class_names_dict, scale)
+    record_detections(output_data, conn.source, conn.request_id)
+    timer.mark('postprocess')
+    debug_writer.submit(img_cv2, output_data, f"stream{conn.id}_{seq}", scale, request_id=conn.request_id)
+    timer.mark('debug')
+    if packed:
+        reply = detection_codec.encode_stream_reply(seq, conn.dropped, output_data.to_columns())
+    else:
+        reply = json.dumps({
+            'seq': seq,
+            'dropped': conn.dropped,
+            'imgsz': imgsz,
+            'predictions': format_predictions(output_data, response_format),
+            'timings_ms': {stage: round(seconds * 1000.0, 2) for stage, seconds in timer.timings.items()},
+        }, ensure_ascii=False, separators=(',', ':'))
+    timer.mark('serialize')
+    return reply
+
+
+def stream_endpoint(ws):
+    """
+    WebSocket で連続フレームを受け取り、検出結果をフレーム番号付きで送り返す。
+    推論中に届いたフレームは溜めずに最新の1枚だけを次に推論する (古いフレームは破棄して数える)。
+    フレームの形式は detection_codec.py を参照。
+    """
+    if model is None:
+        ws.send(json.dumps({'error': 'Model not loaded or failed to load', 'details': model_load_error}))
+        return
+    try:
+        response_format = requested_format(request)
+    except ValueError as e:
+        ws.send(json.dumps({'error': str(e)}))
+        return
+    packed = request.args.get('encoding') == 'packed'
+
+    conn = StreamConnection(request.remote_addr, g.request_id, request_source(request.headers, request.args, request.remote_addr))
+    with stream_lock:
+        active_streams[conn.id] = conn
+    logging.info(f"Stream #{conn.id} opened from {conn.peer} (format={response_format}, packed={packed}).")
+    try:
+        while True:
+            data = ws.receive()
+            conn.received += 1
+            # 推論中に溜まったフレームは最新の1枚だけ残して破棄する
+            while True:
+                newer = ws.receive(timeout=0)
+                if newer is None:
+                    break
+                conn.received += 1
+                conn.dropped += 1
+                stream_frames_total.inc('dropped')
+                data = newer
+
+            seq = None
+            try:
+                if isinstance(data, str):
+                    raise ValueError("Expected a binary frame (8-byte sequence number followed by an image)")
+                seq, img_bytes = detection_codec.unpack_stream_frame(data)
+                conn.last_seq = seq
+                reply = process_stream_frame(conn, seq, bytes(img_bytes), response_format, packed)
+                conn.processed += 1
+                stream_frames_total.inc('processed')
+            except Exception as e:
+                conn.errors += 1
+                stream_frames_total.inc('error')
+                logging.warning(f"Stream #{conn.id} frame {seq} failed: {e}")
+                reply = json.dumps({'seq': seq, 'dropped': conn.dropped, 'error': str(e)})
+            ws.send(reply)
+    except ConnectionClosed:
+        pass
+    finally:
+        with stream_lock:
+            active_streams.pop(conn.id, None)
+        logging.info(f"Stream #{conn.id} closed: received {conn.received}, processed {conn.processed}, dropped {conn.dropped}, errors {conn.errors}.")
+
+
+if Sock is not None:
+    Sock(app).route('/stream')(stream_endpoint)
+else:
+    logging.info("flask-sock is not installed; the /stream WebSocket endpoint is disabled (pip install flask-sock).")
 
+
+# --- 共有メモリ経由のフレーム受信 (--shm-ingest) ---
+# 同じホストのクライアントは JPEG へのエンコードと HTTP を省き、共有メモリに書いた生の BGR フレームを
+# スロット番号だけ Unix ドメインソケットで知らせる。プロトコルは shm_ring.py を参照。
+shm_frames_total = metrics_registry.counter(
+    'goto_shm_frames_total', 'Frames received over the shared-memory ingest socket, by outcome (processed / rejected / error).', ('outcome',))
+shm_connections = metrics_registry.gauge(
+    'goto_shm_connections', 'Open shared-memory ingest connections.')
+
+
+class ShmIngestConnection:
+    """
+    共有メモリ受信の1接続分の状態と統計。
+    受信スレッドはフレームを推論キューに入れるだけで応答を待たず、応答は送信スレッドが届いた順に返す
+    (クライアントがスロット数まで続けて送れるので、バッチが埋まりやすい)。
+    """
+    _ids = iter(range(1, 1 << 62))
+
+    def __init__(self, sock, ring, request_id, source):
+        self.id = next(ShmIngestConnection._ids)
+        self.sock = sock
+        self.ring = ring
+        self.request_id = request_id # 接続要求の 'request_id' (無ければ新しい ID)。デバッグ画像の検索に使う
+        self.source = source         # 接続要求の 'source' (無ければ 'shm')。検出結果の履歴の送信元
+        self.started = time.time()
+        self.received = 0
+        self.processed = 0
+        self.rejected = 0 # 受け付け制限 (429 / 504) で推論しなかったフレーム数
+        self.errors = 0
+        self.replies = queue.Queue() # 推論中のフレーム (届いた順)
+
+    def stats(self):
+        return {
+            'id': self.id,
+            'ring': self.ring.name,
+            'request_id': self.request_id,
+            'slots': self.ring.slot_count,
+            'slot_bytes': self.ring.slot_bytes,
+            'uptime_seconds': round(time.time() - self.started, 1),
+            'received': self.received,
+            'processed': self.processed,
+            'rejected': self.rejected,
+            'errors': self.errors,
+            'in_flight': self.replies.qsize(),
+        }
+
+
+class ShmIngestServer:
+    """Unix ドメインソケットで待ち受け、接続ごとにクライアントの共有メモリを開いて推論する"""
+
+    def __init__(self, path=SHM_SOCKET_PATH, mode=SHM_SOCKET_MODE):
+        self.path = path
+        self.mode = mode
+        self._listener = None
+        self._lock = threading.Lock()
+        self._connections = {} # id -> ShmIngestConnection
+        shm_connections.set_function(lambda: len(self._connections))
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path) # 前回の起動で残ったソケット
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.path)
+        os.chmod(self.path, self.mode) # listen() する前に絞るので、その前に他のユーザーが接続することはない
+        listener.listen(16)
+        self._listener = listener
+        threading.Thread(target=self._accept_loop, name='shm-ingest', daemon=True).start()
+        logging.info(f"Shared-memory frame ingest listening on {self.path} (mode {self.mode:o}).")
+
+    def _accept_loop(self):
+        while True:
+            sock, _ = self._listener.accept()
+            threading.Thread(target=self._serve, args=(sock,), name='shm-ingest-conn', daemon=True).start()
+
+    def _handshake(self, sock):
+        """最初のメッセージで共有メモリ名を受け取って開く。(リング, リクエスト ID, 送信元) を返し、開けなければエラーを返して None"""
+        try:
+            hello = json.loads(shm_ring.receive_message(sock, max_bytes=4096))
+            ring = shm_ring.Ring.attach(str(hello['ring']))
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            logging.warning(f"Shared-memory ingest handshake failed: {e}")
+            shm_ring.send_message(sock, json.dumps({'ok': False, 'error': str(e)}).encode('utf-8'))
+            return None
+        request_id = request_id_from({REQUEST_ID_HEADER: str(hello.get('request_id') or '')})
+        shm_ring.send_message(sock, json.dumps({'ok': True, 'backend': model.name if model is not None else None,
+                                                'request_id': request_id}).encode('utf-8'))
+        return ring, request_id, str(hello.get('source') or 'shm')[:128]
+
+    def _serve(self, sock):
+        conn = None
+        try:
+            handshake = self._handshake(sock)
+            if handshake is None:
+                return
+            conn = ShmIngestConnection(sock, *handshake)
+            with self._lock:
+                self._connections[conn.id] = conn
+            threading.Thread(target=self._reply_loop, args=(conn,), name='shm-ingest-reply', daemon=True).start()
+            logging.info(f"Shared-memory ingest #{conn.id} opened (ring {conn.ring.name}, {conn.ring.slot_count} slots "
+                         f"of {conn.ring.slot_bytes} bytes, request ID {conn.request_id}).")
+            while True:
+                request_bytes = shm_ring.receive_message(sock, max_bytes=shm_ring.FRAME_REQUEST.size)
+                conn.received += 1
+                self._submit(conn, *shm_ring.FRAME_REQUEST.unpack(request_bytes))
+        except (ConnectionError, OSError):
+            pass
+        except Exception as e:
+            logging.warning(f"Shared-memory ingest connection failed: {e}")
+        finally:
+            if conn is not None:
+                conn.replies.put(None) # 推論中のフレームの応答を返し終えたら送信スレッドが後始末する
             else:
-                 # result.boxes が空、または存在しない場合
-                 message = "No objects detected (result.boxes is empty or None after internal processing)."
-                 logging.info(f"Prediction result for '{file.filename}': {message}")
-        else:
-             # results リスト自体が空か、期待した形式でない場合
-             message = "Prediction executed, but no valid results structure was returned."
-             logging.warning(f"Prediction result for '{file.filename}': {message}")
+                sock.close()
 
-        # --- デバッグ画像の保存 ---
-        if DEBUG_IMAGE_DIR:
+    def _submit(self, conn, seq, slot, width, height):
+        """スロットをコピーせずに推論キューに入れる。推論できないフレームは送信スレッド経由ですぐにエラーを返す"""
+        timer = StageTimer()
+        if model is None:
+            conn.replies.put((seq, None, None, None, (503, {'error': 'Model not loaded or failed to load', 'details': model_load_error})))
+            return
+        try:
+            frame = conn.ring.view(slot, width, height)
+        except ValueError as e:
+            conn.replies.put((seq, None, None, None, (400, {'error': str(e)})))
+            return
+        imgsz = resolution_ladder.current()
+        class_names_dict = model.names
+        try:
+            future = batch_scheduler.submit(frame, imgsz, CONFIDENCE_THRESHOLD)
+        except (OverloadedError, DeadlineExceededError) as e:
+            status, payload, headers = admission_error(e)
+            conn.replies.put((seq, None, None, None, (status, dict(payload, **headers))))
+            return
+        conn.replies.put((seq, frame, (future, imgsz, class_names_dict), timer, None))
+
+    def _reply_loop(self, conn):
+        try:
+            while True:
+                item = conn.replies.get()
+                if item is None:
+                    break
+                seq, frame, pending, timer, error = item
+                if error is None:
+                    try:
+                        body = self._finish(conn, seq, frame, timer, *pending)
+                        status = 200
+                        conn.processed += 1
+                        shm_frames_total.inc('processed')
+                    except Exception as e:
+                        logging.warning(f"Shared-memory ingest #{conn.id} frame {seq} failed: {e}")
+                        error = (500, {'error': str(e)})
+                if error is not None:
+                    status, payload = error
+                    body = json.dumps(payload).encode('utf-8')
+                    if status in (429, 504):
+                        conn.rejected += 1
+                        shm_frames_total.inc('rejected')
+                    else:
+                        conn.errors += 1
+                        shm_frames_total.inc('error')
+                try:
+                    shm_ring.send_message(conn.sock, shm_ring.encode_reply(seq, status, body))
+                except OSError:
+                    pass # クライアントは切断済み。残りのフレームも推論が終わるまで待ってから共有メモリを閉じる
+                item = frame = pending = None # 共有メモリを閉じられるようにスロットへの参照を残さない
+        finally:
+            with self._lock:
+                self._connections.pop(conn.id, None)
+            conn.sock.close()
             try:
-                timestamp = time.strftime("%Y%m%d_%H%M%S")
-                # ファイル名を安全な文字のみにする
-                safe_original_filename = "".join(c if c.isalnum() else "_" for c in os.path.splitext(file.filename)[0])
-
-                if output_data: # 検出結果がある場合
-                    save_filename = f"{timestamp}_{safe_original_filename}_result_simple.jpg" # 新しいファイル名
-                    save_path = os.path.join(DEBUG_IMAGE_DIR, save_filename)
-                    cv2.imwrite(save_path, img_to_draw) # 描画済み画像を保存
-                    logging.info(f"Saved debug image with detections to: {save_path}")
-                else: # 検出結果がない場合
-                    save_filename = f"{timestamp}_{safe_original_filename}_no_detection_simple.jpg" # 新しいファイル名
-                    save_path = os.path.join(DEBUG_IMAGE_DIR, save_filename)
-                    cv2.imwrite(save_path, img_cv2) # 元画像(BGR)を保存
-                    logging.info(f"Saved original image (no detection) to: {save_path}")
-            except Exception as save_e:
-                # 画像保存に失敗してもAPI自体はエラーにしない
-                logging.error(f"Failed to save debug image to '{DEBUG_IMAGE_DIR}': {save_e}", exc_info=True)
+                conn.ring.close()
+            except BufferError:
+                logging.warning(f"Shared-memory ingest #{conn.id}: ring {conn.ring.name} is still referenced; it will be released later.")
+            logging.info(f"Shared-memory ingest #{conn.id} closed: received {conn.received}, processed {conn.processed}, "
+                         f"rejected {conn.rejected}, errors {conn.errors}.")
+
+    def _finish(self, conn, seq, frame, timer, future, imgsz, class_names_dict):
+        """推論結果を待って検出結果の固定レイアウトにする (フレームは元の解像度のまま推論するので scale は 1)"""
+        result = future.result()
+        resolution_ladder.observe(imgsz, timer.mark('inference') * 1000.0)
+        output_data = build_predictions(result, class_names_dict)
+        record_detections(output_data, conn.source, conn.request_id)
+        timer.mark('postprocess')
+        # 応答後にクライアントがスロットを書き換えるため、保存する場合はコピーする
+        debug_writer.submit(frame, output_data, f"shm{conn.id}_{seq}", copy=True, request_id=conn.request_id)
+        timer.mark('debug')
+        body = detection_codec.encode_packed(output_data.to_columns())
+        timer.mark('serialize')
+        return body
+
+    def stats(self):
+        with self._lock:
+            connections = [conn.stats() for conn in self._connections.values()]
+        return {'enabled': self._listener is not None, 'socket': self.path, 'active': len(connections), 'connections': connections}
+
+
+shm_ingest = ShmIngestServer()
+
+
+# --- リクエスト共通の計測 ---
+@app.before_request
+def metrics_before_request():
+    g.request_started = time.perf_counter()
+    g.request_id = request_id_from(request.headers)
+    requests_in_flight.inc()
+
+
+@app.after_request
+def metrics_after_request(response):
+    response.headers[REQUEST_ID_HEADER] = g.request_id
+    endpoint = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    requests_total.inc(endpoint, response.status_code)
+    if response.status_code >= 400:
+        request_errors_total.inc(response.status_code)
+    request_duration_seconds.observe(time.perf_counter() - g.request_started, endpoint)
+    return response
+
+
+@app.teardown_request
+def metrics_teardown_request(exc):
+    if 'request_started' in g:
+        requests_in_flight.dec()
+
+
+# --- /metrics エンドポイント ---
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus 形式で処理段階ごとのヒストグラム・カウンター・ゲージを返す"""
+    worker_info_gauge.set(1, worker_info['index'] if worker_info['index'] is not None else 0, os.getpid())
+    resolution_ladder.accumulate()
+    return Response(metrics_registry.render(), content_type=metrics.CONTENT_TYPE)
 
-        # 正常終了：検出結果を含むJSONを返す
-        return jsonify({'message': message, 'predictions': output_data}), 200
 
+# --- 起動処理 (ウォームアップ) とヘルスチェック ---
+server_ready = threading.Event() # ウォームアップまで終わり、推論を受け付けられる状態
+startup_info = {'timings_seconds': {'imports': round(IMPORTS_SECONDS, 3)}, 'ready_after_seconds': None, 'error': None}
+startup_seconds = metrics_registry.gauge(
+    'goto_startup_seconds', 'Time spent in each startup phase.', ('phase',))
+ready_gauge = metrics_registry.gauge(
+    'goto_ready', '1 when the model is loaded and warmed up.')
+ready_gauge.set_function(lambda: int(server_ready.is_set() and model is not None))
+startup_seconds.set(IMPORTS_SECONDS, 'imports')
+
+
+def run_startup(backend=MODEL_BACKEND, load=True):
+    """
+    モデルのロード (load=True の場合) とウォームアップを行い、終わったら準備完了 (/readyz が 200) にする。
+    起動時間の内訳 (imports / hash / ultralytics_import / weights / fuse / warmup) をログに出す。
+    """
+    if load:
+        load_model(backend)
+    if model is None:
+        logging.warning(f"--- Flask server running BUT YOLO model ({model_name}) failed to load. /readyz will report not ready. ---")
+        logging.warning(f"--- Load Error Details: {model_load_error} ---")
+        return
+    timings = startup_info['timings_seconds']
+    timings.update({phase: round(seconds, 3) for phase, seconds in model.timings.items()})
+    try:
+        batch_sizes = warmup_batch_sizes()
+        warm_up(model, batch_sizes)
     except Exception as e:
-        # 推論・結果処理中の予期せぬエラー
-        logging.error(f"Error during YOLO prediction or result processing for '{file.filename}': {e}", exc_info=True)
-        return jsonify({'error': f'Prediction process failed internally: {e}'}), 500 # Internal Server Error
+        startup_info['error'] = f'Warm-up failed: {e}'
+        logging.error(f"Warm-up inference failed; the server will not report ready: {e}", exc_info=True)
+        return
+    timings['warmup'] = round(model.warmup_ms / 1000.0, 3)
+    for phase, seconds in timings.items():
+        startup_seconds.set(seconds, phase)
+    batch_scheduler.start()
+    debug_writer.start()
+    if detection_history is not None:
+        detection_history.start()
+    startup_info['ready_after_seconds'] = round(time.perf_counter() - STARTUP_STARTED, 3)
+    server_ready.set()
+    breakdown = ', '.join(f"{phase} {seconds:.2f} s" for phase, seconds in timings.items())
+    logging.info(f"Startup timing: {breakdown} (warm-up batch sizes {batch_sizes}); ready after {startup_info['ready_after_seconds']:.2f} s.")
+    logging.info(f"--- YOLO model ({model.model_path}, backend: {model.name}) loaded and warmed up. Ready to accept requests. ---")
+
+
+@app.route('/healthz', methods=['GET'])
+def healthz_endpoint():
+    """生存確認: プロセスが応答できれば 200 (モデルの状態は見ない)"""
+    return jsonify(liveness()), 200
+
+
+@app.route('/readyz', methods=['GET'])
+def readyz_endpoint():
+    """準備完了確認: モデルのロードとウォームアップが終わっていれば 200、それ以外は 503"""
+    payload, status = readiness()
+    return jsonify(payload), status
+
+
+def liveness():
+    return {'status': 'alive', 'uptime_seconds': round(time.perf_counter() - STARTUP_STARTED, 1), 'worker': worker_info}
+
+
+def readiness():
+    """(本体, ステータス) を返す (/readyz と --async で共有)"""
+    if server_ready.is_set() and model is not None:
+        return {'status': 'ready', 'ready_after_seconds': startup_info['ready_after_seconds']}, 200
+    details = model_load_error or startup_info['error']
+    return {'status': 'not_ready' if details else 'starting', 'details': details}, 503
+
+
+# --- /admin エンドポイント ---
+def admin_authorized():
+    """GOTO_ADMIN_TOKEN が設定されていれば X-Admin-Token ヘッダーで、無ければローカルからの接続だけ許可する"""
+    if ADMIN_TOKEN:
+        return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), ADMIN_TOKEN)
+    return request.remote_addr in ('127.0.0.1', '::1')
 
 
-# --- /status エンドポイント (変更なし) ---
+@app.route('/admin/reload', methods=['POST'])
+def admin_reload_endpoint():
+    """
+    best.pt を読み直してモデルを差し替える。既定では裏で実行して 202 を返す。
+    ?wait=1 で完了まで待ち、?force=1 で重みが同じでも読み直す。
+    """
+    if not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    force = is_truthy(request.args.get('force', '0'))
+    if not is_truthy(request.args.get('wait', '0')):
+        threading.Thread(target=model_reloader.reload, kwargs={'force': force}, name='model-reload', daemon=True).start()
+        return jsonify({'status': 'reloading', 'worker': worker_info}), 202
+    reloaded, message = model_reloader.reload(force=force)
+    failed = not reloaded and message.startswith('Model reload failed')
+    return jsonify({
+        'reloaded': reloaded,
+        'message': message,
+        'model': model.describe() if model is not None else None,
+        'worker': worker_info,
+    }), 500 if failed else 200
+
+
+# --- /debug/images エンドポイント (デバッグ画像の検索) ---
+@app.route('/debug/images', methods=['GET'])
+def debug_images_endpoint():
+    """
+    デバッグ画像の索引を検索する (/admin と同じ認可)。
+    ?request_id=<X-Request-ID> で一致するもの、?at=<UNIX 時刻 または ISO 8601>&window=<秒> でその前後のものを近い順に返す。
+    どちらも無ければ新しい順。画像本体は /debug/images/<name> で取得する。
+    """
+    if not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    if debug_writer.archive is None:
+        return jsonify({'error': 'Debug images are disabled'}), 404
+    at = request.args.get('at')
+    try:
+        if at is not None:
+            at = parse_timestamp(at)
+        window = float(request.args.get('window', 60.0))
+        limit = min(1000, max(1, int(request.args.get('limit', 100))))
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query: {e}'}), 400
+    frames = debug_writer.archive.find(request.args.get('request_id'), at, window, limit)
+    for frame in frames:
+        frame['url'] = f"/debug/images/{frame['name']}"
+    return jsonify({'count': len(frames), 'frames': frames}), 200
+
+
+@app.route('/debug/images/<name>', methods=['GET'])
+def debug_image_endpoint(name):
+    """索引に登録されたデバッグ画像を返す (アーカイブ済みのものはアーカイブから読む)"""
+    if not admin_authorized():
+        return jsonify({'error': 'Forbidden'}), 403
+    image = debug_writer.archive.read(name) if debug_writer.archive is not None else None
+    if image is None:
+        return jsonify({'error': f"Unknown debug image '{name}'"}), 404
+    return Response(image, mimetype='image/jpeg')
+
+
+# --- /history エンドポイント (検出結果の履歴の集計) ---
+@app.route('/history', methods=['GET'])
+def history_endpoint():
+    """
+    検出結果の履歴を集計する。範囲は ?start= / ?end= (UNIX 時刻 または ISO 8601, 既定は直近1時間, 1分単位に丸める)。
+    ?source= と ?class_name= で絞り込み、送信元・クラスごとの検出数・平均信頼度・フレームあたりの件数を返す。
+    ?bucket=minute|hour で時系列、?detections=N で個々の検出 (新しい順に N 件) も返す。
+    """
+    if detection_history is None:
+        return jsonify({'error': 'Detection history is disabled'}), 404
+    started = time.perf_counter()
+    try:
+        end = parse_timestamp(request.args['end']) if 'end' in request.args else time.time()
+        start = parse_timestamp(request.args['start']) if 'start' in request.args else end - 3600.0
+        limit = int(request.args.get('detections', 0))
+    except ValueError as e:
+        return jsonify({'error': f'Invalid query: {e}'}), 400
+    bucket = request.args.get('bucket')
+    if start >= end:
+        return jsonify({'error': 'start must be before end'}), 400
+    if bucket is not None and bucket not in DetectionHistory.RESOLUTIONS:
+        return jsonify({'error': f"bucket must be one of {', '.join(DetectionHistory.RESOLUTIONS)}"}), 400
+    if bucket is not None and (end - start) / DetectionHistory.RESOLUTIONS[bucket] > HISTORY_MAX_BUCKETS:
+        return jsonify({'error': f'Range is too long for bucket={bucket} (max {HISTORY_MAX_BUCKETS} buckets)'}), 400
+    source = request.args.get('source')
+    class_name = request.args.get('class_name')
+    payload = {'start': start, 'end': end, 'sources': detection_history.summary(start, end, source, class_name)}
+    if bucket is not None:
+        payload['bucket'] = bucket
+        payload['series'] = detection_history.series(start, end, DetectionHistory.RESOLUTIONS[bucket], source, class_name)
+    if limit > 0:
+        payload['detections'] = detection_history.detections(start, end, source, class_name, min(limit, 10000))
+    payload['query_ms'] = round((time.perf_counter() - started) * 1000.0, 2)
+    return jsonify(payload), 200
+
+
+# --- /status エンドポイント ---
 @app.route('/status', methods=['GET'])
 def status_endpoint():
     """サービスの稼働状態とモデルのロード状態を返す"""
+    payload, status = service_status()
+    return jsonify(payload), status
+
+
+def service_status():
+    """/status の (本体, ステータス) を返す (--async と共有)"""
     if model is not None and model_load_error is None:
         # モデルが正常にロードされている場合
         logging.info("Status check: OK - Model is loaded.")
-        return jsonify({'status': 'ok', 'message': 'Service is running and model is loaded.'}), 200
+        return {
+            'status': 'ok',
+            'message': 'Service is running and model is loaded.',
+            'model': model.describe(),
+            'reload': model_reloader.stats(),
+            'startup': dict(startup_info, ready=server_ready.is_set()),
+            'models': model_registry.stats(),
+            'batching': batch_scheduler.stats(),
+            'resolution': resolution_ladder.stats(),
+            'debug_images': debug_writer.stats(),
+            'history': detection_history.stats() if detection_history is not None else None,
+            'decode': decode_stats.summary(),
+            'cache': result_cache.stats(),
+            'streams': streams_summary(),
+            'shm_ingest': shm_ingest.stats(),
+            'tracking': tracking_sessions.stats(),
+            'frontend': async_frontend.stats() if async_frontend is not None else {'mode': 'flask'},
+            'worker': worker_info,
+        }, 200
     else:
         # モデルのロードに失敗しているか、ロードされていない場合
         logging.warning(f"Status check: ERROR - Model not ready. Load Error: {model_load_error}")
-        return jsonify({
+        return {
             'status': 'error',
             'message': 'Service is not fully operational: Model failed to load or is not available.',
-            'details': model_load_error # エラーの詳細を含める
-            }), 403 # Forbidden または 503 Service Unavailable が適切
+            'details': model_load_error, # エラーの詳細を含める
+            'reload': model_reloader.stats(),
+            }, 403 # Forbidden または 503 Service Unavailable が適切
+
 
+# --- asyncio フロントエンド (--async) ---
+# 受信 (multipart の解析を含む) はイベントループで行い、遅いクライアントがスレッドを占有しないようにする。
+# デコードなどの CPU 処理は CPU コア数のスレッドプールで行い、推論は従来どおりマイクロバッチでまとめる。
+# 対応するのは /predict /status /healthz /readyz /metrics のみ。
+async_pending_requests = metrics_registry.gauge(
+    'goto_async_pending_requests', 'Jobs queued for or running in the --async executor.')
+async_frontend = None
 
-# --- メイン実行ブロック (変更なし) ---
+
+class AsyncRequestView:
+    """aiohttp のリクエストを resolve_model / requested_format などが使う形 (args / form / headers) に合わせる"""
+
+    def __init__(self, request, form):
+        self.args = request.query
+        self.form = form
+        self.headers = request.headers
+
+
+class AsyncFrontend:
+    def __init__(self, workers=ASYNC_EXECUTOR_WORKERS, max_pending=ASYNC_MAX_PENDING, read_timeout=ASYNC_READ_TIMEOUT):
+        self.workers = max(1, int(workers))
+        self.max_pending = max(1, int(max_pending))
+        self.read_timeout = read_timeout
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='inference')
+        self.pending = 0 # イベントループのスレッドだけが変更する
+        self.rejected = collections.Counter()
+        async_pending_requests.set_function(lambda: self.pending)
+
+    def stats(self):
+        return {'mode': 'async', 'executor_workers': self.workers, 'pending': self.pending,
+                'max_pending': self.max_pending, 'rejected': dict(self.rejected)}
+
+    def build_app(self):
+        @web.middleware
+        async def metrics_middleware(request, handler):
+            """Flask 側の before_request / after_request と同じメトリクスを記録する"""
+            started = time.perf_counter()
+            request['started'] = started
+            request['request_id'] = request_id_from(request.headers)
+            requests_in_flight.inc()
+            status = 500
+            try:
+                response = await handler(request)
+                status = response.status
+                response.headers[REQUEST_ID_HEADER] = request['request_id']
+                return response
+            except web.HTTPException as e:
+                status = e.status
+                raise
+            finally:
+                requests_in_flight.dec()
+                route = request.match_info.route.resource
+                endpoint = route.canonical if route is not None else 'unmatched'
+                requests_total.inc(endpoint, status)
+                if status >= 400:
+                    request_errors_total.inc(status)
+                request_duration_seconds.observe(time.perf_counter() - started, endpoint)
+
+        app = web.Application(middlewares=[metrics_middleware], client_max_size=int(UPLOAD_MAX_MB * 1024 * 1024))
+        app.router.add_post('/predict', self.predict)
+        app.router.add_get('/status', self.status)
+        app.router.add_get('/healthz', self.healthz)
+        app.router.add_get('/readyz', self.readyz)
+        app.router.add_get('/metrics', self.metrics)
+        return app
+
+    @staticmethod
+    def json(payload, status=200, headers=None):
+        body = json.dumps(payload, ensure_ascii=False, separators=(',', ':'))
+        return web.Response(text=body, status=status, content_type='application/json', headers=headers)
+
+    async def read_form(self, request):
+        """
+        multipart/form-data をイベントループ上で読み、(フォームの値, (ファイル名, 'image' のバイト列) または None) を返す。
+        画素をそのまま送ったリクエスト (application/octet-stream) は本体全体を画像とする。
+        """
+        form = {}
+        upload = None
+        if request.content_type == detection_codec.RAW_MEDIA_TYPE:
+            return form, (RAW_UPLOAD_FILENAME, await request.read())
+        if not request.content_type.startswith('multipart/'):
+            return form, upload
+        reader = await request.multipart()
+        async for part in reader:
+            if part.name == 'image' and upload is None:
+                upload = (part.filename or '', bytes(await part.read()))
+            elif part.filename is None:
+                form[part.name] = await part.text()
+            else:
+                await part.release()
+        return form, upload
+
+    def reject(self, reason, error):
+        self.rejected[reason] += 1
+        status, payload, headers = admission_error(error)
+        return self.json(payload, status, headers)
+
+    async def predict(self, request):
+        timer = StageTimer()
+        try:
+            form, upload = await asyncio.wait_for(self.read_form(request), self.read_timeout)
+        except asyncio.TimeoutError:
+            return self.json({'error': f'Request body was not received within {self.read_timeout:.0f} seconds'}, 408)
+        except ValueError as e:
+            return self.json({'error': f'Malformed multipart body: {e}'}, 400)
+        view = AsyncRequestView(request, form)
+        try:
+            # 名前付きモデルはロードに時間がかかることがあるのでスレッドで選ぶ
+            active_model, backend = await self.run_in_executor(lambda: resolve_model(view))
+        except Exception as e:
+            if isinstance(e, KeyError):
+                return self.json({'error': f"Unknown model '{e.args[0]}'", 'available': [DEFAULT_MODEL_NAME] + model_registry.available()}, 404)
+            logging.error(f"Failed to load named model: {e}", exc_info=True)
+            return self.json({'error': f'Failed to load model: {e}'}, 503)
+        if active_model is None:
+            logging.error("Prediction attempt failed: Model is not loaded.")
+            return self.json({'error': 'Model not loaded or failed to load', 'details': model_load_error}, 503)
+        if upload is None:
+            logging.warning("Request rejected: No 'image' file part found in the request.")
+            return self.json({'error': 'No image file provided in the request'}, 400)
+        filename, img_bytes = upload
+        if filename == '':
+            logging.warning("Request rejected: No file selected (empty filename).")
+            return self.json({'error': 'No file selected'}, 400)
+        try:
+            response_format = requested_format(view)
+            tiling = requested_tiling(view)
+            deadline = request_deadline(request.headers, request['started'])
+            raw = raw_upload(img_bytes, request.headers, tiling, active_model) if request.content_type == detection_codec.RAW_MEDIA_TYPE else None
+        except ValueError as e:
+            return self.json({'error': str(e)}, 400)
+        media_type = best_media_type(request.headers.get('Accept'))
+        timer.mark('read')
+
+        # スレッドプールの順番待ちも推論キューに並んでいるとみなして受け付けを判断する
+        if self.pending >= self.max_pending:
+            return self.reject('pending', OverloadedError(
+                f"Too many requests waiting for the inference executor ({self.pending}/{self.max_pending})",
+                1, batch_scheduler.queue_depth(), batch_scheduler.projected_wait_ms()))
+        try:
+            batch_scheduler.check_admission(1 + max(0, self.pending - self.workers), deadline)
+        except (OverloadedError, DeadlineExceededError) as e:
+            return self.reject('admission', e)
+
+        upload = UploadPrediction(img_bytes, filename, active_model, backend, tiling, deadline, timer, request['request_id'],
+                                  request_source(request.headers, request.query, request.remote), raw)
+        key = upload.cache_key()
+        cache_status, handle = result_cache.begin(key, cache_bypass_requested(request.headers))
+        try:
+            if cache_status == 'hit':
+                output_data = handle
+            elif cache_status == 'coalesced':
+                output_data = await asyncio.wrap_future(handle)
+            else:
+                try:
+                    output_data = await self.compute(upload)
+                except BaseException as e:
+                    result_cache.finish(key, handle, error=e)
+                    raise
+                result_cache.finish(key, handle, output_data)
+            message, cache_status = upload.respond(output_data, cache_status)
+        except Exception as e:
+            status, payload, headers = predict_error(e, filename)
+            return self.json(payload, status, headers)
+        body, content_type, headers = encode_detections(message, output_data, response_format, media_type, timer, upload.imgsz)
+        headers['Content-Type'] = content_type
+        headers['X-Cache'] = cache_status.upper()
+        return web.Response(body=body, status=200, headers=headers)
+
+    async def compute(self, upload):
+        """
+        デコード (と分割推論) はスレッドプールで、推論の完了待ちはイベントループで行う。
+        推論を待つ間はスレッドを使わないので、スレッド数がコア数でもマイクロバッチが埋まる。
+        """
+        await self.run_in_executor(upload.decode)
+        if upload.tiling:
+            return await self.run_in_executor(upload.tiled)
+        result = await asyncio.wrap_future(upload.submit())
+        return upload.predicted(result)
+
+    async def run_in_executor(self, fn):
+        loop = asyncio.get_running_loop()
+        future = self.executor.submit(fn)
+        self.pending += 1
+        # クライアントが切断してもスレッド側の処理は最後まで行われるので、終わったときに数を戻す
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(self._finished))
+        return await asyncio.wrap_future(future)
+
+    def _finished(self):
+        self.pending -= 1
+
+    async def status(self, request):
+        payload, status = service_status()
+        return self.json(payload, status)
+
+    async def healthz(self, request):
+        return self.json(liveness())
+
+    async def readyz(self, request):
+        payload, status = readiness()
+        return self.json(payload, status)
+
+    async def metrics(self, request):
+        worker_info_gauge.set(1, worker_info['index'] if worker_info['index'] is not None else 0, os.getpid())
+        resolution_ladder.accumulate()
+        return web.Response(text=metrics_registry.render(), headers={'Content-Type': metrics.CONTENT_TYPE})
+
+
+def run_async_server(workers=ASYNC_EXECUTOR_WORKERS, max_pending=ASYNC_MAX_PENDING):
+    """aiohttp で /predict などを待ち受ける (終了するまで戻らない)"""
+    global async_frontend
+    async_frontend = AsyncFrontend(workers, max_pending)
+    logging.info(f"Starting asyncio server on host 0.0.0.0, port {SERVER_PORT} "
+                 f"({async_frontend.workers} executor threads, up to {async_frontend.max_pending} pending requests)...")
+    web.run_app(async_frontend.build_app(), host='0.0.0.0', port=SERVER_PORT,
+                keepalive_timeout=ASYNC_KEEPALIVE_TIMEOUT, print=None)
+
+
+# --- プリフォーク (マルチプロセス) 実行 ---
+worker_info = {'index': None, 'pid': os.getpid(), 'workers': 1, 'intra_op_threads': None}
+
+
+def configure_worker_threads(threads):
+    """1プロセスあたりの torch / OpenCV のスレッド数を制限してコアの奪い合いを防ぐ"""
+    import torch
+    torch.set_num_threads(threads)
+    cv2.setNumThreads(threads)
+    worker_info['intra_op_threads'] = threads
+
+
+def run_worker(index, listen_socket, threads):
+    """
+    fork された子プロセス: 共有ソケットで Flask (werkzeug) サーバーを動かす。
+    SIGTERM を受けたら新しい接続の受け付けをやめ、処理中のリクエストが終わってから
+    (WORKER_SHUTDOWN_TIMEOUT より少し短い時間まで待つ) バッチスケジューラとモデルの監視を止めて戻る。
+    """
+    from werkzeug.serving import make_server
+    signal.signal(signal.SIGTERM, signal.SIG_DFL) # サーバーができる前なら、そのまま終了してよい
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # Ctrl+C は親 (スーパーバイザ) が処理する
+    worker_info.update(index=index, pid=os.getpid())
+    configure_worker_threads(threads)
+    # スレッドは fork を越えて引き継がれないため、子プロセスで起動する。
+    # ウォームアップも fork 後に各ワーカーで行う (親で推論すると torch のスレッドプールが子で壊れることがある)
+    threading.Thread(target=run_startup, kwargs={'load': False}, name='startup', daemon=True).start()
+    model_reloader.start() # ワーカーごとにモデルを持つため、監視も各ワーカーで行う
+    logging.info(f"Worker {index} (pid {os.getpid()}) serving on port {SERVER_PORT} with {threads} intra-op threads.")
+    server = make_server('0.0.0.0', SERVER_PORT, app, threaded=True, fd=listen_socket.fileno())
+
+    def request_shutdown(signum, frame):
+        # shutdown() は serve_forever() が戻るまで待つため、シグナルハンドラ (メインスレッド) からは直接呼べない
+        threading.Thread(target=server.shutdown, name='shutdown', daemon=True).start()
+
+    signal.signal(signal.SIGTERM, request_shutdown)
+    server.serve_forever()
+
+    # 親は WORKER_SHUTDOWN_TIMEOUT で SIGKILL するため、その前に終わるよう余裕を残す
+    deadline = time.monotonic() + max(0.0, WORKER_SHUTDOWN_TIMEOUT - 1.0)
+    if requests_in_flight.value():
+        logging.info(f"Worker {index} waiting for {requests_in_flight.value()} in-flight requests to finish...")
+    while requests_in_flight.value() > 0 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    if requests_in_flight.value():
+        logging.warning(f"Worker {index} exiting with {requests_in_flight.value()} requests still in flight.")
+    model_reloader.stop(max(0.0, deadline - time.monotonic()))
+    batch_scheduler.stop(max(0.0, deadline - time.monotonic()))
+    logging.info(f"Worker {index} (pid {os.getpid()}) stopped.")
+
+
+def run_prefork(workers):
+    """
+    モデルを読み込んだ親プロセスから workers 個の子プロセスを fork し、監視する。
+    重みは copy-on-write で共有され、待ち受けソケットも全ワーカーで共有する。
+    クラッシュしたワーカーは (連続クラッシュ時は待ち時間を伸ばしながら) 再起動する。
+    """
+    if not hasattr(os, 'fork'):
+        logging.warning("Prefork mode requires os.fork (not available on this platform). Falling back to a single process.")
+        return False
+
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    worker_info.update(workers=workers, intra_op_threads=threads)
+
+    listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listen_socket.bind(('0.0.0.0', SERVER_PORT))
+    listen_socket.listen(128)
+    listen_socket.set_inheritable(True)
+
+    # 親プロセスのオブジェクトを GC 対象から外し、子での参照カウント以外の書き込み (COW 解除) を減らす
+    gc.collect()
+    gc.freeze()
+
+    children = {} # pid -> worker index
+    crash_counts = collections.Counter()
+    stopping = False
+
+    def spawn(index):
+        pid = os.fork()
+        if pid == 0:
+            exit_code = 0
+            try:
+                run_worker(index, listen_socket, threads)
+            except BaseException as worker_error:
+                logging.critical(f"Worker {index} exited with error: {worker_error}", exc_info=True)
+                exit_code = 1
+            finally:
+                os._exit(exit_code)
+        children[pid] = (index, time.monotonic())
+        return pid
+
+    def request_stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    logging.info(f"Starting {workers} prefork workers on port {SERVER_PORT} ({threads} intra-op threads each)...")
+    for index in range(workers):
+        spawn(index)
+
+    restart_at = {} # worker index -> 再起動予定時刻
+    while not stopping:
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            pid, status = 0, 0
+        if pid and pid in children:
+            index, started_at = children.pop(pid)
+            uptime = time.monotonic() - started_at
+            # 起動直後のクラッシュが続く場合は待ち時間を倍々に伸ばす
+            crash_counts[index] = crash_counts[index] + 1 if uptime < WORKER_MIN_UPTIME else 0
+            delay = min(WORKER_RESTART_BACKOFF_MAX, 0.5 * (2 ** (crash_counts[index] - 1))) if crash_counts[index] else 0.0
+            logging.error(f"Worker {index} (pid {pid}) exited with status {status} after {uptime:.1f}s. Restarting in {delay:.1f}s.")
+            restart_at[index] = time.monotonic() + delay
+        for index, due in list(restart_at.items()):
+            if time.monotonic() >= due:
+                del restart_at[index]
+                spawn(index)
+        if not pid:
+            time.sleep(0.2)
+
+    logging.info(f"Shutting down {len(children)} workers...")
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+    deadline = time.monotonic() + WORKER_SHUTDOWN_TIMEOUT
+    while children and time.monotonic() < deadline:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break
+        if pid:
+            children.pop(pid, None)
+        else:
+            time.sleep(0.1)
+    for pid in children:
+        logging.warning(f"Worker pid {pid} did not exit in time, killing it.")
+        try:
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+        except (ProcessLookupError, ChildProcessError):
+            pass
+    listen_socket.close()
+    logging.info("All workers stopped.")
+    return True
+
+
+# python Server.py として起動した場合はコマンドライン引数を反映してから main でロードする
+if __name__ != '__main__':
+    run_startup()
+
+
+# --- メイン実行ブロック ---
 if __name__ == '__main__':
-    # サーバー起動前のモデルロード状態ログ
-    if model is None:
-        # model_name が定義されているか確認してから表示
-        model_path_display = model_name if 'model_name' in locals() else "N/A"
-        logging.warning(f"--- Flask server starting BUT YOLO model ({model_path_display}) failed to load. The /predict endpoint will return errors. ---")
-        logging.warning(f"--- Load Error Details: {model_load_error} ---")
-    else:
-        logging.info(f"--- Flask server starting with YOLO model ({model_name}) loaded successfully. Ready to accept requests. ---")
+    parser = argparse.ArgumentParser(description="YOLO 推論サーバー")
+    parser.add_argument('--batch-size', type=int, default=BATCH_MAX_SIZE, metavar='N',
+                        help=f"1回の推論にまとめる最大画像数 (1 でバッチ化無効, デフォルト: {BATCH_MAX_SIZE})")
+    parser.add_argument('--batch-wait-ms', type=float, default=BATCH_MAX_WAIT_MS, metavar='MS',
+                        help=f"バッチが埋まるのを待つ最大時間 (ミリ秒, デフォルト: {BATCH_MAX_WAIT_MS})")
+    parser.add_argument('--queue-max', type=int, default=INFERENCE_QUEUE_MAX, metavar='N',
+                        help=f"推論待ちキューの最大画像数, 超えたら 429 (デフォルト: {INFERENCE_QUEUE_MAX})")
+    parser.add_argument('--max-queue-wait-ms', type=float, default=ADMISSION_MAX_WAIT_MS, metavar='MS',
+                        help=f"予測キュー待ち時間がこれを超えたら 429 (0 で無効, デフォルト: {ADMISSION_MAX_WAIT_MS})")
+    parser.add_argument('--no-reduced-decode', action='store_true',
+                        help="大きな JPEG の縮小デコードを無効にし、常にフル解像度でデコードする")
+    parser.add_argument('--cache-mb', type=float, default=RESULT_CACHE_MAX_MB, metavar='MB',
+                        help=f"推論結果キャッシュのメモリ上限 (0 で無効, デフォルト: {RESULT_CACHE_MAX_MB})")
+    parser.add_argument('--cache-ttl', type=float, default=RESULT_CACHE_TTL, metavar='SEC',
+                        help=f"推論結果キャッシュの有効期間 (秒, デフォルト: {RESULT_CACHE_TTL})")
+    parser.add_argument('--debug-sample', choices=DEBUG_SAMPLE_MODES, default=DEBUG_SAMPLE_MODE,
+                        help=f"デバッグ画像を保存するフレームの選び方 (デフォルト: {DEBUG_SAMPLE_MODE})")
+    parser.add_argument('--debug-every-n', type=int, default=DEBUG_SAMPLE_EVERY_N, metavar='N',
+                        help=f"every_n モードで N リクエストに1枚保存 (デフォルト: {DEBUG_SAMPLE_EVERY_N})")
+    parser.add_argument('--debug-low-conf', type=float, default=DEBUG_LOW_CONFIDENCE, metavar='CONF',
+                        help=f"low_confidence モードの信頼度上限 (デフォルト: {DEBUG_LOW_CONFIDENCE})")
+    parser.add_argument('--debug-queue-size', type=int, default=DEBUG_QUEUE_SIZE, metavar='N',
+                        help=f"保存待ちキューの上限, 満杯時は破棄 (デフォルト: {DEBUG_QUEUE_SIZE})")
+    parser.add_argument('--debug-max-mb', type=float, default=DEBUG_MAX_MB, metavar='MB',
+                        help=f"デバッグ画像 (アーカイブを含む) の合計サイズの上限, 超えたら古いものから消す (0 で無制限, デフォルト: {DEBUG_MAX_MB})")
+    parser.add_argument('--debug-max-files', type=int, default=DEBUG_MAX_FILES, metavar='N',
+                        help=f"デバッグ画像 (アーカイブを含む) の枚数の上限 (0 で無制限, デフォルト: {DEBUG_MAX_FILES})")
+    parser.add_argument('--debug-max-age-hours', type=float, default=DEBUG_MAX_AGE_HOURS, metavar='HOURS',
+                        help=f"デバッグ画像を残す期間 (時間, 0 で無制限, デフォルト: {DEBUG_MAX_AGE_HOURS})")
+    parser.add_argument('--no-debug-archive', action='store_true',
+                        help="過ぎた時間帯のデバッグ画像を1時間ごとの zip にまとめず、個別のファイルのまま残す")
+    parser.add_argument('--history-db', default=HISTORY_DB_PATH, metavar='PATH',
+                        help=f"検出結果の履歴 (SQLite) の保存先 (デフォルト: {HISTORY_DB_PATH})")
+    parser.add_argument('--no-history', action='store_true',
+                        help="検出結果を履歴に記録しない (/history は 404)")
+    parser.add_argument('--track-max-sessions', type=int, default=TRACK_MAX_SESSIONS, metavar='N',
+                        help=f"/track の同時セッション数の上限 (デフォルト: {TRACK_MAX_SESSIONS})")
+    parser.add_argument('--track-timeout', type=float, default=TRACK_SESSION_TIMEOUT, metavar='SEC',
+                        help=f"フレームが来ない /track セッションを破棄するまでの時間 (秒, デフォルト: {TRACK_SESSION_TIMEOUT})")
+    parser.add_argument('--backend', choices=sorted(MODEL_BACKENDS), default=MODEL_BACKEND,
+                        help=f"推論バックエンド (onnx は初回起動時に best.pt を変換してキャッシュする, "
+                             f"stub はモデルを使わず固定の検出結果を返す負荷試験用, デフォルト: {MODEL_BACKEND})")
+    parser.add_argument('--stub-latency-ms', type=float, default=STUB_LATENCY_MS, metavar='MS',
+                        help=f"stub バックエンドの1バッチあたりの模擬推論時間 (ミリ秒, デフォルト: {STUB_LATENCY_MS})")
+    parser.add_argument('--model-dir', default=MODEL_DIR, metavar='DIR',
+                        help=f"?model=<name> で使う <name>.pt の置き場所 (Server.py からの相対パス, デフォルト: {MODEL_DIR})")
+    parser.add_argument('--model-memory-mb', type=float, default=MODEL_MEMORY_BUDGET_MB, metavar='MB',
+                        help=f"名前付きモデルの合計メモリ上限, 超えたら使われていない順に解放 (デフォルト: {MODEL_MEMORY_BUDGET_MB})")
+    parser.add_argument('--watch-interval', type=float, default=MODEL_WATCH_INTERVAL, metavar='SEC',
+                        help=f"best.pt の更新を確認してホットリロードする間隔 (秒, 0 で監視しない, デフォルト: {MODEL_WATCH_INTERVAL})")
+    parser.add_argument('--adaptive-resolution', action='store_true', default=RESOLUTION_ADAPTIVE,
+                        help="負荷に応じて推論解像度を --resolution-levels の中で切り替える (混雑時は下げ、余裕があれば上げる)")
+    parser.add_argument('--resolution-levels', type=int, nargs='+', default=list(RESOLUTION_LEVELS), metavar='PX',
+                        help=f"切り替える推論解像度 (デフォルト: {' '.join(map(str, RESOLUTION_LEVELS))})")
+    parser.add_argument('--latency-target-ms', type=float, default=RESOLUTION_TARGET_MS, metavar='MS',
+                        help=f"--adaptive-resolution で保つ1枚あたりのキュー待ち + 推論時間 (ミリ秒, デフォルト: {RESOLUTION_TARGET_MS})")
+    parser.add_argument('--async', dest='serve_async', action='store_true',
+                        help="Flask の代わりに asyncio (aiohttp) で待ち受ける (/predict /status /healthz /readyz /metrics のみ, pip install aiohttp)")
+    parser.add_argument('--async-workers', type=int, default=ASYNC_EXECUTOR_WORKERS, metavar='N',
+                        help=f"--async でデコードなどの CPU 処理を行うスレッド数 (デフォルト: CPU コア数 = {ASYNC_EXECUTOR_WORKERS})")
+    parser.add_argument('--async-max-pending', type=int, default=ASYNC_MAX_PENDING, metavar='N',
+                        help=f"--async で処理待ちにできるリクエスト数, 超えたら 429 (デフォルト: {ASYNC_MAX_PENDING})")
+    parser.add_argument('--shm-ingest', action='store_true', default=SHM_INGEST,
+                        help="同じホストのクライアントから共有メモリ経由で生の BGR フレームを受け取る (プロトコルは shm_ring.py)")
+    parser.add_argument('--shm-socket', default=SHM_SOCKET_PATH, metavar='PATH',
+                        help=f"--shm-ingest で待ち受ける Unix ドメインソケットのパス (デフォルト: {SHM_SOCKET_PATH})")
+    parser.add_argument('--shm-socket-mode', type=lambda value: int(value, 8), default=SHM_SOCKET_MODE, metavar='OCTAL',
+                        help=f"--shm-ingest のソケットのパーミッション (8進数)。接続できるユーザーはサーバーに任意の共有メモリを開かせて推論させられるため、"
+                             f"別のユーザーのクライアントを許可するときはグループを揃えて 660 にする (デフォルト: {SHM_SOCKET_MODE:o})")
+    parser.add_argument('--workers', type=int, default=1, metavar='N',
+                        help="N 個のワーカープロセスを fork して同じポートで待ち受ける (POSIX のみ, デフォルト: 1)")
+    args = parser.parse_args()
+    if args.serve_async and web is None:
+        parser.error("--async requires aiohttp (pip install aiohttp)")
+    if args.serve_async and args.workers > 1:
+        parser.error("--async cannot be combined with --workers")
+    if args.shm_ingest and args.workers > 1:
+        parser.error("--shm-ingest cannot be combined with --workers")
+    batch_scheduler.max_batch_size = max(1, args.batch_size)
+    batch_scheduler.max_wait_ms = max(0.0, args.batch_wait_ms)
+    batch_scheduler.max_queue_depth = max(1, args.queue_max)
+    batch_scheduler.max_queue_wait_ms = max(0.0, args.max_queue_wait_ms)
+    JPEG_REDUCED_DECODE = not args.no_reduced_decode
+    STUB_LATENCY_MS = max(0.0, args.stub_latency_ms)
+    result_cache.max_bytes = int(max(0.0, args.cache_mb) * 1024 * 1024)
+    result_cache.ttl = max(0.0, args.cache_ttl)
+    model_reloader.backend = args.backend
+    model_registry.backend = args.backend
+    model_registry.directory = os.path.normpath(os.path.join(script_dir, args.model_dir))
+    model_registry.budget_bytes = int(max(0.0, args.model_memory_mb) * 1024 * 1024)
+    model_reloader.interval = max(0.0, args.watch_interval)
+    tracking_sessions.max_sessions = max(1, args.track_max_sessions)
+    resolution_ladder.enabled = args.adaptive_resolution
+    resolution_ladder.target_ms = max(1.0, args.latency_target_ms)
+    try:
+        resolution_ladder.set_levels(args.resolution_levels)
+    except ValueError as e:
+        parser.error(f"--resolution-levels: {e}")
+    tracking_sessions.timeout = max(1.0, args.track_timeout)
+    if args.no_history:
+        detection_history = None
+    elif detection_history is not None:
+        detection_history.path = args.history_db
+    debug_writer.configure(mode=args.debug_sample, every_n=args.debug_every_n,
+                           low_confidence=args.debug_low_conf, queue_size=args.debug_queue_size,
+                           max_mb=args.debug_max_mb, max_files=args.debug_max_files,
+                           max_age_hours=args.debug_max_age_hours, archive=not args.no_debug_archive)
+
+    # モデルロード (プリフォーク時は fork 前の親プロセスで一度だけ行う)
+    preloaded = False
+    if args.workers > 1:
+        # プリフォークモード: fork 前の親プロセスでモデルを一度だけロードし、ワーカーが終了するまでここでブロックする
+        load_model(args.backend)
+        preloaded = True
+        if run_prefork(args.workers):
+            raise SystemExit(0)
+
+    # モデルのロードとウォームアップは裏で行い、その間も /healthz と /readyz に応答する
+    threading.Thread(target=run_startup, args=(args.backend, not preloaded), name='startup', daemon=True).start()
+    model_reloader.start() # モデルのロードに失敗していても、best.pt が置かれればロードする
+    if args.shm_ingest:
+        shm_ingest.path = args.shm_socket
+        shm_ingest.mode = args.shm_socket_mode
+        shm_ingest.start()
+
+    if args.serve_async:
+        run_async_server(args.async_workers, args.async_max_pending)
+        raise SystemExit(0)
 
     # Flaskサーバー起動
     logging.info(f"Starting Flask server on host 0.0.0.0, port {SERVER_PORT}...")
@@ -272,4 +3379,4 @@ if __name__ == '__main__':
         app.run(host='0.0.0.0', port=SERVER_PORT, debug=False, threaded=True)
     except Exception as run_error:
         # サーバー起動自体に失敗した場合
-        logging.critical(f"Failed to start Flask server: {run_error}", exc_info=True)
\ No newline at end of file
+        logging.critical(f"Failed to start Flask server: {run_error}", exc_info=True)
@@ -0,0 +1,90 @@
+import json
+import time
+import argparse
+
+import numpy as np
+
+import detection_codec
+
+# /predict のレスポンス形式ごとのエンコード時間とサイズを比較する
+# 検出結果はランダムに作るので、モデルやサーバーは不要
+
+DEFAULT_COUNTS = (0, 1, 10, 50, 300)
+DEFAULT_RUNS = 2000
+CLASS_NAMES = {0: 'zombie', 1: 'skeleton', 2: 'creeper', 3: 'spider', 4: 'enderman'}
+
+
+def synthetic_columns(count, rng):
+    """Server.py の Detections.to_columns() と同じ形の検出結果を作る"""
+    class_ids = rng.integers(0, len(CLASS_NAMES), count).tolist()
+    x1y1 = rng.uniform(0, 1800, (count, 2))
+    wh = rng.uniform(10, 300, (count, 2))
+    return {
+        'class_id': class_ids,
+        'conf': rng.uniform(0.1, 1.0, count).tolist(),
+        'xyxy': np.hstack([x1y1, x1y1 + wh]).tolist(),
+        'names': {str(class_id): CLASS_NAMES[class_id] for class_id in class_ids},
+    }
+
+
+def to_objects(columns):
+    """Server.py の Detections.to_objects() と同じ従来形式"""
+    return [
+        {'class_id': class_id, 'class_name': CLASS_NAMES[class_id], 'confidence': conf,
+         'box': {'x1': box[0], 'y1': box[1], 'x2': box[2], 'y2': box[3]}}
+        for class_id, conf, box in zip(columns['class_id'], columns['conf'], columns['xyxy'])
+    ]
+
+
+def dump_json(payload):
+    # Server.py の json_response と同じ設定
+    return json.dumps(payload, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def measure(encode, runs):
+    encode() # 初回の準備コストを除く
+    start = time.perf_counter()
+    for _ in range(runs):
+        body = encode()
+    return (time.perf_counter() - start) / runs * 1e6, len(body)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="検出結果のレスポンス形式 (JSON / バイナリ) のエンコード時間とサイズを比較する")
+    parser.add_argument('--counts', type=int, nargs='+', default=list(DEFAULT_COUNTS), metavar='N',
+                        help=f"1フレームあたりの検出数 (デフォルト: {' '.join(map(str, DEFAULT_COUNTS))})")
+    parser.add_argument('--runs', type=int, default=DEFAULT_RUNS, metavar='N', help=f"形式ごとの計測回数 (デフォルト: {DEFAULT_RUNS})")
+    parser.add_argument('--seed', type=int, default=0, help="乱数シード (デフォルト: 0)")
+    args = parser.parse_args()
+
+    if detection_codec.msgpack is None:
+        print("[警告] msgpack がインストールされていないため MessagePack は計測しません (pip install msgpack)")
+
+    rng = np.random.default_rng(args.seed)
+    print(f"{'検出数':>6} {'形式':<16} {'エンコード(us)':>14} {'サイズ(byte)':>12} {'JSON比':>8}")
+    for count in args.counts:
+        columns = synthetic_columns(count, rng)
+        message = f"Detected {count} objects."
+        encoders = [
+            ('json', lambda: dump_json({'message': message, 'predictions': to_objects(columns)})),
+            ('json-columnar', lambda: dump_json({'message': message, 'predictions': columns})),
+            ('packed', lambda: detection_codec.encode_packed(columns)),
+        ]
+        if detection_codec.msgpack is not None:
+            encoders.append(('msgpack-columnar', lambda: detection_codec.encode_msgpack({'message': message, 'predictions': columns})))
+
+        # 往復して値が保たれることを確認 (座標は float32 に丸められる)
+        decoded = detection_codec.decode_packed(detection_codec.encode_packed(columns))
+        assert decoded['class_id'].tolist() == columns['class_id']
+        assert np.allclose(decoded['xyxy'], np.asarray(columns['xyxy']).reshape(-1, 4), atol=1e-3)
+
+        baseline_size = None
+        for label, encode in encoders:
+            encode_us, size = measure(encode, args.runs)
+            baseline_size = baseline_size or size
+            print(f"{count:>6} {label:<16} {encode_us:>14.1f} {size:>12} {size / baseline_size:>7.2f}x")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
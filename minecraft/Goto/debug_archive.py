@@ -0,0 +1,312 @@
+import os
+import re
+import time
+import sqlite3
+import zipfile
+import threading
+
+try:
+    import fcntl # 複数のワーカープロセスで同時に整理しないためのファイルロック (POSIX のみ)
+except ImportError:
+    fcntl = None
+
+# デバッグ画像の保存期間・容量の管理と、1時間ごとのアーカイブ (Server.py の DebugImageWriter が使う)
+# - 保存した画像はすべて索引 (SQLite) に記録し、リクエスト ID と撮影時刻で引けるようにする
+# - 過ぎた時間帯 (1時間単位) の画像は <directory>/archive/YYYYMMDD_HH.zip にまとめて個別のファイルを消す
+#   (JPEG はそれ以上ほとんど縮まないため無圧縮で格納する。既にアーカイブ済みの時間帯に後から来た分は YYYYMMDD_HH-2.zip, ... に入れる)
+# - 合計サイズ・ファイル数・保存期間の上限を超えたら古いものから消す (アーカイブ済みの画像は1時間分のまとめ単位)
+
+INDEX_NAME = 'index.sqlite'
+ARCHIVE_DIR = 'archive'
+LOCK_NAME = '.maintenance.lock'
+SHARD_FORMAT = '%Y%m%d_%H' # アーカイブのファイル名 (ローカル時刻の時間帯)
+FILENAME_TIME = re.compile(r'^(\d{8}_\d{6})_') # DebugImageWriter のファイル名の先頭の時刻
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS frames (
+    name        TEXT PRIMARY KEY, -- ファイル名 (アーカイブ内でも同じ名前)
+    request_id  TEXT,             -- 索引を作る前から残っていた画像は NULL
+    captured_at REAL NOT NULL,    -- リクエストを受け取った時刻 (UNIX 時刻)
+    bytes       INTEGER NOT NULL,
+    shard       TEXT              -- アーカイブのファイル名 (NULL はまだ個別のファイル)
+);
+CREATE INDEX IF NOT EXISTS frames_request_id ON frames (request_id);
+CREATE INDEX IF NOT EXISTS frames_captured_at ON frames (captured_at);
+CREATE INDEX IF NOT EXISTS frames_shard ON frames (shard);
+"""
+
+
+def shard_name(captured_at):
+    return time.strftime(SHARD_FORMAT, time.localtime(captured_at)) + '.zip'
+
+
+def hour_start(now):
+    """now を含む時間帯 (ローカル時刻) の開始時刻"""
+    local = time.localtime(now)
+    return time.mktime(local[:4] + (0, 0) + local[6:8] + (-1,))
+
+
+class DebugArchive:
+    """
+    デバッグ画像の索引・アーカイブ・削除。record() は保存スレッドから、maintain() は整理スレッドから呼ぶ。
+    max_bytes / max_files / max_age (秒) は 0 で無制限。batch_limit は1回の maintain() で扱う画像の数の上限。
+    """
+
+    def __init__(self, directory, max_bytes=0, max_files=0, max_age=0.0, archive=True, batch_limit=5000):
+        self.directory = directory
+        self.batch_limit = max(1, int(batch_limit)) # 1回の maintain() の各段階で扱う画像の上限
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.max_age = max_age
+        self.archive = archive
+        self._db = None
+        self._db_pid = None
+        self._lock = threading.Lock()
+        self.counters = {'archived': 0, 'shards_written': 0, 'deleted_files': 0, 'deleted_shards': 0, 'maintenance_runs': 0}
+        self.last_maintenance = None
+
+    @property
+    def archive_dir(self):
+        return os.path.join(self.directory, ARCHIVE_DIR)
+
+    def _connection(self):
+        # fork 前に開いた接続は子プロセスで使えないため、プロセスごとに開く
+        if self._db is None or self._db_pid != os.getpid():
+            db = sqlite3.connect(os.path.join(self.directory, INDEX_NAME), timeout=10.0, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.executescript(SCHEMA)
+            self._db, self._db_pid = db, os.getpid()
+        return self._db
+
+    def record(self, path, request_id, captured_at):
+        """
+        保存した画像を索引に登録する。同じ名前が既に登録されていれば sqlite3.IntegrityError
+        (整理スレッドが書き込み直後の画像を先に未登録分として拾った行だけは、この画像のものとして引き継ぐ)
+        """
+        name = os.path.basename(path)
+        with self._lock:
+            db = self._connection()
+            with db:
+                cursor = db.execute("""
+                    INSERT INTO frames (name, request_id, captured_at, bytes, shard) VALUES (?, ?, ?, ?, NULL)
+                    ON CONFLICT (name) DO UPDATE SET request_id = excluded.request_id, captured_at = excluded.captured_at
+                    WHERE frames.request_id IS NULL AND frames.shard IS NULL
+                """, (name, request_id, captured_at, os.path.getsize(path)))
+                if cursor.rowcount == 0:
+                    raise sqlite3.IntegrityError(f"Debug image '{name}' is already indexed")
+
+    # --- 整理 (アーカイブと削除) ---
+    # self._lock は SQLite の読み書きの間だけ持つ (ディレクトリの走査・アーカイブの書き込み・削除の間は
+    # 保存スレッドや /debug/images, /status を止めない)。1回の maintain() で扱うのは各段階 batch_limit 件までで、
+    # 溜まっていた分は何回かに分けて片付ける (結果の 'pending' が True なら残りがある)。
+    def maintain(self, now=None):
+        """過ぎた時間帯をアーカイブにまとめ、上限を超えた古い画像を消す。処理した件数を返す"""
+        now = time.time() if now is None else now
+        lock_file = open(os.path.join(self.directory, LOCK_NAME), 'a')
+        try:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return {} # 別のワーカーが整理中
+            indexed, pending = self._index_untracked()
+            result = {'indexed': indexed}
+            if self.archive:
+                result['archived'], more = self._roll_completed_hours(now)
+                pending = pending or more
+            deleted, more = self._apply_retention(now)
+            result.update(deleted)
+            result['pending'] = pending or more
+            with self._lock:
+                self.counters['maintenance_runs'] += 1
+                self.last_maintenance = now
+        finally:
+            lock_file.close()
+        return result
+
+    def _count(self, **amounts):
+        with self._lock:
+            for key, value in amounts.items():
+                self.counters[key] += value
+
+    def _index_untracked(self):
+        """索引に無い画像 (この仕組みを入れる前に保存されたものなど) を batch_limit 件まで登録する"""
+        with self._lock:
+            known = {name for (name,) in self._connection().execute('SELECT name FROM frames WHERE shard IS NULL')}
+        rows = []
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith('.jpg') or entry.name in known or not entry.is_file():
+                    continue
+                if len(rows) >= self.batch_limit:
+                    break
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                match = FILENAME_TIME.match(entry.name)
+                captured_at = time.mktime(time.strptime(match.group(1), '%Y%m%d_%H%M%S')) if match else stat.st_mtime
+                rows.append((entry.name, captured_at, stat.st_size))
+        if rows:
+            with self._lock:
+                db = self._connection()
+                with db:
+                    db.executemany('INSERT OR IGNORE INTO frames (name, request_id, captured_at, bytes, shard) VALUES (?, NULL, ?, ?, NULL)', rows)
+        return len(rows), len(rows) >= self.batch_limit
+
+    def _roll_completed_hours(self, now):
+        """
+        今の時間帯より前の個別の画像 (古い順に batch_limit 件まで) を時間帯ごとのアーカイブに入れて消す。
+        アーカイブは一時ファイルに書いてから置き換える。既にその時間帯のアーカイブがあれば書き直さず、
+        後から来た分だけを別のアーカイブ (YYYYMMDD_HH-2.zip, ...) にする。
+        """
+        with self._lock:
+            db = self._connection()
+            rows = db.execute('SELECT name, captured_at FROM frames WHERE shard IS NULL AND captured_at < ? ORDER BY captured_at LIMIT ?',
+                              (hour_start(now), self.batch_limit)).fetchall()
+            shards = {shard for (shard,) in db.execute('SELECT DISTINCT shard FROM frames WHERE shard IS NOT NULL')}
+        by_hour = {}
+        for name, captured_at in rows:
+            by_hour.setdefault(shard_name(captured_at), []).append(name)
+        os.makedirs(self.archive_dir, exist_ok=True)
+        archived = 0
+        for base, names in by_hour.items():
+            shard = self._new_shard(base, shards)
+            added, missing = [], []
+            path = os.path.join(self.archive_dir, shard)
+            partial = path + '.partial'
+            with zipfile.ZipFile(partial, 'w', zipfile.ZIP_STORED) as zf:
+                for name in names:
+                    try:
+                        zf.write(os.path.join(self.directory, name), name)
+                        added.append(name)
+                    except FileNotFoundError:
+                        missing.append(name)
+            if added:
+                os.replace(partial, path)
+                shards.add(shard)
+            else:
+                os.remove(partial)
+            with self._lock:
+                db = self._connection()
+                with db:
+                    db.executemany('UPDATE frames SET shard = ? WHERE name = ? AND shard IS NULL', [(shard, name) for name in added])
+                    db.executemany('DELETE FROM frames WHERE name = ? AND shard IS NULL', [(name,) for name in missing])
+            # 索引をアーカイブに向けてから消す (その間の read() はどちらかから読める)
+            for name in added:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+            archived += len(added)
+            if added:
+                self._count(shards_written=1)
+        self._count(archived=archived)
+        return archived, len(rows) >= self.batch_limit
+
+    def _new_shard(self, base, shards):
+        """
+        その時間帯でまだ使っていないアーカイブのファイル名。索引に無いファイルは、置き換えた直後に止まって
+        索引を更新できなかった残骸 (中の画像はまだ個別のファイルとして残っている) なので消して使い直す。
+        """
+        stem = base[:-len('.zip')]
+        number = 1
+        while True:
+            shard = base if number == 1 else f"{stem}-{number}.zip"
+            if shard not in shards:
+                try:
+                    os.remove(os.path.join(self.archive_dir, shard))
+                except FileNotFoundError:
+                    pass
+                return shard
+            number += 1
+
+    def _apply_retention(self, now):
+        """期間切れ・上限超過の分を古い順に batch_limit 件まで消す (アーカイブはまとめて1単位)"""
+        with self._lock:
+            db = self._connection()
+            total_files, total_bytes = db.execute('SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM frames').fetchone()
+            oldest = db.execute('SELECT name, shard, captured_at, bytes FROM frames ORDER BY captured_at LIMIT ?',
+                                (self.batch_limit,)).fetchall()
+        # 古い順に並べた画像を削除の単位 (個別のファイルかアーカイブ) にまとめる
+        units = {}
+        for name, shard, captured_at, size in oldest:
+            if shard is None:
+                units[name] = (False, captured_at, size, 1)
+            elif shard not in units:
+                with self._lock:
+                    units[shard] = (True,) + self._connection().execute(
+                        'SELECT MAX(captured_at), SUM(bytes), COUNT(*) FROM frames WHERE shard = ?', (shard,)).fetchone()
+        deleted = {'deleted_files': 0, 'deleted_shards': 0}
+        stopped = False
+        for unit, (is_shard, newest, size, count) in units.items():
+            expired = self.max_age and newest < now - self.max_age
+            over_size = self.max_bytes and total_bytes > self.max_bytes
+            over_count = self.max_files and total_files > self.max_files
+            if not (expired or over_size or over_count):
+                stopped = True
+                break
+            with self._lock:
+                db = self._connection()
+                with db:
+                    db.execute('DELETE FROM frames WHERE shard = ?' if is_shard else 'DELETE FROM frames WHERE name = ? AND shard IS NULL', (unit,))
+            path = os.path.join(self.archive_dir if is_shard else self.directory, unit)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+            total_files -= count
+            deleted['deleted_shards' if is_shard else 'deleted_files'] += 1
+        self._count(**deleted)
+        return deleted, not stopped and len(oldest) >= self.batch_limit
+
+    # --- 検索と読み出し ---
+    def find(self, request_id=None, at=None, window=60.0, limit=100):
+        """request_id が一致する画像、または at (UNIX 時刻) の前後 window 秒の画像を近い順に返す"""
+        query = 'SELECT name, request_id, captured_at, bytes, shard FROM frames'
+        if request_id is not None:
+            query += ' WHERE request_id = ? ORDER BY captured_at LIMIT ?'
+            params = (request_id, limit)
+        elif at is not None:
+            query += ' WHERE captured_at BETWEEN ? AND ? ORDER BY ABS(captured_at - ?) LIMIT ?'
+            params = (at - window, at + window, at, limit)
+        else:
+            query += ' ORDER BY captured_at DESC LIMIT ?'
+            params = (limit,)
+        with self._lock:
+            rows = self._connection().execute(query, params).fetchall()
+        return [{'name': name, 'request_id': rid, 'captured_at': captured_at, 'bytes': size, 'shard': shard}
+                for name, rid, captured_at, size, shard in rows]
+
+    def read(self, name):
+        """画像のバイト列を返す (アーカイブ済みならアーカイブから読む)。無ければ None"""
+        with self._lock:
+            row = self._connection().execute('SELECT shard FROM frames WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return None
+        try:
+            if row[0] is None:
+                with open(os.path.join(self.directory, name), 'rb') as f:
+                    return f.read()
+            with zipfile.ZipFile(os.path.join(self.archive_dir, row[0])) as zf:
+                return zf.read(name)
+        except (FileNotFoundError, KeyError):
+            return None # 整理で消えた直後など
+
+    def stats(self):
+        with self._lock:
+            total_files, total_bytes, loose, shards = self._connection().execute(
+                'SELECT COUNT(*), COALESCE(SUM(bytes), 0), COUNT(*) - COUNT(shard), COUNT(DISTINCT shard) FROM frames').fetchone()
+            counters = dict(self.counters, last_maintenance=self.last_maintenance)
+        return {
+            'files': total_files,
+            'bytes': total_bytes,
+            'loose_files': loose,
+            'shards': shards,
+            'max_bytes': self.max_bytes,
+            'max_files': self.max_files,
+            'max_age_hours': round(self.max_age / 3600.0, 2),
+            'archive': self.archive,
+            **counters,
+        }
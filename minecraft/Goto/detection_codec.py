@@ -0,0 +1,223 @@
+import json
+import struct
+
+import numpy as np
+
+# /predict の検出結果をバイナリで返すための形式 (Server.py とクライアントで共有する)
+# Accept ヘッダーで選ぶ:
+#   application/json               従来どおり (デフォルト)
+#   application/x-goto-detections  下記の固定レイアウト (依存パッケージ無し)
+#   application/x-msgpack          MessagePack (msgpack がインストールされている場合のみ)
+#
+# application/x-goto-detections のレイアウト (すべてリトルエンディアン):
+#   ヘッダー 12 バイト: magic b'GDET' | version u8 | flags u8 | クラス名の数 u16 | 検出数 N u32
+#   xyxy      float32 × N × 4  (元画像の座標 x1, y1, x2, y2)
+#   conf      float32 × N
+#   class_id  int16 × N
+#   クラス名表 (クラス名の数だけ): class_id int16 | 名前のバイト数 u8 | UTF-8 の名前
+# float32 の配列を先に置くので、ヘッダー直後から 4 バイト境界に揃う
+#
+# /stream (WebSocket) のメッセージ:
+#   クライアント → サーバー (バイナリ): フレーム番号 u64 | エンコード済み画像
+#   サーバー → クライアント: JSON テキスト、または encoding=packed の場合は
+#                            フレーム番号 u64 | 累計破棄フレーム数 u32 | 上記の固定レイアウト
+#
+# /predict に JPEG などにエンコードしていない画素をそのまま送る場合 (Content-Type: application/octet-stream):
+#   本体は uint8 の BGR (3 チャンネル) または BGRA (4 チャンネル) を行の詰め物なしで並べたもの。
+#   大きさは X-Frame-Width / X-Frame-Height / X-Frame-Channels (省略時 3) ヘッダー、
+#   または本体の先頭に置く 24 バイトのヘッダーで指定する:
+#     magic b'GRAW' | version u8 | チャンネル数 u8 | flags u8 | 予約 u8 | 幅 u32 | 高さ u32 | 元の幅 u32 | 元の高さ u32
+#   flags の bit0 (ヘッダーの場合は X-Letterboxed: 1) はモデルの入力サイズに合わせてレターボックス済みのフレーム
+#   (中央寄せ, 幅・高さとも 32 の倍数。入力サイズが固定の onnx-int8 バックエンドはその大きさの正方形に限る)。
+#   サーバーは縮小・パディングせずにそのまま推論する。
+#   元の幅・高さ (X-Original-Width / X-Original-Height, 0 は省略) があれば、検出座標を元の画像の座標に戻して返す。
+
+JSON_MEDIA_TYPE = 'application/json'
+PACKED_MEDIA_TYPE = 'application/x-goto-detections'
+MSGPACK_MEDIA_TYPE = 'application/x-msgpack'
+
+MAGIC = b'GDET'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHI')
+NAME_ENTRY = struct.Struct('<hB')
+STREAM_FRAME = struct.Struct('<Q')
+STREAM_REPLY = struct.Struct('<QI')
+
+RAW_MEDIA_TYPE = 'application/octet-stream'
+RAW_MAGIC = b'GRAW'
+RAW_VERSION = 1
+RAW_HEADER = struct.Struct('<4sBBBBIIII')
+RAW_FLAG_LETTERBOXED = 1
+RAW_WIDTH_HEADER = 'X-Frame-Width'
+RAW_HEIGHT_HEADER = 'X-Frame-Height'
+RAW_CHANNELS_HEADER = 'X-Frame-Channels'
+RAW_LETTERBOXED_HEADER = 'X-Letterboxed'
+RAW_ORIGINAL_WIDTH_HEADER = 'X-Original-Width'
+RAW_ORIGINAL_HEIGHT_HEADER = 'X-Original-Height'
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def available_media_types():
+    """サーバーが返せる形式 (優先順。先頭が Accept: */* のときに選ばれる)"""
+    media_types = [JSON_MEDIA_TYPE, PACKED_MEDIA_TYPE]
+    if msgpack is not None:
+        media_types.append(MSGPACK_MEDIA_TYPE)
+    return media_types
+
+
+def encode_packed(columns):
+    """列形式の検出結果 (class_id / conf / xyxy / names) を固定レイアウトのバイト列にする"""
+    count = len(columns['class_id'])
+    names = [(int(class_id), name.encode('utf-8')[:255]) for class_id, name in columns['names'].items()]
+    parts = [HEADER.pack(MAGIC, VERSION, 0, len(names), count)]
+    if count:
+        parts.append(np.asarray(columns['xyxy'], dtype='<f4').reshape(count, 4).tobytes())
+        parts.append(np.asarray(columns['conf'], dtype='<f4').tobytes())
+        parts.append(np.asarray(columns['class_id'], dtype='<i2').tobytes())
+    for class_id, name in names:
+        parts.append(NAME_ENTRY.pack(class_id, len(name)))
+        parts.append(name)
+    return b''.join(parts)
+
+
+def decode_packed(data):
+    """
+    encode_packed の逆変換。
+    {'class_id': int16[N], 'conf': float32[N], 'xyxy': float32[N, 4], 'names': {class_id: name}} を返す。
+    """
+    magic, version, _, name_count, count = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError(f"Not a detection payload (magic={magic!r})")
+    if version != VERSION:
+        raise ValueError(f"Unsupported detection payload version {version}")
+    offset = HEADER.size
+    xyxy = np.frombuffer(data, dtype='<f4', count=count * 4, offset=offset).reshape(count, 4)
+    offset += xyxy.nbytes
+    conf = np.frombuffer(data, dtype='<f4', count=count, offset=offset)
+    offset += conf.nbytes
+    class_id = np.frombuffer(data, dtype='<i2', count=count, offset=offset)
+    offset += class_id.nbytes
+    names = {}
+    for _ in range(name_count):
+        entry_id, length = NAME_ENTRY.unpack_from(data, offset)
+        offset += NAME_ENTRY.size
+        names[entry_id] = bytes(data[offset:offset + length]).decode('utf-8')
+        offset += length
+    return {'class_id': class_id, 'conf': conf, 'xyxy': xyxy, 'names': names}
+
+
+def encode_msgpack(payload):
+    if msgpack is None:
+        raise RuntimeError("msgpack is not installed (pip install msgpack)")
+    return msgpack.packb(payload, use_bin_type=True)
+
+
+def decode_response(content_type, data):
+    """
+    クライアント用: /predict のレスポンス本体を Content-Type に応じて辞書にする。
+    バイナリ形式では 'predictions' が列形式 (NumPy 配列) になる。
+    """
+    media_type = (content_type or '').split(';', 1)[0].strip().lower()
+    if media_type == PACKED_MEDIA_TYPE:
+        return {'predictions': decode_packed(data)}
+    if media_type == MSGPACK_MEDIA_TYPE:
+        if msgpack is None:
+            raise RuntimeError("msgpack is not installed (pip install msgpack)")
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+    return json.loads(data)
+
+
+def pack_stream_frame(seq, image_bytes):
+    """クライアント用: /stream に送るフレーム (番号 + 画像) を作る"""
+    return STREAM_FRAME.pack(seq) + image_bytes
+
+
+def unpack_stream_frame(data):
+    if len(data) <= STREAM_FRAME.size:
+        raise ValueError("Stream frame is too short (expected an 8-byte sequence number followed by an image)")
+    return STREAM_FRAME.unpack_from(data, 0)[0], memoryview(data)[STREAM_FRAME.size:]
+
+
+def encode_stream_reply(seq, dropped, columns):
+    return STREAM_REPLY.pack(seq, dropped) + encode_packed(columns)
+
+
+def decode_stream_reply(data):
+    """
+    クライアント用: /stream の応答を辞書にする。
+    テキスト (JSON) でもバイナリ (encoding=packed) でも同じキー seq / dropped / predictions を持つ。
+    """
+    if isinstance(data, str):
+        return json.loads(data)
+    seq, dropped = STREAM_REPLY.unpack_from(data, 0)
+    return {'seq': seq, 'dropped': dropped, 'predictions': decode_packed(memoryview(data)[STREAM_REPLY.size:])}
+
+
+class RawFrame:
+    """application/octet-stream で送られた画素の並び方 (幅・高さ・チャンネル数) とレターボックスの情報"""
+    __slots__ = ('width', 'height', 'channels', 'letterboxed', 'original_size', 'offset')
+
+    def __init__(self, width, height, channels=3, letterboxed=False, original_size=None, offset=0):
+        if width <= 0 or height <= 0:
+            raise ValueError(f"Invalid frame size {width}x{height}")
+        if channels not in (3, 4):
+            raise ValueError(f"Raw frames must have 3 (BGR) or 4 (BGRA) channels, got {channels}")
+        if original_size is not None and min(original_size) <= 0:
+            raise ValueError(f"Invalid original size {original_size[0]}x{original_size[1]}")
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.letterboxed = letterboxed
+        self.original_size = original_size # (幅, 高さ) または None
+        self.offset = offset                # 本体の中の画素の開始位置
+
+    @classmethod
+    def parse(cls, data, headers):
+        """本体の先頭の 24 バイトのヘッダー、無ければ X-Frame-* ヘッダーから読む。不正なら ValueError"""
+        if bytes(data[:4]) == RAW_MAGIC:
+            if len(data) < RAW_HEADER.size:
+                raise ValueError("Raw frame header is truncated")
+            _, version, channels, flags, _, width, height, original_width, original_height = RAW_HEADER.unpack_from(data, 0)
+            if version != RAW_VERSION:
+                raise ValueError(f"Unsupported raw frame version {version}")
+            original_size = (original_width, original_height) if original_width and original_height else None
+            frame = cls(width, height, channels, bool(flags & RAW_FLAG_LETTERBOXED), original_size, RAW_HEADER.size)
+        else:
+            if RAW_WIDTH_HEADER not in headers or RAW_HEIGHT_HEADER not in headers:
+                raise ValueError(f"Raw frames need a {RAW_MAGIC.decode()} header or the {RAW_WIDTH_HEADER} and {RAW_HEIGHT_HEADER} headers")
+            width = int(headers[RAW_WIDTH_HEADER])
+            height = int(headers[RAW_HEIGHT_HEADER])
+            channels = int(headers.get(RAW_CHANNELS_HEADER, 3))
+            original_width = int(headers.get(RAW_ORIGINAL_WIDTH_HEADER, 0))
+            original_height = int(headers.get(RAW_ORIGINAL_HEIGHT_HEADER, 0))
+            letterboxed = headers.get(RAW_LETTERBOXED_HEADER, '0').strip().lower() in ('1', 'true', 'yes', 'on')
+            original_size = (original_width, original_height) if original_width and original_height else None
+            frame = cls(width, height, channels, letterboxed, original_size)
+        expected = frame.offset + frame.width * frame.height * frame.channels
+        if len(data) != expected:
+            raise ValueError(f"Raw frame body is {len(data)} bytes, expected {expected} for "
+                             f"{frame.width}x{frame.height}x{frame.channels}")
+        return frame
+
+    def image(self, data):
+        """本体をコピーせずに (高さ, 幅, チャンネル数) の uint8 配列として返す"""
+        return np.frombuffer(data, dtype=np.uint8, count=self.width * self.height * self.channels,
+                             offset=self.offset).reshape(self.height, self.width, self.channels)
+
+    def key(self):
+        """推論結果キャッシュのキーに含める値 (同じバイト列でも並び方が違えば別の画像)"""
+        return (self.width, self.height, self.channels, self.letterboxed, self.original_size)
+
+
+def pack_raw_frame(image, letterboxed=False, original_size=None):
+    """クライアント用: (高さ, 幅, 3 または 4) の uint8 配列を /predict に送る本体 (24 バイトのヘッダー + 画素) にする"""
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    height, width, channels = image.shape
+    original_width, original_height = original_size or (0, 0)
+    header = RAW_HEADER.pack(RAW_MAGIC, RAW_VERSION, channels, RAW_FLAG_LETTERBOXED if letterboxed else 0, 0,
+                             width, height, original_width, original_height)
+    return header + image.tobytes()
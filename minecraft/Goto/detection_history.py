@@ -0,0 +1,291 @@
+import time
+import queue
+import sqlite3
+import logging
+import threading
+import collections
+
+# 検出結果の履歴 (Server.py が使う)
+# - 検出はすべて detections 表に追記する (クラス名と送信元は ID にして1行を小さくする)
+# - 同時に1分ごと・1時間ごとの件数を集計表に足し込み、範囲の集計は集計表だけで答える
+# - 書き込みは専用スレッドがまとめて1トランザクションで行う (リクエストの処理は待たせない)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS labels (
+    id   INTEGER PRIMARY KEY,
+    kind TEXT NOT NULL, -- 'source' (送信元) または 'class' (クラス名)
+    name TEXT NOT NULL,
+    UNIQUE (kind, name)
+);
+CREATE TABLE IF NOT EXISTS detections (
+    ts         INTEGER NOT NULL, -- 受信時刻 (UNIX 時刻, ミリ秒)
+    source_id  INTEGER NOT NULL,
+    class_id   INTEGER NOT NULL, -- labels.id (モデルのクラス番号ではない)
+    confidence REAL NOT NULL,
+    x1 REAL, y1 REAL, x2 REAL, y2 REAL,
+    request_id TEXT
+);
+CREATE INDEX IF NOT EXISTS detections_ts ON detections (ts);
+CREATE TABLE IF NOT EXISTS frame_counts (
+    resolution INTEGER NOT NULL, -- 集計の単位 (秒): 60 または 3600
+    bucket     INTEGER NOT NULL, -- 単位の開始時刻 (UNIX 時刻, 秒)
+    source_id  INTEGER NOT NULL,
+    frames     INTEGER NOT NULL,
+    PRIMARY KEY (resolution, bucket, source_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS class_counts (
+    resolution     INTEGER NOT NULL,
+    bucket         INTEGER NOT NULL,
+    source_id      INTEGER NOT NULL,
+    class_id       INTEGER NOT NULL,
+    detections     INTEGER NOT NULL,
+    confidence_sum REAL NOT NULL,
+    PRIMARY KEY (resolution, bucket, source_id, class_id)
+) WITHOUT ROWID;
+"""
+
+MINUTE = 60
+HOUR = 3600
+
+
+def split_range(start, end):
+    """
+    [start, end) を1時間の集計で数えられる部分と、1分の集計で数える端に分ける。
+    (分の範囲のリスト, 時間の範囲または None) を返す。start / end は分単位に切り詰める。
+    """
+    start = int(start) // MINUTE * MINUTE
+    end = -(-int(end) // MINUTE) * MINUTE
+    first_hour = -(-start // HOUR) * HOUR
+    last_hour = end // HOUR * HOUR
+    if first_hour >= last_hour:
+        return [(start, end)], None
+    minutes = [(lo, hi) for lo, hi in ((start, first_hour), (last_hour, end)) if lo < hi]
+    return minutes, (first_hour, last_hour)
+
+
+class DetectionHistory:
+    """
+    検出結果の履歴。record() はリクエストスレッドから呼び、キューに入れるだけで返る。
+    キューが満杯の場合は待たずに破棄して数える。
+    """
+    RESOLUTIONS = {'minute': MINUTE, 'hour': HOUR} # series() に渡す集計の単位 (秒)
+
+    def __init__(self, path, queue_size=10000, flush_interval=1.0, max_batch=1000):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._queue = queue.Queue(maxsize=max(1, int(queue_size)))
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._read_local = threading.local() # 読み出しはスレッドごとの接続で行う (書き込みと並行できる)
+        self._labels = {} # (kind, name) -> id (書き込みスレッドだけが使う)
+        self.counters = collections.Counter(frames=0, detections=0, dropped=0, flushes=0, failed=0)
+        self._counter_lock = threading.Lock() # dropped はリクエストのスレッド、それ以外は書き込みスレッドが更新する
+        self.last_flush_ms = None
+
+    def _count(self, **amounts):
+        with self._counter_lock:
+            self.counters.update(amounts)
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, timeout=10.0)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                db = self._connect()
+                db.executescript(SCHEMA)
+                db.close()
+                self._thread = threading.Thread(target=self._run, name='detection-history', daemon=True)
+                self._thread.start()
+                logging.info(f"Detection history is written to {self.path}.")
+
+    def record(self, source, request_id, class_names, confidences, xyxy, received_at=None):
+        """1フレーム分の検出結果をキューに入れる (検出が無いフレームもフレーム数として数える)"""
+        if self._thread is None:
+            self.start()
+        try:
+            self._queue.put_nowait((received_at or time.time(), source, request_id, class_names, confidences, xyxy))
+            return True
+        except queue.Full:
+            self._count(dropped=1)
+            return False
+
+    # --- 書き込み ---
+    def _run(self):
+        db = self._connect()
+        while True:
+            batch = [self._queue.get()]
+            # 最初の1件から flush_interval だけ待って、その間に届いた分をまとめて書く
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                started = time.perf_counter()
+                self._flush(db, batch)
+                self.last_flush_ms = (time.perf_counter() - started) * 1000.0
+                self._count(flushes=1)
+            except Exception as e:
+                self._count(failed=len(batch))
+                self._labels.clear() # ロールバックされた ID を使わない
+                logging.error(f"Failed to write {len(batch)} frames to the detection history: {e}", exc_info=True)
+
+    def _label(self, db, kind, name):
+        key = (kind, name)
+        label_id = self._labels.get(key)
+        if label_id is None:
+            db.execute('INSERT OR IGNORE INTO labels (kind, name) VALUES (?, ?)', key)
+            label_id = self._labels[key] = db.execute('SELECT id FROM labels WHERE kind = ? AND name = ?', key).fetchone()[0]
+        return label_id
+
+    def _flush(self, db, batch):
+        rows = []
+        frames = collections.Counter()  # (resolution, bucket, source_id) -> フレーム数
+        classes = collections.Counter() # (resolution, bucket, source_id, class_id) -> 件数
+        confidence_sums = collections.Counter()
+        detections = 0
+        with db:
+            for received_at, source, request_id, class_names, confidences, xyxy in batch:
+                ts = int(received_at * 1000)
+                source_id = self._label(db, 'source', source)
+                for resolution in (MINUTE, HOUR):
+                    frames[resolution, int(received_at) // resolution * resolution, source_id] += 1
+                for class_name, confidence, box in zip(class_names, confidences, xyxy):
+                    class_id = self._label(db, 'class', class_name)
+                    rows.append((ts, source_id, class_id, confidence, *box, request_id))
+                    for resolution in (MINUTE, HOUR):
+                        key = (resolution, int(received_at) // resolution * resolution, source_id, class_id)
+                        classes[key] += 1
+                        confidence_sums[key] += confidence
+                detections += len(class_names)
+            db.executemany('INSERT INTO detections VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            db.executemany("""
+                INSERT INTO frame_counts VALUES (?, ?, ?, ?)
+                ON CONFLICT (resolution, bucket, source_id) DO UPDATE SET frames = frames + excluded.frames
+            """, [key + (count,) for key, count in frames.items()])
+            db.executemany("""
+                INSERT INTO class_counts VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (resolution, bucket, source_id, class_id) DO UPDATE SET
+                    detections = detections + excluded.detections,
+                    confidence_sum = confidence_sum + excluded.confidence_sum
+            """, [key + (count, confidence_sums[key]) for key, count in classes.items()])
+        self._count(frames=len(batch), detections=detections)
+
+    # --- 検索 ---
+    def _reader(self):
+        if self._thread is None:
+            self.start() # 表を作る
+        db = getattr(self._read_local, 'db', None)
+        if db is None:
+            db = self._read_local.db = self._connect()
+        return db
+
+    @staticmethod
+    def _filters(source, class_name):
+        """送信元・クラス名の絞り込み条件 (labels の名前で指定する)"""
+        clauses, params = [], []
+        if source is not None:
+            clauses.append("source_id = (SELECT id FROM labels WHERE kind = 'source' AND name = ?)")
+            params.append(source)
+        if class_name is not None:
+            clauses.append("class_id = (SELECT id FROM labels WHERE kind = 'class' AND name = ?)")
+            params.append(class_name)
+        return ''.join(f' AND {clause}' for clause in clauses), params
+
+    def _ranges(self, start, end):
+        """集計表を引く (resolution, lo, hi) のリスト。時間の集計で足りる部分は時間の集計を使う"""
+        minutes, hours = split_range(start, end)
+        ranges = [(MINUTE, lo, hi) for lo, hi in minutes]
+        if hours is not None:
+            ranges.append((HOUR, *hours))
+        return ranges
+
+    def summary(self, start, end, source=None, class_name=None):
+        """[start, end) の送信元・クラスごとの検出数と平均信頼度、送信元ごとのフレーム数 (1分単位に丸める)"""
+        db = self._reader()
+        class_filter, class_params = self._filters(source, class_name)
+        frame_filter, frame_params = self._filters(source, None)
+        totals = collections.defaultdict(lambda: [0, 0.0])
+        frames = collections.Counter()
+        for resolution, lo, hi in self._ranges(start, end):
+            for source_id, class_id, count, confidence_sum in db.execute(f"""
+                SELECT source_id, class_id, SUM(detections), SUM(confidence_sum) FROM class_counts
+                WHERE resolution = ? AND bucket >= ? AND bucket < ?{class_filter} GROUP BY source_id, class_id
+            """, [resolution, lo, hi] + class_params):
+                totals[source_id, class_id][0] += count
+                totals[source_id, class_id][1] += confidence_sum
+            for source_id, count in db.execute(f"""
+                SELECT source_id, SUM(frames) FROM frame_counts
+                WHERE resolution = ? AND bucket >= ? AND bucket < ?{frame_filter} GROUP BY source_id
+            """, [resolution, lo, hi] + frame_params):
+                frames[source_id] += count
+        names = self._label_names(db)
+        result = {}
+        for source_id, count in frames.items():
+            result[names[source_id]] = {'frames': count, 'classes': {}}
+        for (source_id, class_id), (count, confidence_sum) in totals.items():
+            entry = result.setdefault(names[source_id], {'frames': 0, 'classes': {}})
+            entry['classes'][names[class_id]] = {
+                'detections': count,
+                'mean_confidence': round(confidence_sum / count, 4) if count else None,
+                'per_frame': round(count / entry['frames'], 4) if entry['frames'] else None,
+            }
+        return result
+
+    def series(self, start, end, resolution, source=None, class_name=None):
+        """[start, end) の resolution (秒) ごとの件数。(バケット開始時刻, 送信元, クラス名, 件数, フレーム数) の辞書のリスト"""
+        db = self._reader()
+        lo = int(start) // resolution * resolution
+        class_filter, class_params = self._filters(source, class_name)
+        frame_filter, frame_params = self._filters(source, None)
+        frames = {(bucket, source_id): count for bucket, source_id, count in db.execute(f"""
+            SELECT bucket, source_id, frames FROM frame_counts
+            WHERE resolution = ? AND bucket >= ? AND bucket < ?{frame_filter}
+        """, [resolution, lo, end] + frame_params)}
+        names = self._label_names(db)
+        return [
+            {'bucket': bucket, 'source': names[source_id], 'class_name': names[class_id], 'detections': count,
+             'mean_confidence': round(confidence_sum / count, 4), 'frames': frames.get((bucket, source_id), 0)}
+            for bucket, source_id, class_id, count, confidence_sum in db.execute(f"""
+                SELECT bucket, source_id, class_id, detections, confidence_sum FROM class_counts
+                WHERE resolution = ? AND bucket >= ? AND bucket < ?{class_filter} ORDER BY bucket, source_id, class_id
+            """, [resolution, lo, end] + class_params)
+        ]
+
+    def detections(self, start, end, source=None, class_name=None, limit=1000):
+        """[start, end) の個々の検出を新しい順に返す"""
+        db = self._reader()
+        extra, params = self._filters(source, class_name)
+        names = self._label_names(db)
+        return [
+            {'ts': ts / 1000.0, 'source': names[source_id], 'class_name': names[class_id], 'confidence': confidence,
+             'box': {'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2}, 'request_id': request_id}
+            for ts, source_id, class_id, confidence, x1, y1, x2, y2, request_id in db.execute(f"""
+                SELECT ts, source_id, class_id, confidence, x1, y1, x2, y2, request_id FROM detections
+                WHERE ts >= ? AND ts < ?{extra} ORDER BY ts DESC LIMIT ?
+            """, [int(start * 1000), int(end * 1000)] + params + [limit])
+        ]
+
+    @staticmethod
+    def _label_names(db):
+        return dict(db.execute('SELECT id, name FROM labels'))
+
+    def stats(self):
+        with self._counter_lock:
+            counters = dict(self.counters)
+        return {
+            'path': self.path,
+            'queue_depth': self._queue.qsize(),
+            'queue_size': self._queue.maxsize,
+            'last_flush_ms': round(self.last_flush_ms, 2) if self.last_flush_ms is not None else None,
+            **counters,
+        }
@@ -0,0 +1,457 @@
+import os
+import sys
+import json
+import time
+import queue
+import random
+import argparse
+import threading
+import subprocess
+import http.client
+import collections
+
+import cv2
+import numpy as np
+
+# Server.py の /predict に負荷をかけ、スループット・レイテンシ・エラー率・サーバー側の処理段階ごとの時間を計測する
+# - 画像は Minecraft 風の合成フレーム (空・地形ブロック・モブ風の矩形) を解像度ごとに作る (カメラやデータセットは不要)
+# - --concurrency N: N 本の接続でレスポンスが返るたびに次を送る (クローズドループ)
+# - --rate R: 毎秒 R リクエストを予定時刻どおりに送る (オープンループ, レイテンシは予定時刻から計る)
+# - --start-server: Server.py をローカルで起動して計測し、終わったら止める (--stub でモデル無しの HTTP 層だけを計測)
+# 結果は JSON で書き出すので、コミット間で比較できる
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 9001
+DEFAULT_RESOLUTIONS = ('640x360', '1280x720', '1920x1080')
+DEFAULT_FRAMES = 8          # 解像度ごとの合成フレーム数 (同じ画像ばかりにならないように)
+DEFAULT_JPEG_QUALITY = 85
+DEFAULT_CONCURRENCY = 4
+DEFAULT_DURATION = 20.0     # 計測時間 (秒)
+DEFAULT_WARMUP = 3.0        # 計測前に捨てる時間 (秒)
+DEFAULT_TIMEOUT = 30.0      # 1リクエストのタイムアウト (秒)
+READY_TIMEOUT = 180.0       # --start-server で /readyz が 200 になるまで待つ時間 (秒)
+PERCENTILES = (50, 95, 99)
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Server.py')
+
+# 合成フレームの色 (BGR)
+SKY_TOP = (235, 180, 120)
+SKY_BOTTOM = (250, 215, 170)
+BLOCK_COLORS = [(60, 160, 70), (40, 90, 130), (120, 120, 120), (30, 60, 100)] # 草・土・石・木
+MOB_COLORS = [(60, 140, 60), (210, 210, 210), (40, 200, 40), (30, 30, 30)]    # ゾンビ・スケルトン・クリーパー・クモ
+
+
+def parse_resolution(text):
+    try:
+        width, height = (int(v) for v in text.lower().split('x'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Resolution must look like 1280x720, got {text!r}")
+    if width <= 0 or height <= 0:
+        raise argparse.ArgumentTypeError(f"Resolution must be positive, got {text!r}")
+    return width, height
+
+
+def synthetic_frame(width, height, rng):
+    """空のグラデーション、ブロック単位の地形、モブ風の矩形からなる Minecraft 風の BGR 画像を作る"""
+    ramp = np.linspace(0.0, 1.0, height)[:, None, None]
+    image = (np.array(SKY_TOP) * (1.0 - ramp) + np.array(SKY_BOTTOM) * ramp).astype(np.uint8)
+    image = np.repeat(image, width, axis=1)
+
+    block = max(8, width // 40)
+    columns = width // block + 1
+    # 地表の高さをランダムウォークで決め、その下をブロックで埋める
+    surface = np.clip(np.cumsum(rng.integers(-1, 2, columns)) + height // (2 * block), 2, height // block - 1)
+    for column, top in enumerate(surface):
+        x = column * block
+        for row in range(int(top), height // block + 1):
+            if row == top:
+                color = BLOCK_COLORS[0]
+            elif row <= top + 2:
+                color = BLOCK_COLORS[1]
+            else:
+                color = BLOCK_COLORS[2 + (row + column) % 2]
+            noise = rng.integers(-20, 21, 3)
+            cv2.rectangle(image, (x, row * block), (x + block - 1, row * block + block - 1),
+                          tuple(int(c) for c in np.clip(np.array(color) + noise, 0, 255)), -1)
+
+    for _ in range(int(rng.integers(1, 6))):
+        mob_width, mob_height = block, block * 2
+        x = int(rng.integers(0, max(1, width - mob_width)))
+        y = int(surface[min(x // block, columns - 1)]) * block - mob_height
+        color = MOB_COLORS[int(rng.integers(0, len(MOB_COLORS)))]
+        cv2.rectangle(image, (x, max(0, y)), (x + mob_width, max(0, y) + mob_height), color, -1)
+    return image
+
+
+def build_frames(resolutions, count, quality, seed):
+    """解像度ごとに count 枚の合成フレームを JPEG にして返す: [(解像度ラベル, JPEG バイト列), ...]"""
+    rng = np.random.default_rng(seed)
+    frames = []
+    for width, height in resolutions:
+        for _ in range(count):
+            ok, encoded = cv2.imencode('.jpg', synthetic_frame(width, height, rng), [cv2.IMWRITE_JPEG_QUALITY, quality])
+            if not ok:
+                raise RuntimeError(f"JPEG encoding failed for {width}x{height}")
+            frames.append((f'{width}x{height}', encoded.tobytes()))
+    return frames
+
+
+def multipart_body(image_bytes, boundary):
+    """Server.py の /predict が受け取る 'image' フィールドだけの multipart/form-data"""
+    return b''.join([
+        f'--{boundary}\r\n'.encode(),
+        b'Content-Disposition: form-data; name="image"; filename="frame.jpg"\r\n',
+        b'Content-Type: image/jpeg\r\n\r\n',
+        image_bytes,
+        f'\r\n--{boundary}--\r\n'.encode(),
+    ])
+
+
+def parse_server_timing(header):
+    """'decode;dur=1.23, infer;dur=4.56' を {'decode': 1.23, 'infer': 4.56} (ミリ秒) にする"""
+    timings = {}
+    for entry in (header or '').split(','):
+        name, _, params = entry.strip().partition(';')
+        for param in params.split(';'):
+            key, _, value = param.strip().partition('=')
+            if key == 'dur' and name:
+                try:
+                    timings[name] = float(value)
+                except ValueError:
+                    pass
+    return timings
+
+
+class Sample:
+    __slots__ = ('started', 'latency', 'status', 'resolution', 'stages', 'cache', 'error')
+
+    def __init__(self, started, latency, status, resolution, stages=None, cache=None, error=None):
+        self.started = started
+        self.latency = latency
+        self.status = status # HTTP ステータス (接続エラー・タイムアウトは 0)
+        self.resolution = resolution
+        self.stages = stages or {}
+        self.cache = cache
+        self.error = error
+
+
+class Client:
+    """1本の keep-alive 接続で /predict を送る (切れたら次のリクエストで繋ぎ直す)"""
+
+    def __init__(self, host, port, path, timeout, headers):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.timeout = timeout
+        self.headers = headers
+        self.boundary = f'goto-loadtest-{random.getrandbits(64):016x}'
+        self.connection = None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def send(self, resolution, image_bytes, scheduled=None):
+        """1リクエスト送って Sample を返す。scheduled を渡すとレイテンシをその時刻から計る"""
+        body = multipart_body(image_bytes, self.boundary)
+        headers = dict(self.headers)
+        headers['Content-Type'] = f'multipart/form-data; boundary={self.boundary}'
+        started = time.perf_counter()
+        origin = started if scheduled is None else scheduled
+        try:
+            if self.connection is None:
+                self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            self.connection.request('POST', self.path, body=body, headers=headers)
+            response = self.connection.getresponse()
+            response.read()
+            latency = time.perf_counter() - origin
+            if response.getheader('Connection', '').lower() == 'close':
+                self.close()
+            return Sample(origin, latency, response.status, resolution,
+                          parse_server_timing(response.getheader('Server-Timing')), response.getheader('X-Cache'))
+        except (OSError, http.client.HTTPException) as e:
+            self.close()
+            return Sample(origin, time.perf_counter() - origin, 0, resolution, error=f'{type(e).__name__}: {e}')
+
+
+def run_closed_loop(clients, frames, deadline, samples):
+    """各接続がレスポンスを受け取るたびに次のフレームを送る"""
+    def worker(client, offset):
+        index = offset
+        while time.perf_counter() < deadline:
+            resolution, image_bytes = frames[index % len(frames)]
+            samples.append(client.send(resolution, image_bytes))
+            index += len(clients)
+        client.close()
+
+    threads = [threading.Thread(target=worker, args=(client, i), daemon=True) for i, client in enumerate(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def run_open_loop(clients, frames, deadline, rate, samples):
+    """
+    毎秒 rate 件の予定時刻を作り、空いている接続が送る。
+    接続が足りずに送信が遅れた分もレイテンシに含める (coordinated omission を避ける)。
+    """
+    schedule = queue.Queue()
+
+    def worker(client):
+        while True:
+            item = schedule.get()
+            if item is None:
+                break
+            scheduled, (resolution, image_bytes) = item
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            samples.append(client.send(resolution, image_bytes, scheduled))
+        client.close()
+
+    threads = [threading.Thread(target=worker, args=(client,), daemon=True) for client in clients]
+    for thread in threads:
+        thread.start()
+    interval = 1.0 / rate
+    next_time = time.perf_counter()
+    index = 0
+    while next_time < deadline:
+        schedule.put((next_time, frames[index % len(frames)]))
+        index += 1
+        next_time += interval
+        # 予定を先に積みすぎないよう、少し先の分まで積んだら待つ
+        ahead = next_time - time.perf_counter() - 0.1
+        if ahead > 0:
+            time.sleep(ahead)
+    for _ in threads:
+        schedule.put(None)
+    for thread in threads:
+        thread.join()
+
+
+def percentiles_ms(values):
+    if not values:
+        return {f'p{p}': None for p in PERCENTILES}
+    points = np.percentile(np.asarray(values) * 1000.0, PERCENTILES)
+    return {f'p{p}': round(float(v), 2) for p, v in zip(PERCENTILES, points)}
+
+
+def latency_summary(samples):
+    latencies = [sample.latency for sample in samples]
+    summary = {'count': len(samples)}
+    summary.update(percentiles_ms(latencies))
+    summary['mean'] = round(float(np.mean(latencies)) * 1000.0, 2) if latencies else None
+    summary['max'] = round(max(latencies) * 1000.0, 2) if latencies else None
+    return summary
+
+
+def summarize(samples, elapsed):
+    """計測区間の Sample をまとめて結果の辞書にする"""
+    ok = [sample for sample in samples if sample.status == 200]
+    statuses = collections.Counter(str(sample.status) for sample in samples)
+    errors = collections.Counter(sample.error for sample in samples if sample.error)
+
+    stages = collections.defaultdict(list)
+    for sample in ok:
+        for stage, duration_ms in sample.stages.items():
+            stages[stage].append(duration_ms / 1000.0)
+    stage_summary = {}
+    for stage, values in stages.items():
+        stage_summary[stage] = dict(percentiles_ms(values), mean=round(float(np.mean(values)) * 1000.0, 2), count=len(values))
+
+    by_resolution = {}
+    for resolution in sorted({sample.resolution for sample in samples}):
+        subset = [sample for sample in samples if sample.resolution == resolution]
+        subset_ok = [sample for sample in subset if sample.status == 200]
+        by_resolution[resolution] = dict(latency_summary(subset_ok), errors=len(subset) - len(subset_ok))
+
+    return {
+        'requests': len(samples),
+        'succeeded': len(ok),
+        'elapsed_seconds': round(elapsed, 3),
+        'throughput_rps': round(len(ok) / elapsed, 2) if elapsed > 0 else None,
+        'error_rate': round(1.0 - len(ok) / len(samples), 4) if samples else None,
+        'status_counts': dict(statuses),
+        'errors': dict(errors.most_common(10)),
+        'latency_ms': latency_summary(ok),
+        'server_stages_ms': stage_summary, # Server-Timing ヘッダーが無い場合は空
+        'cache': dict(collections.Counter(sample.cache for sample in ok if sample.cache)),
+        'by_resolution': by_resolution,
+    }
+
+
+def fetch_json(host, port, path, timeout=5.0):
+    connection = http.client.HTTPConnection(host, port, timeout=timeout)
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        return response.status, json.loads(response.read() or b'null')
+    except (OSError, http.client.HTTPException, ValueError):
+        return None, None
+    finally:
+        connection.close()
+
+
+def git_revision():
+    """結果を比較できるよう、Server.py のあるリポジトリのコミットを記録する"""
+    try:
+        output = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(SERVER_SCRIPT),
+                                capture_output=True, text=True, timeout=5)
+        dirty = subprocess.run(['git', 'status', '--porcelain', '--', os.path.basename(SERVER_SCRIPT)],
+                               cwd=os.path.dirname(SERVER_SCRIPT), capture_output=True, text=True, timeout=5)
+        return {'commit': output.stdout.strip() or None, 'server_modified': bool(dirty.stdout.strip())}
+    except (OSError, subprocess.SubprocessError):
+        return {'commit': None, 'server_modified': None}
+
+
+def start_server(args):
+    """Server.py を子プロセスで起動し、/readyz が 200 になるまで待つ"""
+    command = [sys.executable, SERVER_SCRIPT] + args.server_args
+    if args.stub:
+        command += ['--backend', 'stub', '--stub-latency-ms', str(args.stub_latency_ms)]
+    print(f"Starting server: {' '.join(command)}")
+    log = open(args.server_log, 'w') if args.server_log else subprocess.DEVNULL
+    process = subprocess.Popen(command, stdout=log, stderr=subprocess.STDOUT, cwd=os.path.dirname(SERVER_SCRIPT))
+    deadline = time.monotonic() + READY_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode} before becoming ready")
+        status, _ = fetch_json(args.host, args.port, '/readyz', timeout=1.0)
+        if status == 200:
+            return process
+        time.sleep(0.5)
+    stop_server(process)
+    raise RuntimeError(f"Server did not become ready within {READY_TIMEOUT:.0f} s")
+
+
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def print_report(result):
+    summary = result['summary']
+    latency = summary['latency_ms']
+    print(f"Requests: {summary['requests']} ({summary['succeeded']} ok), "
+          f"throughput {summary['throughput_rps']} req/s, error rate {summary['error_rate']}")
+    print(f"Latency (ms): p50 {latency['p50']}  p95 {latency['p95']}  p99 {latency['p99']}  max {latency['max']}")
+    if summary['status_counts']:
+        print(f"Status codes: {summary['status_counts']}")
+    for error, count in summary['errors'].items():
+        print(f"  {count} x {error}")
+    if summary['server_stages_ms']:
+        print(f"{'stage':<14} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+        for stage, values in summary['server_stages_ms'].items():
+            print(f"{stage:<14} {values['mean']:>8} {values['p50']:>8} {values['p95']:>8} {values['p99']:>8}")
+    for resolution, values in summary['by_resolution'].items():
+        print(f"{resolution:>10}: n={values['count']} p50 {values['p50']} p95 {values['p95']} errors {values['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Server.py の /predict に合成フレームで負荷をかけ、スループットとレイテンシを JSON で記録する")
+    parser.add_argument('--host', default=DEFAULT_HOST, help=f"サーバーのホスト (デフォルト: {DEFAULT_HOST})")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help=f"サーバーのポート (デフォルト: {DEFAULT_PORT})")
+    parser.add_argument('--path', default='/predict', help="送信先のパス (クエリ文字列も可, 例: '/predict?tiled=1', デフォルト: /predict)")
+    parser.add_argument('--resolutions', type=parse_resolution, nargs='+', default=[parse_resolution(r) for r in DEFAULT_RESOLUTIONS],
+                        metavar='WxH', help=f"合成フレームの解像度 (デフォルト: {' '.join(DEFAULT_RESOLUTIONS)})")
+    parser.add_argument('--frames', type=int, default=DEFAULT_FRAMES, metavar='N', help=f"解像度ごとの合成フレーム数 (デフォルト: {DEFAULT_FRAMES})")
+    parser.add_argument('--quality', type=int, default=DEFAULT_JPEG_QUALITY, help=f"JPEG 品質 (デフォルト: {DEFAULT_JPEG_QUALITY})")
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY, metavar='N',
+                        help=f"同時接続数 (--rate 指定時は送信に使う接続の数, デフォルト: {DEFAULT_CONCURRENCY})")
+    parser.add_argument('--rate', type=float, default=None, metavar='RPS', help="毎秒のリクエスト数 (指定するとオープンループ)")
+    parser.add_argument('--duration', type=float, default=DEFAULT_DURATION, metavar='SEC', help=f"計測時間 (秒, デフォルト: {DEFAULT_DURATION})")
+    parser.add_argument('--warmup', type=float, default=DEFAULT_WARMUP, metavar='SEC', help=f"計測前に捨てる時間 (秒, デフォルト: {DEFAULT_WARMUP})")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT, metavar='SEC', help=f"1リクエストのタイムアウト (秒, デフォルト: {DEFAULT_TIMEOUT})")
+    parser.add_argument('--use-cache', action='store_true', help="サーバーの推論結果キャッシュを使う (デフォルトは Cache-Control: no-cache で無効化)")
+    parser.add_argument('--header', action='append', default=[], metavar='NAME:VALUE', help="追加のリクエストヘッダー (複数指定可)")
+    parser.add_argument('--seed', type=int, default=0, help="乱数シード (デフォルト: 0)")
+    parser.add_argument('--output', default=None, metavar='FILE', help="結果の JSON の保存先 (省略時は保存しない)")
+    parser.add_argument('--label', default=None, help="結果に記録するラベル (比較用)")
+    parser.add_argument('--start-server', action='store_true', help="Server.py を起動してから計測し、終わったら止める")
+    parser.add_argument('--stub', action='store_true', help="--start-server で stub バックエンド (モデル無し) を使い HTTP 層だけを計測する")
+    parser.add_argument('--stub-latency-ms', type=float, default=0.0, metavar='MS', help="stub バックエンドの模擬推論時間 (ミリ秒, デフォルト: 0)")
+    parser.add_argument('--server-log', default=None, metavar='FILE', help="--start-server で起動したサーバーのログの保存先")
+    parser.add_argument('--server-args', nargs=argparse.REMAINDER, default=[], help="以降の引数をそのまま Server.py に渡す")
+    args = parser.parse_args()
+    if args.stub and not args.start_server:
+        parser.error("--stub requires --start-server (or start Server.py yourself with --backend stub)")
+
+    headers = {}
+    for header in args.header:
+        name, sep, value = header.partition(':')
+        if not sep:
+            parser.error(f"--header must look like NAME:VALUE, got {header!r}")
+        headers[name.strip()] = value.strip()
+    if not args.use_cache:
+        headers.setdefault('Cache-Control', 'no-cache')
+
+    print(f"Generating {args.frames} frames for each of {len(args.resolutions)} resolutions...")
+    frames = build_frames(args.resolutions, max(1, args.frames), args.quality, args.seed)
+    random.Random(args.seed).shuffle(frames)
+
+    process = start_server(args) if args.start_server else None
+    try:
+        status, server_status = fetch_json(args.host, args.port, '/status')
+        if status is None:
+            print(f"[エラー] {args.host}:{args.port} のサーバーに接続できません")
+            return 1
+        clients = [Client(args.host, args.port, args.path, args.timeout, headers) for _ in range(max(1, args.concurrency))]
+        samples = []
+        started = time.perf_counter()
+        measure_from = started + max(0.0, args.warmup)
+        deadline = measure_from + args.duration
+        mode = 'open' if args.rate else 'closed'
+        print(f"Running {mode}-loop load for {args.duration:.0f} s (+{args.warmup:.0f} s warm-up) against "
+              f"http://{args.host}:{args.port}{args.path} with {len(clients)} connections"
+              + (f" at {args.rate} req/s" if args.rate else "") + "...")
+        if args.rate:
+            run_open_loop(clients, frames, deadline, args.rate, samples)
+        else:
+            run_closed_loop(clients, frames, deadline, samples)
+        # ウォームアップ中に送ったものと、計測終了後に予定されたものは除く
+        measured = [sample for sample in samples if measure_from <= sample.started < deadline]
+        _, server_status_after = fetch_json(args.host, args.port, '/status')
+    finally:
+        if process is not None:
+            stop_server(process)
+
+    result = {
+        'label': args.label,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': git_revision(),
+        'config': {
+            'target': f'http://{args.host}:{args.port}{args.path}',
+            'mode': mode,
+            'concurrency': len(clients),
+            'rate': args.rate,
+            'duration_seconds': args.duration,
+            'warmup_seconds': args.warmup,
+            'resolutions': [f'{w}x{h}' for w, h in args.resolutions],
+            'frames_per_resolution': args.frames,
+            'jpeg_quality': args.quality,
+            'use_cache': args.use_cache,
+            'started_server': args.start_server,
+            'stub': args.stub,
+        },
+        'server': {
+            'model': (server_status or {}).get('model'),
+            'worker': (server_status or {}).get('worker'),
+            'batching': (server_status_after or {}).get('batching'),
+        },
+        'summary': summarize(measured, args.duration),
+    }
+    print_report(result)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
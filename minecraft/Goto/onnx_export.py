@@ -0,0 +1,57 @@
+import os
+import time
+import shutil
+import hashlib
+import logging
+import tempfile
+
+# Server.py と quantize.py で共有する ONNX 変換・キャッシュ処理
+# キャッシュファイル名は <重みファイル名>_<sha256先頭16文字>_<imgsz>[_int8].onnx
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_key(weights_path, imgsz):
+    """重みファイルの内容と推論サイズからキャッシュキーを作る"""
+    return f"{os.path.splitext(os.path.basename(weights_path))[0]}_{file_sha256(weights_path)[:16]}_{imgsz}"
+
+
+def onnx_model_path(weights_path, imgsz, cache_dir):
+    return os.path.join(cache_dir, f"{cache_key(weights_path, imgsz)}.onnx")
+
+
+def int8_model_path(weights_path, imgsz, cache_dir):
+    return os.path.join(cache_dir, f"{cache_key(weights_path, imgsz)}_int8.onnx")
+
+
+def export_onnx_cached(weights_path, imgsz, cache_dir):
+    """重みファイルを ONNX に変換してキャッシュし、そのパスを返す (キャッシュがあれば変換しない)"""
+    from ultralytics import YOLO
+
+    onnx_path = onnx_model_path(weights_path, imgsz, cache_dir)
+    if os.path.exists(onnx_path):
+        logging.info(f"Using cached ONNX model: {onnx_path}")
+        return onnx_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    logging.info(f"Exporting {weights_path} to ONNX (imgsz={imgsz}). This only happens once per weights file...")
+    start_time = time.time()
+    # 書き出し先を重みファイルの隣にしないよう、作業用ディレクトリに重みをコピーしてから export する
+    work_dir = tempfile.mkdtemp(prefix='export_', dir=cache_dir)
+    try:
+        work_weights = os.path.join(work_dir, os.path.splitext(os.path.basename(onnx_path))[0] + '.pt')
+        shutil.copyfile(weights_path, work_weights)
+        # dynamic=True: バッチサイズと入力解像度を可変にする (マイクロバッチで使うため)
+        # simplify=True: グラフを簡略化して ONNX Runtime での推論を速くする
+        exported = YOLO(work_weights).export(format='onnx', imgsz=imgsz, dynamic=True, simplify=True)
+        os.replace(exported, onnx_path) # 完成したファイルだけをキャッシュに置く
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    logging.info(f"ONNX export finished in {time.time() - start_time:.1f} seconds: {onnx_path}")
+    return onnx_path
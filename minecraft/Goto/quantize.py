@@ -0,0 +1,244 @@
+import os
+import json
+import time
+import random
+import argparse
+import logging
+
+import cv2
+import numpy as np
+
+from onnx_export import export_onnx_cached, int8_model_path
+
+# --- 設定 ---
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_WEIGHTS = os.path.join(SCRIPT_DIR, 'best.pt') # 量子化する学習済みモデル (Server.py と同じ)
+DEFAULT_DATA_YAML = './dataset/data.yaml'      # build.py が生成する data.yaml
+DEFAULT_VAL_DIR = './dataset/images/val'       # build.py の split_dataset が作る検証用画像
+DEFAULT_IMG_SIZE = 648                         # Server.py の IMAGE_SIZE と合わせる
+DEFAULT_CACHE_DIR = os.path.join(SCRIPT_DIR, 'model_cache') # Server.py の MODEL_CACHE_DIR と同じ場所
+DEFAULT_CALIB_IMAGES = 200                     # キャリブレーションに使う画像数
+DEFAULT_LATENCY_IMAGES = 50                    # レイテンシ計測に使う画像数
+DEFAULT_LATENCY_RUNS = 3                       # 1画像あたりの計測回数
+DEFAULT_REPORT = './quantize_report.json'
+RANDOM_SEED = 42
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def list_val_images(val_dir):
+    return sorted(os.path.join(val_dir, f) for f in os.listdir(val_dir) if f.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def preprocess(img_bgr, size):
+    """ultralytics の推論前処理 (レターボックス, BGR->RGB, CHW, 0-1 正規化) と同じ変換を行う"""
+    h, w = img_bgr.shape[:2]
+    ratio = min(size / h, size / w)
+    new_w, new_h = int(round(w * ratio)), int(round(h * ratio))
+    resized = cv2.resize(img_bgr, (new_w, new_h), interpolation=cv2.INTER_LINEAR) if (new_w, new_h) != (w, h) else img_bgr
+    canvas = np.full((size, size, 3), 114, dtype=np.uint8)
+    top, left = (size - new_h) // 2, (size - new_w) // 2
+    canvas[top:top + new_h, left:left + new_w] = resized
+    return np.ascontiguousarray(canvas[:, :, ::-1].transpose(2, 0, 1))[None].astype(np.float32) / 255.0
+
+
+class ValImageCalibrationReader:
+    """検証用画像を1枚ずつ ONNX Runtime のキャリブレーションに渡す"""
+
+    def __init__(self, image_paths, input_name, size):
+        self._paths = iter(image_paths)
+        self._input_name = input_name
+        self._size = size
+
+    def get_next(self):
+        for path in self._paths:
+            img = cv2.imread(path)
+            if img is None:
+                print(f"[警告] スキップ: 画像を読み込めません: {path}")
+                continue
+            return {self._input_name: preprocess(img, self._size)}
+        return None
+
+    def rewind(self):
+        pass
+
+
+def head_nodes_to_exclude(onnx_model):
+    """
+    検出ヘッド最終段 (DFL・座標デコード・Concat) を量子化対象から外す。
+    座標 (0〜imgsz) とクラス確率 (0〜1) が同じテンソルに連結されるため、
+    ここを INT8 にすると精度が大きく落ちる。畳み込み層は量子化したままにする。
+    """
+    prefixes = [node.name.split('/')[1] for node in onnx_model.graph.node
+                if node.name.startswith('/model.') and len(node.name.split('/')) > 2]
+    if not prefixes:
+        return []
+    head = max(prefixes, key=lambda p: int(p.split('.')[1]) if p.split('.')[1].isdigit() else -1)
+    return [node.name for node in onnx_model.graph.node
+            if node.name.startswith(f'/{head}/') and (node.op_type != 'Conv' or '/dfl/' in node.name)]
+
+
+def quantize_model(fp32_path, int8_path, image_paths, size, per_channel=True):
+    """FP32 ONNX モデルを検証画像でキャリブレーションして静的 INT8 (QDQ) モデルを作る"""
+    import onnx
+    import onnxruntime as ort
+    from onnxruntime.quantization import quantize_static, QuantFormat, QuantType, CalibrationMethod
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    prepared_path = int8_path.replace('_int8.onnx', '_prep.onnx')
+    try:
+        # 形状推論とグラフ最適化を先に済ませておく (量子化の推奨手順)
+        quant_pre_process(fp32_path, prepared_path, skip_symbolic_shape=False)
+        source_path = prepared_path
+    except Exception as e:
+        print(f"[警告] 量子化前処理に失敗したため元のモデルをそのまま使います: {e}")
+        source_path = fp32_path
+
+    fp32_model = onnx.load(fp32_path)
+    input_name = ort.InferenceSession(fp32_path, providers=['CPUExecutionProvider']).get_inputs()[0].name
+    excluded = head_nodes_to_exclude(fp32_model)
+    print(f"[情報] キャリブレーション画像 {len(image_paths)} 枚で静的量子化を実行します (除外ノード {len(excluded)} 個)...")
+    start_time = time.time()
+    quantize_static(
+        source_path,
+        int8_path,
+        ValImageCalibrationReader(image_paths, input_name, size),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=per_channel,
+        calibrate_method=CalibrationMethod.MinMax,
+        nodes_to_exclude=excluded,
+    )
+    if source_path == prepared_path:
+        os.remove(prepared_path)
+
+    # ultralytics がクラス名・stride・imgsz を読むメタデータを INT8 モデルにも引き継ぐ
+    int8_model = onnx.load(int8_path)
+    del int8_model.metadata_props[:]
+    int8_model.metadata_props.extend(fp32_model.metadata_props)
+    onnx.save(int8_model, int8_path)
+    print(f"[情報] INT8 モデルを保存しました ({time.time() - start_time:.1f} 秒): {int8_path}")
+
+
+def measure_latency(model, image_paths, imgsz, runs):
+    """Server.py と同じ model.predict 呼び出しで1枚ずつの処理時間 (ms) を計測する"""
+    images = [img for img in (cv2.imread(p) for p in image_paths) if img is not None]
+    if not images:
+        return None
+    for img in images[:3]: # ウォームアップ
+        model.predict(img, imgsz=imgsz, verbose=False)
+    samples = []
+    for _ in range(runs):
+        for img in images:
+            start_time = time.perf_counter()
+            model.predict(img, imgsz=imgsz, verbose=False)
+            samples.append((time.perf_counter() - start_time) * 1000.0)
+    samples.sort()
+    return {
+        'samples': len(samples),
+        'p50_ms': round(float(np.percentile(samples, 50)), 3),
+        'p99_ms': round(float(np.percentile(samples, 99)), 3),
+        'mean_ms': round(float(np.mean(samples)), 3),
+    }
+
+
+def evaluate_map(model, data_yaml, imgsz):
+    """検証データ (data.yaml の val) で mAP を計算する"""
+    metrics = model.val(data=data_yaml, imgsz=imgsz, split='val', batch=1, plots=False, verbose=False)
+    return {'map50': round(float(metrics.box.map50), 5), 'map50_95': round(float(metrics.box.map), 5)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="best.pt を静的 INT8 ONNX モデルに量子化し、FP32 との精度・速度を比較する")
+    parser.add_argument('--weights', default=DEFAULT_WEIGHTS, help=f"量子化する .pt ファイル (デフォルト: {DEFAULT_WEIGHTS})")
+    parser.add_argument('--data', default=DEFAULT_DATA_YAML, help=f"mAP 評価に使う data.yaml (デフォルト: {DEFAULT_DATA_YAML})")
+    parser.add_argument('--val-dir', default=DEFAULT_VAL_DIR, help=f"キャリブレーション・計測に使う検証画像 (デフォルト: {DEFAULT_VAL_DIR})")
+    parser.add_argument('--imgsz', type=int, default=DEFAULT_IMG_SIZE, help=f"推論サイズ (Server.py の IMAGE_SIZE, デフォルト: {DEFAULT_IMG_SIZE})")
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR, help=f"ONNX モデルの保存先 (デフォルト: {DEFAULT_CACHE_DIR})")
+    parser.add_argument('--calib-images', type=int, default=DEFAULT_CALIB_IMAGES, metavar='N',
+                        help=f"キャリブレーションに使う検証画像の枚数 (デフォルト: {DEFAULT_CALIB_IMAGES})")
+    parser.add_argument('--latency-images', type=int, default=DEFAULT_LATENCY_IMAGES, metavar='N',
+                        help=f"レイテンシ計測に使う画像の枚数 (デフォルト: {DEFAULT_LATENCY_IMAGES})")
+    parser.add_argument('--latency-runs', type=int, default=DEFAULT_LATENCY_RUNS, metavar='N',
+                        help=f"1画像あたりの計測回数 (デフォルト: {DEFAULT_LATENCY_RUNS})")
+    parser.add_argument('--no-per-channel', action='store_true', help="重みをチャネル単位ではなくテンソル単位で量子化する")
+    parser.add_argument('--skip-map', action='store_true', help="mAP 評価を省略する (レイテンシだけ比較する)")
+    parser.add_argument('--force', action='store_true', help="既存の INT8 モデルがあっても作り直す")
+    parser.add_argument('--report', default=DEFAULT_REPORT, help=f"比較レポートの出力先 JSON (デフォルト: {DEFAULT_REPORT})")
+    args = parser.parse_args()
+
+    from ultralytics import YOLO
+    from ultralytics.utils.checks import check_imgsz
+
+    if not os.path.isfile(args.weights):
+        print(f"[エラー] モデルファイルが見つかりません: {args.weights}"); return 1
+    if not os.path.isdir(args.val_dir):
+        print(f"[エラー] 検証画像ディレクトリが見つかりません: {args.val_dir} (build.py でデータセットを分割してください)"); return 1
+    val_images = list_val_images(args.val_dir)
+    if not val_images:
+        print(f"[エラー] 検証画像がありません: {args.val_dir}"); return 1
+
+    # モデルの実際の入力サイズ (stride の倍数に切り上げ) でキャリブレーションする
+    input_size = check_imgsz(args.imgsz, stride=32)
+    rng = random.Random(RANDOM_SEED)
+    calib_images = rng.sample(val_images, min(args.calib_images, len(val_images)))
+    latency_images = rng.sample(val_images, min(args.latency_images, len(val_images)))
+
+    fp32_path = export_onnx_cached(os.path.abspath(args.weights), args.imgsz, args.cache_dir)
+    int8_path = int8_model_path(os.path.abspath(args.weights), args.imgsz, args.cache_dir)
+    if args.force or not os.path.exists(int8_path):
+        quantize_model(fp32_path, int8_path, calib_images, input_size, per_channel=not args.no_per_channel)
+    else:
+        print(f"[情報] 既存の INT8 モデルを使います (作り直す場合は --force): {int8_path}")
+
+    report = {
+        'weights': os.path.abspath(args.weights),
+        'imgsz': args.imgsz,
+        'input_size': input_size,
+        'calibration_images': len(calib_images),
+        'val_images': len(val_images),
+        'models': {},
+    }
+    for label, path in (('fp32', fp32_path), ('int8', int8_path)):
+        print(f"[情報] {label.upper()} モデルを評価中: {path}")
+        model = YOLO(path, task='detect')
+        entry = {'path': path, 'size_mb': round(os.path.getsize(path) / (1 << 20), 3)}
+        entry['latency'] = measure_latency(model, latency_images, args.imgsz, args.latency_runs)
+        if not args.skip_map:
+            try:
+                entry['accuracy'] = evaluate_map(model, args.data, args.imgsz)
+            except Exception as e:
+                print(f"[警告] {label.upper()} の mAP 評価に失敗しました: {e}")
+                entry['accuracy'] = None
+        report['models'][label] = entry
+
+    fp32, int8 = report['models']['fp32'], report['models']['int8']
+    comparison = {}
+    if fp32['latency'] and int8['latency']:
+        comparison['speedup_p50'] = round(fp32['latency']['p50_ms'] / int8['latency']['p50_ms'], 3)
+        comparison['speedup_p99'] = round(fp32['latency']['p99_ms'] / int8['latency']['p99_ms'], 3)
+    if fp32.get('accuracy') and int8.get('accuracy'):
+        comparison['map50_delta'] = round(int8['accuracy']['map50'] - fp32['accuracy']['map50'], 5)
+        comparison['map50_95_delta'] = round(int8['accuracy']['map50_95'] - fp32['accuracy']['map50_95'], 5)
+    report['comparison'] = comparison
+
+    with open(args.report, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print("-" * 30 + "\n[情報] FP32 / INT8 比較結果:")
+    for label in ('fp32', 'int8'):
+        entry = report['models'][label]
+        latency = entry['latency'] or {}
+        accuracy = entry.get('accuracy') or {}
+        print(f"  {label.upper()}: p50 {latency.get('p50_ms')} ms, p99 {latency.get('p99_ms')} ms, "
+              f"mAP50 {accuracy.get('map50')}, mAP50-95 {accuracy.get('map50_95')}, {entry['size_mb']} MB")
+    print(f"  比較: {comparison}")
+    print(f"[情報] レポートを保存しました: {args.report}")
+    print(f"[情報] Server.py --backend onnx-int8 で配信できます (Server.py の IMAGE_SIZE が {args.imgsz} の場合)")
+    return 0
+
+
+if __name__ == '__main__':
+    raise SystemExit(main())
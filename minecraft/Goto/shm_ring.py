@@ -0,0 +1,207 @@
+import json
+import socket
+import struct
+import threading
+
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+import detection_codec
+
+# 同じホストのクライアントから Server.py へ、JPEG にせず生の BGR フレームを渡すための共有メモリのリングバッファ
+# (Server.py とクライアントで共有する)
+#
+# クライアントが共有メモリ (リング) を作り、空いているスロットにフレームを書いてから、
+# Unix ドメインソケットでスロット番号だけを送る。サーバーはスロットをコピーせずに NumPy 配列として推論に渡す。
+# 応答を受け取るまでそのスロットは書き換えない (スロット数だけ応答を待たずに送れる)。
+# ソケットに接続できれば任意の共有メモリを開かせられるため、サーバーはソケットを 600 (--shm-socket-mode) で作る。
+#
+# 共有メモリのレイアウト (すべてリトルエンディアン):
+#   ヘッダー 64 バイト: magic b'GRNG' | version u8 | 予約 u8 | 予約 u16 | スロット数 u32 | 1スロットのバイト数 u32
+#   スロット i は 64 + i × スロットのバイト数 から始まる (64 バイト境界に揃える)
+#   スロットの中身は height × width × 3 (BGR, uint8, 行の詰め物なし)
+#
+# ソケットのメッセージは「長さ u32 + 本体」:
+#   クライアント → サーバー: 最初に接続要求 (JSON: {"ring": 共有メモリ名, "request_id": 省略可, "source": 省略可}),
+#                            以降はフレーム要求 (seq u64 | slot u32 | width u32 | height u32)
+#   サーバー → クライアント: 接続応答 (JSON: {"ok": true, "request_id": デバッグ画像の検索に使う ID, ...}),
+#                            以降は seq u64 | ステータス u16 (HTTP と同じ意味) | 本体
+#                            本体はステータス 200 なら detection_codec の固定レイアウト、それ以外は JSON のエラー
+
+MAGIC = b'GRNG'
+VERSION = 1
+RING_HEADER = struct.Struct('<4sBBHII')
+RING_HEADER_SIZE = 64
+ALIGNMENT = 64
+CHANNELS = 3
+LENGTH = struct.Struct('<I')
+FRAME_REQUEST = struct.Struct('<QIII')
+FRAME_REPLY = struct.Struct('<QH')
+DEFAULT_SOCKET_PATH = '/tmp/goto-ingest.sock'
+DEFAULT_SLOTS = 4
+
+
+def slot_bytes_for(max_width, max_height):
+    size = max_width * max_height * CHANNELS
+    return (size + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def attach_shared_memory(name):
+    """
+    クライアントが作った共有メモリを開く。
+    Python 3.12 以前は開いただけのプロセスも終了時に共有メモリを削除してしまうため、追跡を外す。
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class Ring:
+    """共有メモリ上のリングバッファ (作成はクライアント、サーバーは attach で開く)"""
+
+    def __init__(self, shm, owner):
+        self.shm = shm
+        self.owner = owner
+        magic, version, _, _, self.slot_count, self.slot_bytes = RING_HEADER.unpack_from(shm.buf, 0)
+        if magic != MAGIC:
+            raise ValueError(f"Shared memory '{shm.name}' is not a frame ring (magic={magic!r})")
+        if version != VERSION:
+            raise ValueError(f"Unsupported frame ring version {version}")
+        if RING_HEADER_SIZE + self.slot_count * self.slot_bytes > shm.size:
+            raise ValueError(f"Shared memory '{shm.name}' is smaller than its header claims")
+
+    @classmethod
+    def create(cls, max_width, max_height, slots=DEFAULT_SLOTS):
+        slot_bytes = slot_bytes_for(max_width, max_height)
+        shm = shared_memory.SharedMemory(create=True, size=RING_HEADER_SIZE + slots * slot_bytes)
+        RING_HEADER.pack_into(shm.buf, 0, MAGIC, VERSION, 0, 0, slots, slot_bytes)
+        return cls(shm, owner=True)
+
+    @classmethod
+    def attach(cls, name):
+        return cls(attach_shared_memory(name), owner=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def view(self, slot, width, height):
+        """スロットの中身をコピーせずに (height, width, 3) の uint8 配列として返す"""
+        if not 0 <= slot < self.slot_count:
+            raise ValueError(f"Slot {slot} is out of range (ring has {self.slot_count} slots)")
+        if width <= 0 or height <= 0 or width * height * CHANNELS > self.slot_bytes:
+            raise ValueError(f"Frame {width}x{height} does not fit in a {self.slot_bytes}-byte slot")
+        offset = RING_HEADER_SIZE + slot * self.slot_bytes
+        return np.ndarray((height, width, CHANNELS), dtype=np.uint8, buffer=self.shm.buf, offset=offset)
+
+    def close(self):
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def send_message(sock, payload):
+    sock.sendall(LENGTH.pack(len(payload)) + payload)
+
+
+def _recv_exact(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed")
+        data.extend(chunk)
+    return bytes(data)
+
+
+def receive_message(sock, max_bytes=16 * 1024 * 1024):
+    (length,) = LENGTH.unpack(_recv_exact(sock, LENGTH.size))
+    if length > max_bytes:
+        raise ValueError(f"Message of {length} bytes exceeds the limit of {max_bytes}")
+    return _recv_exact(sock, length)
+
+
+def encode_reply(seq, status, body):
+    return FRAME_REPLY.pack(seq, status) + body
+
+
+def decode_reply(data):
+    """
+    クライアント用: フレームの応答を辞書にする。
+    成功 (status 200) なら 'predictions' が列形式 (NumPy 配列)、失敗なら 'error' を持つ。
+    """
+    seq, status = FRAME_REPLY.unpack_from(data, 0)
+    body = memoryview(data)[FRAME_REPLY.size:]
+    if status == 200:
+        return {'seq': seq, 'status': status, 'predictions': detection_codec.decode_packed(body)}
+    return dict(json.loads(bytes(body)), seq=seq, status=status)
+
+
+class IngestClient:
+    """
+    Server.py の共有メモリ受信 (--shm-ingest) に生の BGR フレームを送るクライアント。
+    predict(frame) は1枚ずつ、submit / receive を分けるとスロット数まで応答を待たずに送れる。
+    """
+
+    def __init__(self, max_width, max_height, slots=DEFAULT_SLOTS, socket_path=DEFAULT_SOCKET_PATH, request_id=None, source=None):
+        self.ring = Ring.create(max_width, max_height, slots)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(socket_path)
+            send_message(self.sock, json.dumps({'ring': self.ring.name, 'request_id': request_id, 'source': source}).encode('utf-8'))
+            hello = json.loads(receive_message(self.sock))
+            if not hello.get('ok'):
+                raise ConnectionError(f"Server refused the ring: {hello.get('error')}")
+        except BaseException:
+            self.close()
+            raise
+        self.request_id = hello.get('request_id')
+        self._next_seq = 0
+        self._free = list(range(slots))
+        self._in_flight = {} # seq -> slot
+        self._lock = threading.Lock()
+
+    def submit(self, frame):
+        """フレーム (H×W×3 の uint8 BGR) を空いているスロットに書いて送り、seq を返す。空きが無ければ RuntimeError"""
+        frame = np.asarray(frame)
+        if frame.dtype != np.uint8 or frame.ndim != 3 or frame.shape[2] != CHANNELS:
+            raise ValueError(f"Expected an HxWx3 uint8 BGR frame, got {frame.dtype} {frame.shape}")
+        height, width = frame.shape[:2]
+        with self._lock:
+            if not self._free:
+                raise RuntimeError("No free slot: receive() replies before submitting more frames")
+            slot = self._free.pop(0)
+            seq = self._next_seq
+            self._next_seq += 1
+            self._in_flight[seq] = slot
+        self.ring.view(slot, width, height)[...] = frame
+        send_message(self.sock, FRAME_REQUEST.pack(seq, slot, width, height))
+        return seq
+
+    def receive(self):
+        """次の応答を受け取り、そのスロットを空きに戻して decode_reply の辞書を返す"""
+        reply = decode_reply(receive_message(self.sock))
+        with self._lock:
+            slot = self._in_flight.pop(reply['seq'], None)
+            if slot is not None:
+                self._free.append(slot)
+        return reply
+
+    def predict(self, frame):
+        self.submit(frame)
+        return self.receive()
+
+    def close(self):
+        try:
+            self.sock.close()
+        finally:
+            self.ring.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
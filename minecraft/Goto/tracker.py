@@ -0,0 +1,233 @@
+import time
+import threading
+import collections
+
+import numpy as np
+
+# /track 用の複数物体トラッカー (ByteTrack / SORT の簡易版)
+# - 検出は信頼度の高いものから先にトラックへ対応付け、残ったトラックを低信頼度の検出で補う (ByteTrack)
+# - 対応付けはクラスごとの IoU による貪欲マッチング
+# - 検出を行わないフレームは等速運動モデルで位置を予測する
+
+
+def iou_matrix(a, b):
+    """(N,4) と (M,4) の xyxy 矩形の IoU を (N,M) で返す"""
+    if len(a) == 0 or len(b) == 0:
+        return np.zeros((len(a), len(b)))
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-9)
+
+
+def greedy_match(iou, threshold):
+    """IoU の大きい組から順に対応付ける。(トラック添字, 検出添字) のリストを返す"""
+    pairs = []
+    if iou.size == 0:
+        return pairs
+    used_rows, used_cols = set(), set()
+    for flat in np.argsort(-iou, axis=None):
+        row, col = divmod(int(flat), iou.shape[1])
+        if iou[row, col] < threshold:
+            break
+        if row in used_rows or col in used_cols:
+            continue
+        used_rows.add(row)
+        used_cols.add(col)
+        pairs.append((row, col))
+    return pairs
+
+
+class Track:
+    __slots__ = ('track_id', 'class_id', 'class_name', 'confidence', 'box', 'velocity',
+                 'hits', 'misses', 'age', 'last_box', 'last_frame')
+
+    def __init__(self, track_id, class_id, class_name, confidence, box, frame):
+        self.track_id = track_id
+        self.class_id = class_id
+        self.class_name = class_name
+        self.confidence = confidence
+        self.box = box
+        self.velocity = np.zeros(4) # 1フレームあたりの xyxy の移動量
+        self.hits = 1   # 検出と対応付いた回数
+        self.misses = 0 # 連続して検出と対応付かなかった検出フレーム数
+        self.age = 0    # 作成からのフレーム数
+        self.last_box = box
+        self.last_frame = frame
+
+    def predict(self):
+        self.box = self.box + self.velocity
+        self.age += 1
+
+    def update(self, box, confidence, frame, smoothing):
+        # 前回の検出からの移動量をフレーム数で割って速度にし、指数移動平均で滑らかにする
+        gap = max(1, frame - self.last_frame)
+        velocity = (box - self.last_box) / gap
+        self.velocity = velocity if self.hits == 1 else smoothing * velocity + (1.0 - smoothing) * self.velocity
+        self.box = box
+        self.last_box = box
+        self.last_frame = frame
+        self.confidence = confidence
+        self.hits += 1
+        self.misses = 0
+
+    def to_dict(self, predicted):
+        x1, y1, x2, y2 = (float(v) for v in self.box)
+        return {
+            'track_id': self.track_id,
+            'class_id': self.class_id,
+            'class_name': self.class_name,
+            'confidence': self.confidence,
+            'box': {'x1': x1, 'y1': y1, 'x2': x2, 'y2': y2},
+            'predicted': predicted, # True: このフレームでは検出せず位置を予測した
+            'hits': self.hits,
+            'age': self.age,
+        }
+
+
+class Tracker:
+    """1セッション分のトラッカー。フレームごとに step() を1回呼ぶ"""
+
+    def __init__(self, iou_threshold=0.2, high_confidence=0.5, max_missed=10, smoothing=0.5):
+        self.iou_threshold = iou_threshold
+        self.high_confidence = high_confidence
+        self.max_missed = max_missed
+        self.smoothing = smoothing
+        self.tracks = []
+        self.frame = 0
+        self._next_id = 1
+
+    def _associate(self, tracks, xyxy, cls, det_indices):
+        """tracks と det_indices の検出を対応付け、(対応付いた組, 残ったトラック, 残った検出) を返す"""
+        if not tracks or not len(det_indices):
+            return [], tracks, list(det_indices)
+        track_boxes = np.array([track.box for track in tracks])
+        track_classes = np.array([track.class_id for track in tracks])
+        iou = iou_matrix(track_boxes, xyxy[det_indices])
+        iou[track_classes[:, None] != cls[det_indices][None, :]] = 0.0 # 別クラス同士は対応付けない
+        pairs = greedy_match(iou, self.iou_threshold)
+        matched_tracks = {row for row, _ in pairs}
+        matched_dets = {col for _, col in pairs}
+        return ([(tracks[row], det_indices[col]) for row, col in pairs],
+                [track for i, track in enumerate(tracks) if i not in matched_tracks],
+                [index for i, index in enumerate(det_indices) if i not in matched_dets])
+
+    def step(self, detections=None):
+        """
+        1フレーム進める。detections は (xyxy[N,4], conf[N], cls[N], class_names) または None。
+        None のフレームは検出を行わず、全トラックを等速運動で予測した位置で返す。
+        戻り値は (トラック, 予測だけかどうか) のリスト。
+        """
+        self.frame += 1
+        for track in self.tracks:
+            track.predict()
+        if detections is None:
+            return [(track, True) for track in self.tracks if track.misses == 0]
+
+        xyxy, conf, cls, class_names = detections
+        high = [i for i in range(len(conf)) if conf[i] >= self.high_confidence]
+        low = [i for i in range(len(conf)) if conf[i] < self.high_confidence]
+        # 1段階目: 高信頼度の検出、2段階目: 残ったトラックと低信頼度の検出
+        matched, remaining, unmatched_high = self._associate(self.tracks, xyxy, cls, high)
+        matched_low, remaining, _ = self._associate(remaining, xyxy, cls, low)
+        for track, index in matched + matched_low:
+            track.update(xyxy[index], float(conf[index]), self.frame, self.smoothing)
+        for track in remaining:
+            track.misses += 1
+        # 対応付かなかった高信頼度の検出から新しいトラックを作る
+        for index in unmatched_high:
+            self.tracks.append(Track(self._next_id, int(cls[index]), class_names[index], float(conf[index]), xyxy[index], self.frame))
+            self._next_id += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_missed]
+        return [(track, False) for track in self.tracks if track.misses == 0]
+
+
+class SessionLimitError(RuntimeError):
+    """同時セッション数の上限に達している"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TrackingSession:
+    def __init__(self, session_id, tracker, detect_every):
+        self.session_id = session_id
+        self.tracker = tracker
+        self.detect_every = detect_every
+        self.lock = threading.Lock() # 同じセッションのフレームは順番に処理する
+        self.created = time.time()
+        self.last_seen = self.created
+        self.frames = 0
+        self.keyframes = 0
+
+    def stats(self):
+        return {
+            'session_id': self.session_id,
+            'frames': self.frames,
+            'keyframes': self.keyframes,
+            'detect_every': self.detect_every,
+            'tracks': len(self.tracker.tracks),
+            'idle_seconds': round(time.time() - self.last_seen, 1),
+        }
+
+
+class TrackingSessions:
+    """セッション ID ごとのトラッカー。一定時間使われないセッションは破棄し、同時セッション数に上限を設ける"""
+
+    def __init__(self, tracker_factory, max_sessions=64, timeout=60.0):
+        self.tracker_factory = tracker_factory
+        self.max_sessions = max_sessions
+        self.timeout = timeout
+        self._sessions = collections.OrderedDict() # 最近使われた順
+        self._lock = threading.Lock()
+        self.evicted = 0
+
+    def _evict_expired(self, now):
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if now - session.last_seen <= self.timeout:
+                break
+            self._sessions.popitem(last=False)
+            self.evicted += 1
+
+    def acquire(self, session_id, detect_every):
+        """セッションを取得する (無ければ作る)。上限に達していれば SessionLimitError"""
+        now = time.time()
+        with self._lock:
+            self._evict_expired(now)
+            session = self._sessions.get(session_id)
+            if session is None:
+                if len(self._sessions) >= self.max_sessions:
+                    oldest = next(iter(self._sessions.values()))
+                    retry_after = max(1, int(self.timeout - (now - oldest.last_seen)) + 1)
+                    raise SessionLimitError(f"Too many tracking sessions (max {self.max_sessions})", retry_after)
+                session = self._sessions[session_id] = TrackingSession(session_id, self.tracker_factory(), detect_every)
+            self._sessions.move_to_end(session_id)
+            session.last_seen = now
+            return session
+
+    def close(self, session_id):
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def __len__(self):
+        with self._lock:
+            self._evict_expired(time.time())
+            return len(self._sessions)
+
+    def stats(self):
+        with self._lock:
+            self._evict_expired(time.time())
+            sessions = [session.stats() for session in self._sessions.values()]
+        return {
+            'max_sessions': self.max_sessions,
+            'timeout_seconds': self.timeout,
+            'active': len(sessions),
+            'evicted': self.evicted,
+            'sessions': sessions,
+        }